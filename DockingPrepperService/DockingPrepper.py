@@ -1,32 +1,81 @@
-import subprocess
 import os
+import shutil
+import tempfile
 import logging
+from contextlib import nullcontext
+import numpy as np
+from Structure import Structure
+from Pockets import findPockets
+from WorkerRuntime import run, ProcessError, METRICS, mapsKey
+
+# Bump whenever a change to the receptor pipeline alters its output, so that
+# receptors prepared by older versions are no longer served from the cache.
+PIPELINE_VERSION = 3
+
+PDB2PQR_OPTIONS = ["--ff", "AMBER",
+                   "--with-ph", "7.0",
+                   "--titration-state-method", "propka",
+                   "--quiet"]
 
 class DockingPrepperException(Exception):
     def __init__(self, error):
         self.error = error
 
 class DockingPrepper():
-    def __init__(self, config):
+    def __init__(self, config, fixerPool=None, pqrPool=None, niceness=0, cancellations=None, job=None, accounting=None):
         self.logger = logging.getLogger("DockingPrepperService.DockingPrepper")
         self.config = config
+        self.fixerPool = fixerPool
+        self.pqrPool = pqrPool
+        self.niceness = niceness
+        self.cancellations = cancellations
+        self.job = job
+        self.accounting = accounting
+
+    def niced(self, command):
+        """ Runs `command` at a lower CPU priority when a niceness is set. """
+        if self.niceness > 0:
+            return ["nice", "-n", str(self.niceness)] + command
+        return command
+
+    def runTool(self, tool: str, command):
+        """ Runs an external tool, killing it after `timeouts.<tool>` seconds
+            or when the job is cancelled, and records what it used.
+        """
+        try:
+            with METRICS.stage(tool):
+                return run(self.niced(command), timeout=self.config.get("timeouts", {}).get(tool),
+                           job=self.job, cancellations=self.cancellations, accounting=self.accounting, tool=tool)
+        except ProcessError as e:
+            self.logger.error(e.error)
+            raise DockingPrepperException(e.error)
+
+    def timed(self, tool: str):
+        """ Accounts the wall time of a tool run by a warm pool. """
+        return self.accounting.timed(tool) if self.accounting is not None else nullcontext()
 
     def removeRotamers(self, file, outfile):
+        with open(outfile, "wb") as out:
+            out.write(self.stripRotamers(file))
+
+    def stripRotamers(self, file) -> bytes:
+        """ Returns the structure without alternate locations other than A,
+            and without DNA and RNA residues.
+        """
         deleternadna = True
 
         rnaResidues = ['A', 'G', 'C', 'U', 'I']
         dnaResidues = ['DA', 'DG', 'DC', 'DT', 'DI']
         toDelete = rnaResidues + dnaResidues
 
-        with open(file, "r") as fil:
-            with open(outfile, "w") as out:
-                for line in fil:
-                    if line.startswith("ATOM") or line.startswith("HETATM"):
-                        if deleternadna and (line[17:20].strip() in toDelete):
-                            continue
-                        if line[16:17] != ' ' and line[16:17] != 'A':
-                            continue
-                    out.write(line)
+        with Structure(file) as structure:
+            atoms = structure.atoms()
+            # a record cut off before its altloc column has no valid altloc either
+            drop = (structure.ends - structure.starts <= 16) | \
+                ((structure.altlocs() != ord(' ')) & (structure.altlocs() != ord('A')))
+            if deleternadna:
+                drop |= np.isin(structure.residueNames(), [r.encode() for r in toDelete])
+            return structure.select(~(atoms & drop))
 
     def preparePDBQTLigand(self, fullPath: str) -> str:
         log = ""
@@ -37,13 +86,14 @@ class DockingPrepper():
             raise DockingPrepperException(f"File {fullPath} is not a MOL2 file")
         outputPath = path + ".pdbqt"
         try:
-            pythonsh = subprocess.run([self.config["babelpath"],
+            pythonsh = self.runTool("obabel", [self.config["babelpath"],
                                        "-imol2",
                                        fullPath,
                                        "-p", "7",
                                        "-O",
-                                       outputPath],
-                                       text=True, capture_output=True)
+                                       outputPath])
+        except DockingPrepperException:
+            raise
         except Exception as e:
             self.logger.error(e)
             raise DockingPrepperException(e)
@@ -55,15 +105,25 @@ class DockingPrepper():
         self.logger.info("OpenBabel output:\n" + log)
         return outputPath
 
-    def preparePDBQTReceptor(self, fullPath: str) -> str:
+    def preparePDBQTReceptor(self, fullPath: str, scratch: str = None) -> str:
         """ Four steps:
                 1. Remove rotamers, DNA and RNA
                 2. Apply PDBFixer
                 3. Protonation using PDB2PQR
                 4. Create PDBQT using MGLTools
+            Intermediate structures are kept in `scratch` or a new directory
+            under `scratchpath` (tmpfs) or, with the warm PDBFixer pool, only
+            in memory.
         """
+        if scratch is not None:
+            return self.runReceptorPipeline(fullPath, scratch)
+        with tempfile.TemporaryDirectory(prefix="prep_", dir=self.config.get("scratchpath")) as scratch:
+            return self.runReceptorPipeline(fullPath, scratch)
+
+    def runReceptorPipeline(self, fullPath: str, scratch: str) -> str:
         log = ""
         path, ext = os.path.splitext(fullPath)
+        scratchPath = os.path.join(scratch, os.path.basename(path))
         # ---------------------------------------------
         self.logger.info(f"Checking filetype of {fullPath}")
         if ext.lower() != ".pdb":
@@ -71,88 +131,87 @@ class DockingPrepper():
             raise DockingPrepperException(f"File {fullPath} is not a PDB file")
         # ---------------------------------------------
         self.logger.info(f"Remove rotamers, DNA and RNA from {fullPath}")
-        noRotamersPath = path + "_no_rotamers.pdb"
-        self.removeRotamers(fullPath, noRotamersPath)
+        with METRICS.stage("rotamers"):
+            noRotamers = self.stripRotamers(fullPath)
         # ---------------------------------------------
-        self.logger.info(f"Applying PDBFixer for receptor {noRotamersPath}")
-        fixedOutputPath = path + "_fixed.pdb"
-        fixer = subprocess.run([self.config["condapath"],
-                                self.config["pdbfixerpath"],
-                                   noRotamersPath,
-                                   fixedOutputPath],
-                                   # "--keep-heterogens=none",
-                                   # "--add-atoms=heavy",
-                                   # "--replace-nonstandard",
-                                   # "--add-residues"],
-                                   text=True, capture_output=True)
-        if fixer.returncode != 0:
-            self.logger.error(fixer.stderr)
-            raise DockingPrepperException(fixer.stderr)
-        log += fixer.stdout
-        log += fixer.stderr
-        self.logger.info("PDBFixer output:\n" + fixer.stdout + fixer.stderr)
-        self.logger.info("Removing: " + noRotamersPath)
-        os.remove(noRotamersPath)
+        fixedOutputPath = scratchPath + "_fixed.pdb"
+        if self.fixerPool is not None:
+            self.logger.info(f"Applying PDBFixer for receptor {fullPath}")
+            try:
+                with METRICS.stage("pdbfixer"), self.timed("pdbfixer"):
+                    fixed = self.fixerPool.fixText(noRotamers.decode(), self.job, self.cancellations)
+            except DockingPrepperException as e:
+                self.logger.error(e.error)
+                raise
+            with open(fixedOutputPath, "w") as file:
+                file.write(fixed)
+        else:
+            noRotamersPath = scratchPath + "_no_rotamers.pdb"
+            with open(noRotamersPath, "wb") as file:
+                file.write(noRotamers)
+            self.logger.info(f"Applying PDBFixer for receptor {noRotamersPath}")
+            fixer = self.runTool("pdbfixer", [self.config["condapath"],
+                                    self.config["pdbfixerpath"],
+                                       noRotamersPath,
+                                       fixedOutputPath])
+                                       # "--keep-heterogens=none",
+                                       # "--add-atoms=heavy",
+                                       # "--replace-nonstandard",
+                                       # "--add-residues"],
+            if fixer.returncode != 0:
+                self.logger.error(fixer.stderr)
+                raise DockingPrepperException(fixer.stderr)
+            log += fixer.stdout
+            log += fixer.stderr
+            self.logger.info("PDBFixer output:\n" + fixer.stdout + fixer.stderr)
         # ---------------------------------------------
         self.logger.info(f"Protonation using PDB2PQR for receptor {fixedOutputPath}")
-        protonatedOutputPath = path + "_protonated.pqr"
-        pqr = subprocess.run([self.config["pdb2pqrpath"],
-                              "--ff", "AMBER",
-                              "--with-ph", "7.0",
-                              "--titration-state-method", "propka",
-                              "--quiet",
-                              fixedOutputPath,
-                              protonatedOutputPath],
-                              text=True, capture_output=True)
-        if pqr.returncode != 0:
-            self.logger.error(pqr.stderr)
-            raise DockingPrepperException(pqr.stderr)
-        log += pqr.stdout
-        log += pqr.stderr
-        self.logger.info("PDB2PQR output:\n" + pqr.stdout + pqr.stderr)
-        self.logger.info("Removing: " + fixedOutputPath)
-        os.remove(fixedOutputPath)
-        self.logger.info("Removing: " + path + "_protonated.log")
-        os.remove(path + "_protonated.log")
+        protonatedOutputPath = scratchPath + "_protonated.pqr"
+        if self.pqrPool is not None:
+            try:
+                with METRICS.stage("pdb2pqr"), self.timed("pdb2pqr"):
+                    self.pqrPool.protonate(fixedOutputPath, protonatedOutputPath, self.job, self.cancellations)
+            except DockingPrepperException as e:
+                self.logger.error(e.error)
+                raise
+        else:
+            pqr = self.runTool("pdb2pqr", [self.config["pdb2pqrpath"]] +
+                                  PDB2PQR_OPTIONS +
+                                 [fixedOutputPath,
+                                  protonatedOutputPath])
+            if pqr.returncode != 0:
+                self.logger.error(pqr.stderr)
+                raise DockingPrepperException(pqr.stderr)
+            log += pqr.stdout
+            log += pqr.stderr
+            self.logger.info("PDB2PQR output:\n" + pqr.stdout + pqr.stderr)
         # ---------------------------------------------
         outputPath = path + "_protonated.pdbqt"
         self.logger.info(f"Creating PDBQT for fixed receptor {protonatedOutputPath} to {outputPath}")
-        pythonsh = subprocess.run([self.config["pythonshpath"],
+        pythonsh = self.runTool("mgltools", [self.config["pythonshpath"],
                                    self.config["preparereceptorpath"],
                                    "-r",
                                    protonatedOutputPath,
                                    "-A", "bonds"
                                    "-U", "nphs",
-                                   "-o", outputPath],
-                                   text=True, capture_output=True)
+                                   "-o", outputPath])
         if pythonsh.returncode != 0:
             self.logger.error(pythonsh.stderr)
             raise DockingPrepperException(pythonsh.stderr)
         log += pythonsh.stdout
         log += pythonsh.stderr
         self.logger.info("MGLTools output:\n" + pythonsh.stdout + pythonsh.stderr)
-        self.logger.info("Removing: " + protonatedOutputPath)
-        os.remove(protonatedOutputPath)
         return outputPath
 
     def prepareConfig(self, fullPath: str):
         self.logger.info(f"Creating config file for {fullPath}")
-        xmin = 1000000000000
-        ymin = 1000000000000
-        zmin = 1000000000000
-        xmax = -1000000000000
-        ymax = -1000000000000
-        zmax = -1000000000000
-
-        with open(fullPath, "r") as file:
-            for line in file.readlines():
-                if line[0:4] == "ATOM":
-                    x = float(line[31:39])
-                    y = float(line[39:46])
-                    z = float(line[46:55])
-                    xmin, xmax = min(xmin, x), max(xmax, x)
-                    ymin, ymax = min(ymin, y), max(ymax, y)
-                    zmin, zmax = min(zmin, z), max(zmax, z)
+        with Structure(fullPath) as structure:
+            atoms = structure.records(b"ATOM")
+            if not atoms.any():
+                raise DockingPrepperException(f"File {fullPath} contains no ATOM records")
+            coordinates = structure.coordinates(atoms)
+        xmin, ymin, zmin = coordinates.min(axis=0)
+        xmax, ymax, zmax = coordinates.max(axis=0)
 
         sizex = xmax - xmin
         sizey = ymax - ymin
@@ -162,12 +221,76 @@ class DockingPrepper():
         offsety = ymin + sizey / 2.0
         offsetz = zmin + sizez / 2.0
 
-        with open(fullPath + "_conf", "w") as file:
-            file.write("center_x = %f\n" % offsetx)
-            file.write("center_y = %f\n" % offsety)
-            file.write("center_z = %f\n\n" % offsetz)
-            file.write("size_x = %f\n" % (sizex + 30))
-            file.write("size_y = %f\n" % (sizey + 30))
-            file.write("size_z = %f\n" % (sizez + 30))
+        self.writeConfig(fullPath + "_conf", (offsetx, offsety, offsetz), (sizex + 30, sizey + 30, sizez + 30))
+        return fullPath + "_conf"
 
-        return fullPath + "_conf"
\ No newline at end of file
+    def preparePocketConfigs(self, fullPath: str):
+        """ Writes a tight box around each of the largest pockets of the
+            receptor to `<fullPath>_conf_pocket<n>`, best pocket first.
+        """
+        settings = self.config.get("pockets", {})
+        if settings.get("count", 0) <= 0:
+            return []
+        self.logger.info(f"Detecting pockets of {fullPath}")
+        with Structure(fullPath) as structure:
+            coordinates = structure.coordinates(structure.records(b"ATOM"))
+        boxes = findPockets(coordinates, settings["count"],
+                            spacing=settings.get("spacing", 1.0),
+                            minBuriedness=settings.get("min_buriedness", 5),
+                            minVolume=settings.get("min_volume", 50.0),
+                            padding=settings.get("padding", 4.0))
+        self.logger.info(f"Found {len(boxes)} pockets in {fullPath}")
+        paths = []
+        for number, (center, size) in enumerate(boxes, start=1):
+            paths.append(f"{fullPath}_conf_pocket{number}")
+            self.writeConfig(paths[-1], center, size)
+        return paths
+
+    def writeConfig(self, path: str, center, size):
+        with open(path, "w") as file:
+            file.write("center_x = %f\n" % center[0])
+            file.write("center_y = %f\n" % center[1])
+            file.write("center_z = %f\n\n" % center[2])
+            file.write("size_x = %f\n" % size[0])
+            file.write("size_y = %f\n" % size[1])
+            file.write("size_z = %f\n" % size[2])
+
+    def prepareMaps(self, fullPath: str, configPaths, keys=None):
+        """ Computes the Vina grid maps of the receptor for every box in
+            `configPaths` once, into `<config>.maps/receptor.*.map`, so they
+            are not recomputed for every ligand. Maps that are still current
+            are kept; `keys` are their mapsKeys when already known. Failures
+            are only logged, DockingService then computes the maps itself.
+            Returns the mapsKeys.
+        """
+        if keys is None:
+            keys = [mapsKey(fullPath, configPath) for configPath in configPaths]
+        for configPath, key in zip(configPaths, keys):
+            mapsDir = configPath + ".maps"
+            try:
+                with open(os.path.join(mapsDir, "key"), "r") as file:
+                    if file.read() == key:
+                        continue
+            except OSError:
+                pass
+            self.logger.info(f"Writing grid maps of {fullPath} for {configPath}")
+            staging = tempfile.mkdtemp(prefix="." + os.path.basename(mapsDir) + "_", dir=os.path.dirname(mapsDir))
+            try:
+                vina = self.runTool("maps", [self.config["maps"]["vinapath"],
+                                      "--receptor", fullPath,
+                                      "--config", configPath,
+                                      "--write_maps", os.path.join(staging, "receptor")])
+                if vina.returncode != 0:
+                    self.logger.warning(f"Could not write grid maps for {configPath}:\n{vina.stderr}")
+                    continue
+                with open(os.path.join(staging, "key"), "w") as file:
+                    file.write(key)
+                shutil.rmtree(mapsDir, ignore_errors=True)
+                os.rename(staging, mapsDir)
+            except DockingPrepperException:
+                self.logger.warning(f"Could not write grid maps for {configPath}")
+            except OSError as e:
+                self.logger.warning(f"Could not store grid maps for {configPath}: {e}")
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+        return keys
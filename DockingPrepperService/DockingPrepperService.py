@@ -1,31 +1,34 @@
-from kombu import Connection, Exchange, Queue, Producer
-from kombu.mixins import ConsumerProducerMixin
+import os
+from kombu import Exchange, Queue
 import json
-from time import sleep
-from random import uniform
-from DockingPrepper import DockingPrepper, DockingPrepperException
+from time import time
+from DockingPrepper import DockingPrepper, DockingPrepperException, PIPELINE_VERSION
+from ReceptorCache import ReceptorCache
+from PDBFixerPool import PDBFixerPool
+from PDB2PQRPool import PDB2PQRPool
+from queue import SimpleQueue, Empty
+from Lanes import Lane
+from WorkerRuntime import linkFile, mapsKey, enqueuedAt, Cancellations, cancellationQueue, METRICS, Accounting, ServiceWorker, setup_mq, HEARTBEAT
 import shutil
-import os
-import logging
+import tempfile
 import yaml
 import argparse
 
-def initialize_logging(mod_name):
-    logger = logging.getLogger(mod_name)
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        '%(asctime)s [%(name)-12s] %(levelname)-8s %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
-    return logger
-
-def createResultMessage(id: str, fullPath: str, fullConfigPath: str):
+# Internal queue receptors are moved to when ligands and receptors run in separate lanes
+RECEPTOR_QUEUE = "DockingPrepTask.Receptor"
+
+def jobOf(body) -> str:
+    """ The id a cancellation of this prep task names. """
+    return body.get("submissionId", body["id"])
+
+def createResultMessage(id: str, fullPath: str, fullConfigPath: str, pocketConfigPaths: list = None, resources: dict = None):
     message = {
        "message": {
             "id": id,
             "path": fullPath,
-            "configPath": fullConfigPath
+            "configPath": fullConfigPath,
+            "pocketConfigPaths": pocketConfigPaths,
+            "resources": resources
         },
         "messageType": [
             "urn:message:AsyncAPI.Models:DockingPrepResult"
@@ -33,96 +36,259 @@ def createResultMessage(id: str, fullPath: str, fullConfigPath: str):
     }
     return message
 
-class Worker(ConsumerProducerMixin):
+class Worker(ServiceWorker):
+    blocking = True
+
     def __init__(self, connection, queues, config):
-        self.connection = connection
-        self.queues = queues
-        self.logger = initialize_logging("DockingPrepperService")
-        self.config = config
+        super().__init__(connection, queues, config, "DockingPrepperService")
+        self.cache = None
+        if config.get("cache", {}).get("path"):
+            version = f"{PIPELINE_VERSION}.{config['cache'].get('revision', 0)}"
+            self.cache = ReceptorCache(config["cache"]["path"], config["cache"]["max_entries"], version)
+        # the warm pools only serve receptors, so they run at the receptor lane's priority
+        niceness = config["lanes"]["receptor"].get("nice", 0) if config.get("lanes", {}).get("enabled") else 0
+        self.fixerPool = None
+        if config.get("pdbfixerworkers", 0) > 0:
+            self.fixerPool = PDBFixerPool(config, config["pdbfixerworkers"], niceness)
+        self.pqrPool = None
+        if config.get("pdb2pqrworkers", 0) > 0:
+            self.pqrPool = PDB2PQRPool(config["pdb2pqrworkers"], niceness, config.get("timeouts", {}).get("pdb2pqr"))
+        self.cancellations = Cancellations(config.get("cancellation", {}).get("ttl", 86400))
+        self.cancellationQueue = cancellationQueue()
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=1)]
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=1),
+                Consumer(queues=[self.cancellationQueue], callbacks=[self.on_cancel], no_ack=True)]
 
-    def on_message(self, body, message):
-        self.logger.info(f"Received message {body}")
-        prepper = DockingPrepper(self.config)
+    def on_cancel(self, body, message):
+        """ Queued prep tasks of a cancelled submission are dropped and its
+            running tools killed, without publishing results.
+        """
+        self.logger.info(f"Submission {body['submissionId']} was cancelled")
+        self.cancellations.cancel(body["submissionId"])
+
+    def cancelled(self, body) -> bool:
+        return self.cancellations.isCancelled(jobOf(body))
+
+    def on_consume_end(self, connection, channel):
+        if self.fixerPool is not None:
+            self.fixerPool.close()
+        if self.pqrPool is not None:
+            self.pqrPool.close()
+        super().on_consume_end(connection, channel)
+
+    def lookup(self, body):
+        """ Returns the cache key of the receptor and, if the prepared receptor
+            was placed next to the input from the cache, its pocket configs.
+        """
+        try:
+            key = self.cache.key(body["path"])
+        except OSError as e:
+            self.logger.warning(f"Could not hash receptor: {e}")
+            return None, None
+        return key, self.cache.get(key, body["path"] + "qt")
+
+    def prepare(self, body, niceness=0):
+        """ Runs one prep job in its own scratch directory and returns the
+            result message. Safe to run from several threads at once.
+        """
+        if self.cancelled(body):
+            return createResultMessage(body["id"], None, None)
+        accounting = Accounting(self.logger, jobOf(body))
+        result = None
+        key = None
+        mapsKeys = None
+        if body["type"] == 0 and self.cache is not None:
+            key, pocketPaths = self.lookup(body)
+            if pocketPaths is not None:
+                self.logger.info(f"Using cached receptor for message {body}")
+                result = createResultMessage(body["id"], body["path"] + "qt", body["path"] + "qt_conf", pocketPaths)
+                mapsKeys = self.cache.mapsKeys(key)
+        if result is None:
+            jobDir = tempfile.mkdtemp(prefix=body["id"] + "_", dir=self.config.get("scratchpath"))
+            try:
+                with METRICS.inFlight("receptor" if body["type"] == 0 else "ligand"):
+                    result = self.runJob(body, jobDir, key, niceness, accounting)
+            finally:
+                shutil.rmtree(jobDir, ignore_errors=True)
+        if body["type"] == 0 and result["message"]["path"] is not None and self.config.get("maps", {}).get("enabled"):
+            configPaths = [result["message"]["configPath"]] + result["message"]["pocketConfigPaths"]
+            prepper = DockingPrepper(self.config, niceness=niceness, cancellations=self.cancellations, job=jobOf(body),
+                                     accounting=accounting)
+            # the Vina run writing the maps is timed by runTool as the "maps" stage
+            prepper.prepareMaps(result["message"]["path"], configPaths, mapsKeys)
+        result["message"]["resources"] = accounting.summary()
+        return result
+
+    def runJob(self, body, jobDir, key, niceness, accounting=None):
+        prepper = DockingPrepper(self.config, self.fixerPool, self.pqrPool, niceness, self.cancellations, jobOf(body),
+                                 accounting)
         receptor = body["type"] == 0
-        os.makedirs("./" + body["id"], exist_ok=True)
-        os.chdir("./" + body["id"])
+        inputFile = os.path.join(jobDir, os.path.basename(body["path"]))
         try:
-            copiedFile = shutil.copy(body["path"], "./")
+            linkFile(body["path"], inputFile)
         except IOError as e:
             self.logger.error(f"Failed to copy file: {e}")
-            message.reject(requeue=False)
-            result = createResultMessage(body["id"], None, None)
-            self.producer.publish(
-                json.dumps(result), exchange="AsyncAPI.Models:DockingPrepResult", retry=True
-            )
-            os.chdir("../")
-            shutil.rmtree(body["id"])
-            return
-        self.logger.debug(f"Copied '{body['path']}' to '{copiedFile}'")
+            return createResultMessage(body["id"], None, None)
+        self.logger.debug(f"Linked '{body['path']}' to '{inputFile}'")
         try:
             if receptor:
-                resultPath = prepper.preparePDBQTReceptor(copiedFile)
+                resultPath = prepper.preparePDBQTReceptor(inputFile, jobDir)
             else:
-                resultPath = prepper.preparePDBQTLigand(copiedFile)
+                resultPath = prepper.preparePDBQTLigand(inputFile)
         except DockingPrepperException:
-            message.reject(requeue=False)
-            self.logger.info(f"Removing file {copiedFile}")
-            os.remove(copiedFile)
-            result = createResultMessage(body["id"], None, None)
-            self.producer.publish(
-                json.dumps(result), exchange="AsyncAPI.Models:DockingPrepResult", retry=True
-            )
-            os.chdir("../")
-            shutil.rmtree(body["id"])
-            return
+            return createResultMessage(body["id"], None, None)
         try:
             self.logger.debug(f"Trying to move result from '{resultPath}' to '{body['path'] + 'qt'}'")
             movedResultFile = shutil.move(resultPath, body["path"] + "qt")
         except Exception as e:
             self.logger.error(f"Failed to move result: {e}")
-            message.reject(requeue=False)
-            result = createResultMessage(body["id"], None, None)
-            self.producer.publish(
-                json.dumps(result), exchange="AsyncAPI.Models:DockingPrepResult", retry=True
-            )
-            os.chdir("../")
-            shutil.rmtree(body["id"])
-            return
+            return createResultMessage(body["id"], None, None)
         self.logger.debug(f"Moved result from '{resultPath}' to '{body['path'] + 'qt'}'")
-        os.remove(copiedFile)
-        self.logger.debug(f"Removed {copiedFile}")
         configPath = None
+        pocketPaths = None
         if (receptor):
             try:
-                configPath = prepper.prepareConfig(movedResultFile)
+                with METRICS.stage("config"):
+                    configPath = prepper.prepareConfig(movedResultFile)
+                with METRICS.stage("pockets"):
+                    pocketPaths = prepper.preparePocketConfigs(movedResultFile)
             except Exception:
-                result = createResultMessage(body["id"], None, None)
-                message.reject(requeue=False)
-                self.producer.publish(
-                    json.dumps(result), exchange="AsyncAPI.Models:DockingPrepResult", retry=True
-                )
-                return
-        result = createResultMessage(body["id"], movedResultFile, configPath)
+                return createResultMessage(body["id"], None, None)
+            if key is not None:
+                mapsKeys = None
+                if self.config.get("maps", {}).get("enabled"):
+                    # prepareMaps reuses these hashes, the files do not change in between
+                    mapsKeys = [mapsKey(movedResultFile, path) for path in [configPath] + pocketPaths]
+                self.cache.put(key, movedResultFile, configPath, pocketPaths, mapsKeys)
+        return createResultMessage(body["id"], movedResultFile, configPath, pocketPaths)
+
+    def submit(self, body, callback, queuedAt=None):
+        with self.busy():
+            result = self.prepare(body)
+        callback(result)
+
+    def finish(self, message, body, result):
+        if self.cancelled(body):
+            self.logger.info(f"Dropping message {body} of a cancelled submission")
+            METRICS.inc("worker_messages_total", outcome="cancelled")
+            self.ack(message)
+            return
         self.logger.info(f"Publishing result for message {body}")
-        self.producer.publish(
-            json.dumps(result), exchange="AsyncAPI.Models:DockingPrepResult", retry=True
-        )
-        os.chdir("../")
-        shutil.rmtree(body["id"])
-        message.ack()
+        self.publish(json.dumps(result), "AsyncAPI.Models:DockingPrepResult")
+        if result["message"]["path"] is not None:
+            METRICS.inc("worker_messages_total", outcome="ok")
+            self.ack(message)
+        else:
+            METRICS.inc("worker_messages_total", outcome="failed")
+            self.reject(message)
+
+    def on_message(self, body, message):
+        self.logger.info(f"Received message {body}")
+        self.received(message)
+        self.submit(body, lambda result: self.finish(message, body, result))
 
-def setup_mq(host):
-    connection = Connection(host, heartbeat=0)
-    channel = connection.channel()
-    exchange = Exchange("AsyncAPI.Models:DockingPrepResult", "fanout", channel=channel)
-    exchange.declare()
+class PooledWorker(Worker):
+    """ Prepares up to `worker.slots` structures at the same time on a thread
+        pool (the heavy lifting happens in subprocesses and the warm pools).
+        Results are published and messages acked back on the consumer thread,
+        since kombu channels must not be shared across threads.
+    """
+    blocking = False
 
-    Queue("DockingPrepResult", exchange=exchange, channel=channel).declare()
+    def __init__(self, connection, queues, config):
+        super().__init__(connection, queues, config)
+        self.lanes = self.createLanes()
+        self.completed = SimpleQueue()
+        for lane in self.lanes.values():
+            self.logger.info(f"Running {lane.slots} slots in lane {lane.name}")
+
+    def createLanes(self):
+        return {"prep": Lane("prep", self.config["worker"]["slots"])}
+
+    def laneFor(self, body):
+        return self.lanes["prep"]
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=self.lanes["prep"].slots),
+                Consumer(queues=[self.cancellationQueue], callbacks=[self.on_cancel], no_ack=True)]
+
+    def submit(self, body, callback, queuedAt=None):
+        lane = self.laneFor(body)
+        future = lane.submit(self.prepare, queuedAt or time(), body, lane.niceness)
+        future.add_done_callback(lambda f: self.completed.put((callback, body, f)))
+
+    def on_iteration(self):
+        while True:
+            try:
+                callback, body, future = self.completed.get_nowait()
+            except Empty:
+                break
+            try:
+                result = future.result()
+            except Exception as e:
+                self.logger.error(f"Prep job crashed: {e}")
+                result = createResultMessage(body["id"], None, None)
+            callback(result)
+        super().on_iteration()
+
+    def on_consume_end(self, connection, channel):
+        for lane in self.lanes.values():
+            lane.shutdown()
+        super().on_consume_end(connection, channel)
+
+class LaneWorker(PooledWorker):
+    """ Prepares ligands and receptors in separate lanes, each with its own
+        concurrency limit and niceness. Receptors are moved off the shared
+        DockingPrepTask queue onto their own queue, which is consumed with the
+        receptor lane's prefetch, so a backlog of receptors never delays
+        ligands. Queue wait per lane is logged every `lanes.report_interval`
+        seconds.
+    """
+    def __init__(self, connection, queues, config):
+        super().__init__(connection, queues, config)
+        self.receptorQueue = Queue(RECEPTOR_QUEUE)
+        self.lastReport = time()
+
+    def createLanes(self):
+        lanes = self.config["lanes"]
+        return {"ligand": Lane("ligand", lanes["ligand"]["slots"], lanes["ligand"].get("nice", 0)),
+                "receptor": Lane("receptor", lanes["receptor"]["slots"], lanes["receptor"].get("nice", 0))}
+
+    def laneFor(self, body):
+        return self.lanes["receptor" if body["type"] == 0 else "ligand"]
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=2 * self.lanes["ligand"].slots),
+                self.isolatedConsumer(channel, queues=[self.receptorQueue], callbacks=[self.on_receptor_message],
+                                      prefetch_count=self.lanes["receptor"].slots),
+                Consumer(queues=[self.cancellationQueue], callbacks=[self.on_cancel], no_ack=True)]
+
+    def on_message(self, body, message):
+        if body["type"] != 0:
+            self.logger.info(f"Received message {body}")
+            self.received(message)
+            self.submit(body, lambda result: self.finish(message, body, result), enqueuedAt(message))
+            return
+        self.logger.debug(f"Moving receptor {body['id']} to the receptor lane")
+        # its queue wait is recorded once it arrives in the receptor lane
+        self.outbox.track(message)
+        self.publish(body, "", routing_key=RECEPTOR_QUEUE, declare=[self.receptorQueue],
+                     headers={"x-enqueued-at": enqueuedAt(message)})
+        self.ack(message)
+
+    def on_receptor_message(self, body, message):
+        self.logger.info(f"Received message {body}")
+        # the wait counts from when the task entered the shared queue
+        self.received(message)
+        self.submit(body, lambda result: self.finish(message, body, result), enqueuedAt(message))
 
-    return connection, channel, exchange
+    def on_iteration(self):
+        super().on_iteration()
+        if time() - self.lastReport >= self.config["lanes"].get("report_interval", 60):
+            self.lastReport = time()
+            for lane in self.lanes.values():
+                self.logger.info(lane.report())
 
 
 if __name__ == "__main__":
@@ -141,10 +307,16 @@ if __name__ == "__main__":
         with open("config.yml", 'r') as f:
             config = yaml.safe_load(f)
 
-    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"])
-    
-    worker = Worker(connection,
+    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"], "DockingPrepResult",
+                                             config.get("messaging", {}).get("heartbeat", HEARTBEAT))
+
+    if config.get("metrics", {}).get("port"):
+        METRICS.serve(config["metrics"]["port"])
+
+    laned = config.get("lanes", {}).get("enabled", False)
+    pooled = laned or config.get("worker", {}).get("slots", 1) > 1
+    worker = (LaneWorker if laned else PooledWorker if pooled else Worker)(connection,
                     [Queue("DockingPrepTask",
                      exchange=Exchange("AsyncAPI.Models:DockingPrepTask", "fanout"))],
                     config)
-    worker.run()
+    worker.run(safety_interval=0.1 if pooled else 1)
@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import threading
+
+class Lane():
+    """ A pool with its own concurrency limit and CPU priority for one kind of
+        prep job. Records how long jobs waited between being queued and
+        starting, so the limits can be tuned.
+    """
+    def __init__(self, name: str, slots: int, niceness: int = 0):
+        self.name = name
+        self.slots = slots
+        self.niceness = niceness
+        self.pool = ThreadPoolExecutor(max_workers=slots, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.resetStats()
+
+    def resetStats(self):
+        self.started = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def submit(self, fn, queuedAt: float, *args):
+        with self.lock:
+            self.queued += 1
+        return self.pool.submit(self.run, fn, queuedAt, *args)
+
+    def run(self, fn, queuedAt, *args):
+        wait = max(0.0, time() - queuedAt)
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.started += 1
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def report(self) -> str:
+        """ Summary of the lane since the last report. """
+        with self.lock:
+            meanWait = self.totalWait / self.started if self.started else 0.0
+            summary = (f"Lane {self.name}: {self.running}/{self.slots} running, {self.queued} queued, "
+                       f"{self.started} started, mean wait {meanWait:.1f}s, max wait {self.maxWait:.1f}s")
+            self.resetStats()
+        return summary
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
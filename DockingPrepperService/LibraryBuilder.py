@@ -0,0 +1,196 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.util import Finalize
+from datetime import datetime, timezone
+from time import time
+import hashlib
+import json
+import glob
+import shutil
+import tempfile
+import logging
+import yaml
+import argparse
+from DockingPrepper import DockingPrepper, DockingPrepperException, PIPELINE_VERSION
+from ReceptorCache import ReceptorCache
+from PDBFixerPool import PDBFixerPool
+from PDB2PQRPool import PDB2PQRPool
+from FASTAGenerator import FASTAGenerator
+from WorkerRuntime import METRICS, Accounting, initialize_logging, linkFile
+
+def fileHash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest():
+    """ What a library build prepared, one JSON line per input appended as
+        soon as it finished, so an interrupted build resumes where it
+        stopped. Each line holds the input's hash, size and modification
+        time, the receptor, config and pocket config files written for it,
+        the mapsKeys of its grid maps, its FASTA, the time and resources it
+        took and, for failures, the error. The last line of an input counts.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the line being written when the build was killed
+                        continue
+                    self.entries[entry["input"]] = entry
+
+    def prepared(self, name: str, fullPath: str) -> bool:
+        """ Whether the input is unchanged since it was prepared by the
+            current pipeline and all of its outputs are still there.
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry["status"] != "ok" or entry["version"] != PIPELINE_VERSION:
+            return False
+        stat = os.stat(fullPath)
+        if (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime_ns):
+            return False
+        return all(os.path.exists(path) for path in [entry["receptor"], entry["config"]] + entry["pockets"])
+
+    def failed(self, name: str) -> bool:
+        entry = self.entries.get(name)
+        return entry is not None and entry["status"] == "failed"
+
+    def add(self, entry: dict):
+        with open(self.path, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.entries[entry["input"]] = entry
+
+# The warm tool pools and FASTA generator of a builder process, see startProcess
+POOLS = None
+GENERATOR = None
+
+def startProcess(config):
+    """ Sets up a builder process with a warm PDBFixer and PDB2PQR of its
+        own when the config enables the warm pools.
+    """
+    global POOLS, GENERATOR
+    fixerPool = None
+    if config.get("pdbfixerworkers", 0) > 0:
+        fixerPool = PDBFixerPool(config, 1)
+        Finalize(None, fixerPool.close, exitpriority=10)
+    pqrPool = None
+    if config.get("pdb2pqrworkers", 0) > 0:
+        pqrPool = PDB2PQRPool(1, timeout=config.get("timeouts", {}).get("pdb2pqr"))
+        Finalize(None, pqrPool.close, exitpriority=10)
+    POOLS = (fixerPool, pqrPool)
+    GENERATOR = FASTAGenerator(config)
+
+def buildReceptor(config, name: str, fullPath: str, outputDir: str) -> dict:
+    """ Prepares one receptor the way a DockingPrepTask does, writing
+        `<name>qt`, its config and pocket configs (and grid maps, when
+        enabled) to `outputDir`, `name` being the input's path relative to
+        the input directory. Returns its manifest entry.
+    """
+    logger = logging.getLogger("DockingPrepperService.LibraryBuilder")
+    accounting = Accounting(logger, name)
+    prepper = DockingPrepper(config, *POOLS, accounting=accounting)
+    stat = os.stat(fullPath)
+    entry = {"input": name, "sha256": fileHash(fullPath), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+             "version": PIPELINE_VERSION, "status": "failed", "error": None,
+             "receptor": None, "config": None, "pockets": [], "maps": None, "fasta": "", "chains": {}}
+    start = time()
+    jobDir = tempfile.mkdtemp(prefix=os.path.basename(name) + "_", dir=config.get("scratchpath"))
+    try:
+        inputFile = os.path.join(jobDir, os.path.basename(fullPath))
+        linkFile(fullPath, inputFile)
+        # mirrors the input tree, inputs of the same name in different directories stay apart
+        outputPath = os.path.join(outputDir, name + "qt")
+        os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+        shutil.move(prepper.preparePDBQTReceptor(inputFile, jobDir), outputPath)
+        with METRICS.stage("config"):
+            configPath = prepper.prepareConfig(outputPath)
+        with METRICS.stage("pockets"):
+            pocketPaths = prepper.preparePocketConfigs(outputPath)
+        if config.get("maps", {}).get("enabled"):
+            entry["maps"] = prepper.prepareMaps(outputPath, [configPath] + pocketPaths)
+        fasta, chains = GENERATOR.getFASTAChains(fullPath)
+        entry.update(status="ok", receptor=outputPath, config=configPath, pockets=pocketPaths, fasta=fasta, chains=chains)
+    except DockingPrepperException as e:
+        entry["error"] = str(e.error)
+    except Exception as e:
+        entry["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        shutil.rmtree(jobDir, ignore_errors=True)
+    entry["seconds"] = time() - start
+    entry["resources"] = accounting.summary()
+    entry["finished"] = datetime.now(timezone.utc).isoformat()
+    return entry
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="LibraryBuilder",
+        description="Prepares a directory of receptor PDB files for docking in parallel, resuming interrupted builds"
+    )
+    parser.add_argument("input", help="Directory with the receptor PDB files")
+    parser.add_argument("--output", help="Directory the prepared receptors are written to, the input directory by default")
+    parser.add_argument("--manifest", help="Manifest of the build, manifest.jsonl in the output directory by default")
+    parser.add_argument("--pattern", default="*.pdb", help="Files in the input directory to prepare")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Receptors prepared at the same time")
+    parser.add_argument("--skip-failed", action="store_true", help="Do not retry inputs that failed in an earlier run")
+    parser.add_argument("--dev", action="store_true", help="Use config_dev.yml")
+    parser.add_argument("--config", help="Config file to use instead of config.yml")
+    args = parser.parse_args()
+
+    config = None
+    configPath = args.config or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              "config_dev.yml" if args.dev else "config.yml")
+    with open(configPath, 'r') as f:
+        config = yaml.safe_load(f)
+
+    logger = initialize_logging("LibraryBuilder")
+    outputDir = os.path.abspath(args.output or args.input)
+    os.makedirs(outputDir, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(outputDir, "manifest.jsonl"))
+    # prepared receptors also go to the service's cache, so uploading them later costs nothing
+    cache = None
+    if config.get("cache", {}).get("path"):
+        cache = ReceptorCache(config["cache"]["path"], config["cache"]["max_entries"],
+                              f"{PIPELINE_VERSION}.{config['cache'].get('revision', 0)}")
+
+    inputs = sorted(glob.glob(os.path.join(glob.escape(args.input), args.pattern)))
+    pending = []
+    for fullPath in inputs:
+        name = os.path.relpath(fullPath, args.input)
+        if manifest.prepared(name, fullPath) or (args.skip_failed and manifest.failed(name)):
+            continue
+        pending.append((name, os.path.abspath(fullPath)))
+    logger.info(f"Preparing {len(pending)} of {len(inputs)} receptors with {args.workers} workers, "
+                f"{len(inputs) - len(pending)} are done already")
+
+    start = time()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=startProcess, initargs=(config,)) as pool:
+        futures = [pool.submit(buildReceptor, config, name, fullPath, outputDir) for name, fullPath in pending]
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                entry = future.result()
+                manifest.add(entry)
+                if entry["status"] == "ok" and cache is not None:
+                    cache.put(cache.key(os.path.join(args.input, entry["input"])), entry["receptor"], entry["config"],
+                              entry["pockets"], entry.get("maps"))
+                if entry["status"] != "ok":
+                    failed += 1
+                    logger.warning(f"Could not prepare {entry['input']}: {entry['error']}")
+                elapsed = time() - start
+                logger.info(f"[{done}/{len(pending)}] {entry['input']} {entry['status']} in {entry['seconds']:.1f} s, "
+                            f"{(len(pending) - done) * elapsed / done / 60:.0f} min left")
+        except KeyboardInterrupt:
+            logger.info("Stopping, the next run continues from the manifest")
+            pool.shutdown(wait=True, cancel_futures=True)
+            sys.exit(1)
+    logger.info(f"Prepared {len(pending) - failed} receptors in {time() - start:.0f} s, {failed} failed")
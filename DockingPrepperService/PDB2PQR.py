@@ -0,0 +1,34 @@
+import os
+import sys
+import json
+from pdb2pqr.main import build_main_parser, main_driver
+
+def protonate(args):
+    main_driver(build_main_parser().parse_args(args))
+
+def serve():
+    """ Keeps pdb2pqr and propka loaded and answers protonation requests,
+        one JSON object per line on stdin ({"args": [...]}, the pdb2pqr
+        command line) with one JSON object per line on stdout ({"ok": ...}).
+        Anything else written to stdout goes to stderr so it cannot break
+        the protocol.
+    """
+    responses = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            protonate(request["args"])
+            response = {"ok": True}
+        except (Exception, SystemExit) as e:
+            # argparse exits on arguments pdb2pqr does not accept
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--serve":
+        serve()
+    else:
+        protonate(sys.argv[1:])
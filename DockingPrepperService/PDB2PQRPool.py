@@ -0,0 +1,27 @@
+import os
+import sys
+from DockingPrepper import DockingPrepperException, PDB2PQR_OPTIONS
+from WorkerRuntime import WarmPool, ProcessError
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PDB2PQR.py")
+
+class PDB2PQRPool(WarmPool):
+    """ Runs PDB2PQR in long-lived `PDB2PQR.py --serve` processes, so pdb2pqr
+        and propka are imported once instead of for every receptor. A process
+        that crashed, took longer than `timeout` seconds or was killed because
+        its job was cancelled is restarted.
+    """
+    def __init__(self, size: int, niceness=0, timeout=None):
+        command = [sys.executable, SERVER, "--serve"]
+        if niceness > 0:
+            command = ["nice", "-n", str(niceness)] + command
+        super().__init__(command, size, timeout, "PDB2PQR")
+
+    def protonate(self, inputPath: str, outputPath: str, job=None, cancellations=None):
+        args = PDB2PQR_OPTIONS + [os.path.abspath(inputPath), os.path.abspath(outputPath)]
+        try:
+            response = self.request({"args": args}, job, cancellations)
+        except ProcessError as e:
+            raise DockingPrepperException(f"{e.error} while protonating {inputPath}")
+        if not response["ok"]:
+            raise DockingPrepperException(response["error"])
@@ -1,28 +1,65 @@
+import io
+import os
 import sys
 import json
 from pdbfixer import PDBFixer
 from simtk.openmm.app import PDBFile
 
-file = sys.argv[1]
-outfile = sys.argv[2]
+def fixStructure(file, outfile):
+    with open(file, 'r') as pdbfile, open(outfile, 'w') as out:
+        fixStream(pdbfile, out)
 
-fixer = PDBFixer(filename=file)
-# delete all but the first chain
-chains = list(fixer.topology.chains())
-if len(chains) > 1:
-    fixer.removeChains([i for i in range(1,len(chains))])
-# Find missing residues
-fixer.findMissingResidues()
-# begin: Only insert missing residues in the middle
-keys = list(fixer.missingResidues.keys())
-for key in keys:
-    chain = chains[key[0]]
-    if key[1] == 0 or key[1] == len(list(chain.residues())):
-        del fixer.missingResidues[key]
-# end
-fixer.findNonstandardResidues()
-fixer.replaceNonstandardResidues()
-fixer.removeHeterogens(False)
-fixer.findMissingAtoms()
-fixer.addMissingAtoms()
-PDBFile.writeFile(fixer.topology, fixer.positions, open(outfile, 'w'), keepIds=True)
\ No newline at end of file
+def fixStream(pdbfile, out):
+    fixer = PDBFixer(pdbfile=pdbfile)
+    # delete all but the first chain
+    chains = list(fixer.topology.chains())
+    if len(chains) > 1:
+        fixer.removeChains([i for i in range(1,len(chains))])
+    # Find missing residues
+    fixer.findMissingResidues()
+    # begin: Only insert missing residues in the middle
+    keys = list(fixer.missingResidues.keys())
+    for key in keys:
+        chain = chains[key[0]]
+        if key[1] == 0 or key[1] == len(list(chain.residues())):
+            del fixer.missingResidues[key]
+    # end
+    fixer.findNonstandardResidues()
+    fixer.replaceNonstandardResidues()
+    fixer.removeHeterogens(False)
+    fixer.findMissingAtoms()
+    fixer.addMissingAtoms()
+    PDBFile.writeFile(fixer.topology, fixer.positions, out, keepIds=True)
+
+def serve():
+    """ Keeps PDBFixer and OpenMM loaded and answers fix requests, one JSON
+        object per line on stdin with one JSON object per line on stdout.
+        Requests either name files ({"input": ..., "output": ...}) or carry
+        the structure itself ({"pdb": ...}), in which case the fixed
+        structure is returned in the response ({"ok": ..., "pdb": ...}).
+        Anything else written to stdout while fixing, by Python or by the
+        native OpenMM code, goes to stderr so it cannot break the protocol.
+    """
+    responses = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            if "pdb" in request:
+                out = io.StringIO()
+                fixStream(io.StringIO(request["pdb"]), out)
+                response = {"ok": True, "pdb": out.getvalue()}
+            else:
+                fixStructure(request["input"], request["output"])
+                response = {"ok": True}
+        except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--serve":
+        serve()
+    else:
+        fixStructure(sys.argv[1], sys.argv[2])
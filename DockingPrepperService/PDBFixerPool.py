@@ -0,0 +1,32 @@
+import os
+from DockingPrepper import DockingPrepperException
+from WorkerRuntime import WarmPool, ProcessError
+
+class PDBFixerPool(WarmPool):
+    """ A fixed number of long-lived `PDBFix.py --serve` processes with
+        PDBFixer and OpenMM already imported, shared by all prep jobs. A
+        process that crashed, timed out or was killed because its job was
+        cancelled is restarted.
+    """
+    def __init__(self, config, size: int, niceness=0):
+        command = [config["condapath"], config["pdbfixerpath"], "--serve"]
+        if niceness > 0:
+            command = ["nice", "-n", str(niceness)] + command
+        super().__init__(command, size, config.get("timeouts", {}).get("pdbfixer"), "PDBFixer")
+
+    def request(self, request: dict, job=None, cancellations=None) -> dict:
+        try:
+            response = super().request(request, job, cancellations)
+        except ProcessError as e:
+            raise DockingPrepperException(e.error)
+        if not response["ok"]:
+            raise DockingPrepperException(response["error"])
+        return response
+
+    def fix(self, inputPath: str, outputPath: str, job=None, cancellations=None):
+        # the server runs in the directory the service started in, not the job's
+        self.request({"input": os.path.abspath(inputPath), "output": os.path.abspath(outputPath)}, job, cancellations)
+
+    def fixText(self, pdb: str, job=None, cancellations=None) -> str:
+        """ Fixes a structure passed in memory and returns the fixed structure. """
+        return self.request({"pdb": pdb}, job, cancellations)["pdb"]
@@ -0,0 +1,89 @@
+import numpy as np
+
+# Scan lines of the LIGSITE buriedness test: the three axes and four body diagonals
+DIRECTIONS = np.array([(1, 0, 0), (0, 1, 0), (0, 0, 1),
+                       (1, 1, 1), (1, 1, -1), (1, -1, 1), (-1, 1, 1)])
+
+# Face neighbours used to connect pocket voxels into clusters
+NEIGHBOURS = np.array([(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)])
+
+def shifted(grid: np.ndarray, offset, fill=0) -> np.ndarray:
+    """ `grid` moved by `offset` voxels, out[i] = grid[i - offset]. """
+    out = np.full_like(grid, fill)
+    source = tuple(slice(0, max(n - o, 0)) if o > 0 else slice(min(-o, n), n) for o, n in zip(offset, grid.shape))
+    target = tuple(slice(min(o, n), n) if o > 0 else slice(0, max(n + o, 0)) for o, n in zip(offset, grid.shape))
+    out[target] = grid[source]
+    return out
+
+def seenAlong(occupied: np.ndarray, direction) -> np.ndarray:
+    """ Voxels with an occupied voxel somewhere behind them along `direction`,
+        by doubling the scanned distance in every step.
+    """
+    seen = occupied.copy()
+    step = 1
+    while step < max(occupied.shape):
+        seen |= shifted(seen, step * np.asarray(direction))
+        step *= 2
+    return seen
+
+def label(mask: np.ndarray) -> np.ndarray:
+    """ Connected components of `mask`: every voxel gets the smallest flat
+        index of its component, voxels outside the mask get -1.
+    """
+    size = mask.size
+    labels = np.where(mask, np.arange(size).reshape(mask.shape), size)
+    inside = mask.ravel()
+    while True:
+        merged = labels
+        for offset in NEIGHBOURS:
+            merged = np.minimum(merged, np.where(mask, shifted(labels, offset, size), size))
+        flat = merged.ravel()
+        # pointer jumping: follow each label to the label of the voxel it names
+        flat[inside] = flat[flat[inside]]
+        if np.array_equal(merged, labels):
+            break
+        labels = merged
+    return np.where(mask, labels, -1)
+
+def findPockets(coordinates: np.ndarray, count: int, spacing: float = 1.0, atomRadius: float = 2.0,
+                minBuriedness: int = 5, minVolume: float = 50.0, padding: float = 4.0, maxVoxels: int = 8000000):
+    """ Grid-based cavity detection (LIGSITE-like) on receptor coordinates.
+
+        Grid points farther than `atomRadius` from every atom that have
+        protein on both sides along at least `minBuriedness` of the seven scan
+        lines are pocket points. Connected pocket points form pockets, of
+        which the `count` largest with at least `minVolume` cubic angstrom are
+        returned as (center, size) boxes, padded by `padding` on every side.
+    """
+    low = coordinates.min(axis=0) - atomRadius - 1
+    high = coordinates.max(axis=0) + atomRadius + 1
+    spacing = max(spacing, (np.prod(high - low) / maxVoxels) ** (1 / 3))
+    shape = tuple(np.ceil((high - low) / spacing).astype(int) + 1)
+
+    occupied = np.zeros(shape, dtype=bool)
+    reach = int(np.ceil(atomRadius / spacing))
+    cube = np.stack(np.meshgrid(*[np.arange(-reach, reach + 1)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+    sphere = cube[np.linalg.norm(cube, axis=1) * spacing <= atomRadius]
+    centers = np.rint((coordinates - low) / spacing).astype(int)
+    for chunk in range(0, len(centers), 20000):
+        voxels = (centers[chunk:chunk + 20000, None, :] + sphere[None, :, :]).reshape(-1, 3)
+        voxels = voxels[np.all((voxels >= 0) & (voxels < shape), axis=1)]
+        occupied[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = True
+
+    buriedness = np.zeros(shape, dtype=np.int8)
+    for direction in DIRECTIONS:
+        buriedness += seenAlong(occupied, direction) & seenAlong(occupied, -direction)
+    pockets = ~occupied & (buriedness >= minBuriedness)
+
+    labels = label(pockets)
+    ids, sizes = np.unique(labels[pockets], return_counts=True)
+    order = np.argsort(-sizes, kind="stable")
+    boxes = []
+    for index in order[:count]:
+        if sizes[index] * spacing ** 3 < minVolume:
+            break
+        voxels = np.argwhere(labels == ids[index])
+        lowest = low + voxels.min(axis=0) * spacing
+        highest = low + voxels.max(axis=0) * spacing
+        boxes.append(((lowest + highest) / 2, highest - lowest + 2 * padding))
+    return boxes
@@ -0,0 +1,81 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+from WorkerRuntime import FileCache, placeFile
+
+class ReceptorCache(FileCache):
+    """ Content-addressed store of prepared receptors.
+
+        Entries are keyed by a hash of the input PDB and the pipeline version
+        and hold the finished `.pdbqt` together with its `_conf` files and,
+        when grid maps are enabled, the mapsKeys of its boxes. Entries
+        written by another pipeline version are dropped on startup, and the
+        least recently used entries are evicted once `max_entries` is exceeded.
+    """
+    def __init__(self, path: str, maxEntries: int, version: str):
+        super().__init__(path, "receptor", "DockingPrepperService.ReceptorCache", maxEntries=maxEntries)
+        self.version = str(version)
+        self.invalidate()
+
+    def key(self, fullPath: str) -> str:
+        digest = hashlib.sha256(self.version.encode() + b"\0")
+        with open(fullPath, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def invalidate(self):
+        """ Removes every entry that was not produced by the current pipeline version. """
+        removed = 0
+        for entry in self.entries():
+            try:
+                with open(os.path.join(entry, "meta.json"), "r") as file:
+                    version = json.load(file)["version"]
+            except (OSError, ValueError, KeyError):
+                version = None
+            if version != self.version:
+                shutil.rmtree(entry, ignore_errors=True)
+                removed += 1
+        if removed:
+            self.logger.info(f"Invalidated {removed} receptors prepared by other pipeline versions")
+
+    def get(self, key: str, outputPath: str):
+        """ Places the cached receptor at `outputPath`, its config at
+            `outputPath + "_conf"` and its pocket configs next to it. Returns
+            the pocket config paths, or None on a miss.
+        """
+        entry = self.entry(key)
+        try:
+            placeFile(os.path.join(entry, "receptor.pdbqt"), outputPath)
+            placeFile(os.path.join(entry, "receptor.pdbqt_conf"), outputPath + "_conf")
+            pocketPaths = []
+            for number in range(1, len(glob.glob(os.path.join(entry, "receptor.pdbqt_conf_pocket*"))) + 1):
+                pocketPaths.append(f"{outputPath}_conf_pocket{number}")
+                placeFile(os.path.join(entry, f"receptor.pdbqt_conf_pocket{number}"), pocketPaths[-1])
+            self.hit(key)
+        except OSError:
+            self.miss()
+            return None
+        return pocketPaths
+
+    def mapsKeys(self, key: str):
+        """ The mapsKeys of the config and pocket configs of the entry, so a
+            hit needs no hashing to tell whether its grid maps are current.
+            None when they were not stored.
+        """
+        try:
+            with open(os.path.join(self.entry(key), "meta.json"), "r") as file:
+                return json.load(file).get("maps")
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, receptorPath: str, configPath: str, pocketPaths=(), mapsKeys=None):
+        files = {"receptor.pdbqt": receptorPath, "receptor.pdbqt_conf": configPath}
+        for number, pocketPath in enumerate(pocketPaths, start=1):
+            files[f"receptor.pdbqt_conf_pocket{number}"] = pocketPath
+        meta = {"version": self.version}
+        if mapsKeys is not None:
+            meta["maps"] = list(mapsKeys)
+        self.store(key, files, {"meta.json": meta})
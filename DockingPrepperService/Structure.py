@@ -0,0 +1,99 @@
+import mmap
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Columns up to and including the z coordinate of ATOM/HETATM records
+WIDTH = 54
+SPACE = ord(" ")
+
+class Structure():
+    """ Fixed-column view of a PDB/PDBQT file.
+
+        The file is memory-mapped and every line is gathered into one row of a
+        byte matrix in a single vectorised pass, so record types, altlocs,
+        residue names and coordinates are available as NumPy arrays without
+        looping over lines in Python. Use as a context manager, the mapping is
+        released on exit.
+    """
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = np.frombuffer(self.map, dtype=np.uint8)
+        except ValueError:
+            # empty files cannot be mapped
+            self.map = None
+            self.buffer = np.zeros(0, dtype=np.uint8)
+        newlines = np.flatnonzero(self.buffer == ord("\n"))
+        self.starts = np.concatenate(([0], newlines + 1))
+        self.ends = np.concatenate((newlines, [len(self.buffer)]))
+        if len(self.buffer) == 0 or self.buffer[-1] == ord("\n"):
+            self.starts, self.ends = self.starts[:-1], self.ends[:-1]
+        self.columns = self.gather()
+
+    def gather(self) -> np.ndarray:
+        """ The first WIDTH columns of every line, blank-padded. Rows are
+            copied from a strided view of the mapping, only the lines near
+            the end of the file go through a small padded buffer.
+        """
+        size = len(self.buffer)
+        columns = np.full((len(self.starts), WIDTH), SPACE, dtype=np.uint8)
+        if len(self.starts) == 0:
+            return columns
+        if size >= WIDTH:
+            columns[:] = sliding_window_view(self.buffer, WIDTH)[np.minimum(self.starts, size - WIDTH)]
+        # lines starting in the last WIDTH bytes have no full window of their own
+        base = max(size - WIDTH, 0)
+        tail = np.flatnonzero(self.starts > size - WIDTH)
+        padded = np.full(2 * WIDTH, SPACE, dtype=np.uint8)
+        padded[:size - base] = self.buffer[base:]
+        columns[tail] = sliding_window_view(padded, WIDTH)[self.starts[tail] - base]
+        lengths = self.ends - self.starts
+        short = np.flatnonzero(lengths < WIDTH)
+        columns[short] = np.where(np.arange(WIDTH) < lengths[short, None], columns[short], SPACE)
+        return columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.buffer = None
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def field(self, start: int, end: int) -> np.ndarray:
+        """ Columns [start, end) of every line as fixed-width byte strings. """
+        return np.ascontiguousarray(self.columns[:, start:end]).view(f"S{end - start}").ravel()
+
+    def records(self, name: bytes) -> np.ndarray:
+        """ Mask of the lines starting with the record name `name`. """
+        return np.all(self.columns[:, :len(name)] == np.frombuffer(name, dtype=np.uint8), axis=1)
+
+    def atoms(self) -> np.ndarray:
+        return self.records(b"ATOM") | self.records(b"HETATM")
+
+    def altlocs(self) -> np.ndarray:
+        return self.columns[:, 16]
+
+    def residueNames(self) -> np.ndarray:
+        return np.char.strip(self.field(17, 20))
+
+    def coordinates(self, mask: np.ndarray) -> np.ndarray:
+        """ (n, 3) array with the coordinates of the lines selected by `mask`. """
+        rows = self.columns[mask]
+        return np.stack([np.ascontiguousarray(rows[:, start:start + 8]).view("S8").ravel().astype(np.float64)
+                         for start in (30, 38, 46)], axis=1)
+
+    def select(self, keep: np.ndarray) -> bytes:
+        """ The lines selected by `keep`, unchanged. """
+        lengths = np.append(self.starts[1:], len(self.buffer)) - self.starts
+        return self.buffer[np.repeat(keep, lengths)].tobytes()
+
+    def write(self, path: str, keep: np.ndarray):
+        """ Writes the lines selected by `keep` unchanged to `path`. """
+        with open(path, "wb") as out:
+            out.write(self.select(keep))
@@ -0,0 +1,122 @@
+import json
+import math
+import os
+import threading
+import logging
+from Docker import readBox
+
+# Starting weights of log(seconds) over FEATURES, roughly right for Vina
+# until enough tasks have finished to learn better ones
+PRIOR = [-6.0, 1.0, 0.5, 0.5, 0.1]
+FEATURES = ["intercept", "log exhaustiveness", "log receptor atoms", "log box volume", "ligand torsions"]
+
+def countAtoms(fullReceptorPath: str) -> int:
+    with open(fullReceptorPath, "rb") as file:
+        data = b"\n" + file.read()
+    return data.count(b"\nATOM") + data.count(b"\nHETATM")
+
+def countTorsions(fullLigandPath: str) -> int:
+    """ Rotatable bonds of a PDBQT ligand, from its TORSDOF record. """
+    with open(fullLigandPath, "r") as file:
+        for line in file:
+            if line.startswith("TORSDOF"):
+                return int(line.split()[1])
+    return 0
+
+class CostModel():
+    """ Predicts how long a docking task runs, from exhaustiveness, receptor
+        size, box volume and ligand flexibility.
+
+        The model is linear in log(seconds) and is fitted online by recursive
+        least squares on the runtime of every finished task. Old observations
+        are slowly forgotten, so the model follows hardware changes. The
+        weights are saved to `path` every `saveEvery` observations and by
+        close(), so they survive restarts.
+    """
+    def __init__(self, path: str = None, forgetting: float = 0.995, saveEvery: int = 100):
+        self.logger = logging.getLogger("DockingService.CostModel")
+        self.path = path
+        self.forgetting = forgetting
+        self.saveEvery = max(1, saveEvery)
+        self.lock = threading.Lock()
+        # serializes writers, so an older snapshot never replaces a newer one
+        self.saving = threading.Lock()
+        self.weights = list(PRIOR)
+        self.covariance = [[1.0 if i == j else 0.0 for j in range(len(PRIOR))] for i in range(len(PRIOR))]
+        self.observations = 0
+        self.saved = 0
+        self.receptorAtoms = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    def features(self, body) -> list:
+        receptor = body["receptorPath"]
+        key = (receptor, os.path.getmtime(receptor))
+        atoms = self.receptorAtoms.get(key)
+        if atoms is None:
+            if len(self.receptorAtoms) > 10000:
+                self.receptorAtoms.clear()
+            atoms = self.receptorAtoms[key] = countAtoms(receptor)
+        _, size = readBox(body["configPath"])
+        return [1.0,
+                math.log(max(body["exhaustiveness"], 1)),
+                math.log(max(atoms, 1)),
+                math.log(max(size[0] * size[1] * size[2], 1.0)),
+                float(countTorsions(body["ligandPath"]))]
+
+    def predict(self, features: list) -> float:
+        """ Expected runtime in seconds. """
+        with self.lock:
+            estimate = sum(w * x for w, x in zip(self.weights, features))
+        return math.exp(min(estimate, 50.0))
+
+    def update(self, features: list, seconds: float):
+        """ Learns from the runtime of a finished task. """
+        target = math.log(max(seconds, 0.1))
+        with self.lock:
+            n = len(self.weights)
+            px = [sum(self.covariance[i][j] * features[j] for j in range(n)) for i in range(n)]
+            gain = [v / (self.forgetting + sum(x * v for x, v in zip(features, px))) for v in px]
+            error = target - sum(w * x for w, x in zip(self.weights, features))
+            self.weights = [w + g * error for w, g in zip(self.weights, gain)]
+            self.covariance = [[(self.covariance[i][j] - gain[i] * px[j]) / self.forgetting for j in range(n)]
+                               for i in range(n)]
+            self.observations += 1
+            due = self.observations - self.saved >= self.saveEvery
+        if self.path and due:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                state = json.load(file)
+            if state["features"] != FEATURES:
+                return
+            self.weights = state["weights"]
+            self.covariance = state["covariance"]
+            self.observations = self.saved = state["observations"]
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Could not load cost model from {self.path}: {e}")
+            return
+        self.logger.info(f"Loaded cost model trained on {self.observations} tasks")
+
+    def save(self):
+        """ Writes the model to `path` without holding up predict(). """
+        with self.saving:
+            with self.lock:
+                # update() replaces the weights and covariance rather than changing them
+                state = {"features": FEATURES, "weights": self.weights,
+                         "covariance": self.covariance, "observations": self.observations}
+                self.saved = self.observations
+            temporary = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+            try:
+                with open(temporary, "w") as file:
+                    json.dump(state, file)
+                os.replace(temporary, self.path)
+            except OSError as e:
+                self.logger.warning(f"Could not save cost model to {self.path}: {e}")
+
+    def close(self):
+        """ Saves what was learned since the last save. """
+        if self.path and self.observations > self.saved:
+            self.save()
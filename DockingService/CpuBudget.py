@@ -0,0 +1,74 @@
+import os
+from collections import OrderedDict
+import threading
+import logging
+
+def availableCpus() -> int:
+    """ Number of cores this process may run on (respects container cpusets). """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class CpuBudget():
+    """ Splits a fixed number of cores across concurrently running Vina jobs.
+
+        Each job asks for cores with its exhaustiveness as weight. Its share
+        is its weighted part of the budget among the running and waiting
+        jobs, capped by the exhaustiveness (Vina cannot use more threads
+        than search runs). A Vina job keeps its threads until it ends, so
+        instead of starting with whatever few cores are left, a job waits
+        until its share is free; jobs get their cores in arrival order, and
+        the first one also takes the free cores no other waiting job needs.
+    """
+    def __init__(self, cpus: int):
+        self.logger = logging.getLogger("DockingService.CpuBudget")
+        self.cpus = max(1, cpus)
+        self.condition = threading.Condition()
+        self.running = {}
+        self.waiting = OrderedDict()
+        self.nextToken = 0
+
+    def share(self, weight: int, totalWeight: int) -> int:
+        return max(1, min(weight, self.cpus * weight // totalWeight))
+
+    def allotment(self, token) -> int:
+        """ Cores the waiting job `token` can start with now, 0 if it has to
+            wait. Must be called with the condition held.
+        """
+        if next(iter(self.waiting)) != token:
+            return 0
+        totalWeight = sum(w for w, _ in self.running.values()) + sum(self.waiting.values())
+        free = self.cpus - sum(c for _, c in self.running.values())
+        weight = self.waiting[token]
+        share = self.share(weight, totalWeight)
+        if free < share:
+            return 0
+        others = sum(self.share(w, totalWeight) for t, w in self.waiting.items() if t != token)
+        return max(share, min(weight, free - others))
+
+    def acquire(self, weight: int):
+        """ Blocks until the job's cores are free, returns a token for
+            release() and the number of cores.
+        """
+        weight = max(1, weight)
+        with self.condition:
+            token = self.nextToken
+            self.nextToken += 1
+            self.waiting[token] = weight
+            cpus = self.allotment(token)
+            while cpus == 0:
+                self.condition.wait()
+                cpus = self.allotment(token)
+            del self.waiting[token]
+            self.running[token] = (weight, cpus)
+            # the next waiting job may fit into what is left
+            self.condition.notify_all()
+            running = len(self.running)
+        self.logger.debug(f"Allotted {cpus} of {self.cpus} cores (weight {weight}, {running} running)")
+        return token, cpus
+
+    def release(self, token):
+        with self.condition:
+            self.running.pop(token, None)
+            self.condition.notify_all()
@@ -1,42 +1,122 @@
-import subprocess
-from pathlib import Path
+from contextlib import nullcontext
 import os
 import re
 import logging
+from WorkerRuntime import run, ProcessError, METRICS, mapsKey
+
+def readBox(fullConfigPath: str):
+    """ Center and size of the search box in a Vina config file. """
+    values = {}
+    with open(fullConfigPath, "r") as file:
+        for line in file:
+            match = re.match(r"\s*(center_[xyz]|size_[xyz])\s*=\s*([-.0-9eE+]+)", line)
+            if match:
+                values[match.group(1)] = float(match.group(2))
+    return ([values["center_x"], values["center_y"], values["center_z"]],
+            [values["size_x"], values["size_y"], values["size_z"]])
 
 class DockerException(Exception):
     def __init__(self, error):
         self.error = error
 
 class Docker():
-    def __init__(self, config):
+    def __init__(self, config, engine=None, cancellations=None, job=None, accounting=None):
+        """ `job` is the submission the docking belongs to, Vina is killed
+            when it shows up in `cancellations`. The resources every Vina run
+            used are recorded in `accounting`.
+        """
         self.regex = re.compile(r'\n   1[ ]*([-.0-9]+)')
         self.logger = logging.getLogger("DockingService.Docker")
         self.config = config
+        self.engine = engine
+        self.cancellations = cancellations
+        self.job = job
+        self.accounting = accounting
+
+    def outputPath(self, fullLigandPath, fullReceptorPath) -> str:
+        receptorFilenameWithExt = os.path.basename(fullReceptorPath)
+        receptorFilename, ext = os.path.splitext(receptorFilenameWithExt)
+        ligandFilename, lext = os.path.splitext(fullLigandPath)
+        return os.path.join(os.path.dirname(fullLigandPath), ligandFilename + "_docked_to_" + receptorFilename + ".pdbqt")
+
+    def mapsFor(self, fullReceptorPath, fullConfigPath):
+        """ Prefix of the precomputed grid maps for the receptor and box, or
+            None when maps are disabled, missing or stale.
+        """
+        if not self.config.get("maps", {}).get("enabled"):
+            return None
+        mapsDir = fullConfigPath + ".maps"
+        try:
+            with open(os.path.join(mapsDir, "key"), "r") as file:
+                if file.read() != mapsKey(fullReceptorPath, fullConfigPath):
+                    self.logger.info(f"Grid maps in {mapsDir} are stale")
+                    return None
+        except OSError:
+            return None
+        return os.path.join(mapsDir, "receptor")
 
-    def runDocking(self, fullLigandPath, fullReceptorPath, fullConfigPath, exhaustiveness):
+    def runPockets(self, fullLigandPath, fullReceptorPath, fullConfigPaths, exhaustiveness, cpus=None, outputdir=None):
+        """ Docks the ligand into every box in `fullConfigPaths` and keeps the
+            best pose at `outputdir`, the usual output path by default.
+            Returns the affinity, the output path and the (1-based) index of
+            the box that won.
         """
+        outputdir = outputdir or self.outputPath(fullLigandPath, fullReceptorPath)
+        if len(fullConfigPaths) == 1:
+            affinity, outputdir = self.runDocking(fullLigandPath, fullReceptorPath, fullConfigPaths[0], exhaustiveness,
+                                                  cpus, outputdir)
+            return affinity, outputdir, 1
+        results = []
+        try:
+            for pocket, fullConfigPath in enumerate(fullConfigPaths, start=1):
+                affinity, posePath = self.runDocking(fullLigandPath, fullReceptorPath, fullConfigPath, exhaustiveness,
+                                                     cpus, f"{outputdir}.pocket{pocket}")
+                results.append((affinity, pocket, posePath))
+            affinity, pocket, posePath = min(results)
+            if os.path.exists(outputdir):
+                os.remove(outputdir)
+            os.replace(posePath, outputdir)
+        finally:
+            for _, _, posePath in results:
+                if os.path.exists(posePath):
+                    os.remove(posePath)
+        self.logger.info(f"Best pose in pocket {pocket} of {len(fullConfigPaths)} with affinity {affinity}")
+        return affinity, outputdir, pocket
+
+    def runDocking(self, fullLigandPath, fullReceptorPath, fullConfigPath, exhaustiveness, cpus=None, outputdir=None):
+        """ Docks the ligand against the receptor. `cpus` is the number of
+            threads Vina may use; when omitted a single job uses up to 4.
         """
         log = ""
         affinity: float = 1000
-        receptorFilenameWithExt = os.path.basename(fullReceptorPath)
-        receptorFilename, ext = os.path.splitext(receptorFilenameWithExt)
-        ligandFilename, lext = os.path.splitext(fullLigandPath)
-        outputdir = os.path.join(os.path.dirname(fullLigandPath), ligandFilename + "_docked_to_" + receptorFilename + ".pdbqt")
-        self.logger.info(f"Starting AutoDock Vina process")
-        docking = subprocess.run([self.config["vinapath"],
-                                  "--config", fullConfigPath,
-                                  "--exhaustiveness",
-                                  str(exhaustiveness),
-                                  "--receptor", fullReceptorPath,
-                                  "--ligand", fullLigandPath,
-                                  "--cpu",
-                                  str(min(exhaustiveness, 4)), # adjust maximum amount of CPUs according to number of workers and CPUs
-                                  "--energy_range",
-                                  "5",
-                                  "--out",
-                                  outputdir], 
-                                  text=True, capture_output=True)
+        outputdir = outputdir or self.outputPath(fullLigandPath, fullReceptorPath)
+        maps = self.mapsFor(fullReceptorPath, fullConfigPath)
+        if self.engine is not None:
+            return self.runEngine(fullLigandPath, fullReceptorPath, fullConfigPath, exhaustiveness, cpus, outputdir, maps)
+        if maps is not None:
+            # the maps carry the receptor and the box, Vina refuses both at once
+            self.logger.info(f"Starting AutoDock Vina process with grid maps {maps}")
+            inputs = [self.config["maps"]["vinapath"], "--maps", maps]
+        else:
+            self.logger.info("Starting AutoDock Vina process")
+            inputs = [self.config["vinapath"], "--config", fullConfigPath, "--receptor", fullReceptorPath]
+        try:
+            with METRICS.stage("vina"):
+                docking = run(inputs + ["--exhaustiveness",
+                                        str(exhaustiveness),
+                                        "--ligand", fullLigandPath,
+                                        "--cpu",
+                                        str(cpus or min(exhaustiveness, 4)),
+                                        "--energy_range",
+                                        "5",
+                                        "--out",
+                                        outputdir],
+                              timeout=self.config.get("timeouts", {}).get("vina"),
+                              job=self.job, cancellations=self.cancellations,
+                              accounting=self.accounting, tool="vina")
+        except ProcessError as e:
+            self.logger.error(e.error)
+            raise DockerException(e.error)
         log += docking.stdout
         log += docking.stderr
         self.logger.info(f"AutoDock Vina finished.")
@@ -50,4 +130,20 @@ class Docker():
        
         self.logger.info(f"Extracted affinity from output: {affinity}")
 
-        return affinity, outputdir
\ No newline at end of file
+        return affinity, outputdir
+
+    def runEngine(self, fullLigandPath, fullReceptorPath, fullConfigPath, exhaustiveness, cpus, outputdir, maps):
+        # an in-process run cannot be killed, only kept from starting
+        if self.cancellations is not None and self.cancellations.isCancelled(self.job):
+            raise DockerException(f"{self.job} was cancelled")
+        self.logger.info("Docking with the resident Vina engine")
+        try:
+            timed = self.accounting.timed("vina_engine") if self.accounting is not None else nullcontext()
+            with METRICS.stage("vina_engine"), timed:
+                affinity = self.engine.dock(fullLigandPath, fullReceptorPath, fullConfigPath, exhaustiveness,
+                                            cpus or min(exhaustiveness, 4), outputdir, maps)
+        except Exception as e:
+            self.logger.error(f"Vina engine failed: {e}")
+            raise DockerException(str(e))
+        self.logger.info(f"Extracted affinity from output: {affinity}")
+        return affinity, outputdir
@@ -1,26 +1,24 @@
-import datetime
-from kombu import Connection, Exchange, Queue, Producer
-from kombu.mixins import ConsumerProducerMixin
+import os
+from kombu import Exchange, Queue, Producer
 import json
 from time import time
-from random import uniform
 import math
+import glob
+import re
 from Docker import Docker
-import logging
+from CpuBudget import CpuBudget, availableCpus
+from ResultCache import ResultCache
+from PoseArchive import PoseArchive
+from Screening import Screening
+from CostModel import CostModel
+from Scheduler import Scheduler
+from WorkerRuntime import Cancellations, cancellationQueue, enqueuedAt, METRICS, Accounting, ServiceWorker, setup_mq, initialize_logging, HEARTBEAT
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue, Empty
 import yaml
 import argparse
 
-def initialize_logging(mod_name):
-    logger = logging.getLogger(mod_name)
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        '%(asctime)s [%(name)-12s] %(levelname)-8s %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
-    return logger
-
-def createResultMessage(submission: str, receptor: str, affinity: float, outputDir: str, secondsToCompletion: int, success: bool):
+def createResultMessage(submission: str, receptor: str, affinity: float, outputDir: str, secondsToCompletion: int, success: bool, stage: str = "full", pocket: int = None, resources: dict = None, archived: bool = False, receptorCount: int = None):
     message = {
         "message": {
             "submission": submission,
@@ -28,7 +26,12 @@ def createResultMessage(submission: str, receptor: str, affinity: float, outputD
             "affinity": affinity,
             "outputPath": outputDir,
             "secondsToCompletion": secondsToCompletion,
-            "success": success
+            "success": success,
+            "stage": stage,
+            "pocket": pocket,
+            "resources": resources,
+            "archived": archived,
+            "receptorCount": receptorCount
         },
         "messageType": [
             "urn:message:AsyncAPI.Models:DockingResult"
@@ -36,51 +39,438 @@ def createResultMessage(submission: str, receptor: str, affinity: float, outputD
     }
     return message
 
-class Worker(ConsumerProducerMixin):
-    def __init__(self, connection, queues, config):
-        self.connection = connection
-        self.queues = queues
-        self.logger = initialize_logging("DockingService")
-        self.config = config
+def createBatchTask(batch, receptor, exhaustiveness=None):
+    return {
+        "submissionId": batch["submissionId"],
+        "receptorId": receptor["receptorId"],
+        "ligandPath": batch["ligandPath"],
+        "receptorPath": receptor["receptorPath"],
+        "configPath": receptor["configPath"],
+        "pocketConfigPaths": receptor.get("pocketConfigPaths"),
+        "exhaustiveness": exhaustiveness or batch["exhaustiveness"],
+        "receptorCount": batch.get("receptorCount", len(batch["receptors"]))
+    }
+
+def withStage(result, stage: str):
+    result["message"]["stage"] = stage
+    return result
+
+def withReceptorCount(result, body):
+    """ Passes on how many receptors the task's submission docks, the
+        receptorCount of the task. Batch tasks default it to the batch's
+        size; plain DockingTasks must set it for the leaderboard to know
+        when their submission is complete.
+    """
+    result["message"]["receptorCount"] = body.get("receptorCount")
+    return result
+
+class Worker(ServiceWorker):
+    blocking = True
+
+    def __init__(self, connection, queues, config, batchQueues=()):
+        super().__init__(connection, queues, config, "DockingService")
+        self.batchQueues = batchQueues
+        self.cache = None
+        if config.get("cache", {}).get("path"):
+            self.cache = ResultCache(config["cache"]["path"], config["cache"]["max_bytes"])
+        self.engine = None
+        if config.get("engine", {}).get("enabled"):
+            # the Vina bindings are only needed in this mode
+            from VinaEngine import VinaEngine
+            self.engine = VinaEngine(config, config["engine"]["receptors"])
+        self.archive = config.get("archive", {}).get("enabled", False)
+        self.costModel = None
+        if config.get("scheduling", {}).get("enabled"):
+            self.costModel = CostModel(config["scheduling"].get("model_path") or None,
+                                       saveEvery=config["scheduling"].get("save_every", 100))
+        self.cancellations = Cancellations(config.get("cancellation", {}).get("ttl", 86400))
+        self.cancellationQueue = cancellationQueue()
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=1)]
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=1),
+                self.isolatedConsumer(channel, queues=self.batchQueues, callbacks=[self.on_batch_message], prefetch_count=1),
+                Consumer(queues=[self.cancellationQueue], callbacks=[self.on_cancel], no_ack=True)]
 
-    def on_message(self, body, message):
-        docker = Docker(self.config)
-        self.logger.info(f"Received message {body}")
+    def on_cancel(self, body, message):
+        """ Queued tasks of a cancelled submission are dropped, running Vina
+            processes of it are killed. No results are published for it.
+        """
+        self.logger.info(f"Submission {body['submissionId']} was cancelled")
+        self.cancellations.cancel(body["submissionId"])
+
+    def cancelled(self, submission) -> bool:
+        return self.cancellations.isCancelled(submission)
+
+    def configPaths(self, body) -> list:
+        """ The search boxes to dock into. With `pockets.enabled` these are
+            the pocket boxes written by the prepper (from the task, else found
+            next to the whole-protein config), falling back to the
+            whole-protein box for receptors without pockets.
+        """
+        if not self.config.get("pockets", {}).get("enabled"):
+            return [body["configPath"]]
+        paths = body.get("pocketConfigPaths")
+        if paths is None:
+            paths = [path for path in glob.glob(glob.escape(body["configPath"]) + "_pocket*") if re.search(r"_pocket\d+$", path)]
+            paths.sort(key=lambda path: int(path.rsplit("_pocket", 1)[1]))
+        return paths[:self.config["pockets"].get("max", len(paths))] or [body["configPath"]]
+
+    def outputPath(self, body) -> str:
+        """ Where the pose of the task goes: its outputPath when set (the
+            first stage of a screen writes next to the final path), else the
+            usual path next to the ligand.
+        """
+        return body.get("outputPath") or Docker(self.config).outputPath(body["ligandPath"], body["receptorPath"])
+
+    def lookup(self, body):
+        """ Returns the cache key for the task and the cached result, if any. """
+        if self.cache is None:
+            return None, None
+        try:
+            key = self.cache.key(body["ligandPath"], body["receptorPath"], self.configPaths(body), body["exhaustiveness"])
+        except OSError as e:
+            self.logger.warning(f"Could not hash docking inputs: {e}")
+            return None, None
+        outputdir = self.outputPath(body)
+        cached = self.cache.get(key, outputdir)
+        if cached is None:
+            return key, None
+        return key, self.archivePose(body, createResultMessage(body["submissionId"], body["receptorId"], cached["affinity"],
+                                                               outputdir, 0, True, pocket=cached.get("pocket")))
+
+    def dock(self, body, cpus=None, key=None):
+        if self.cancelled(body["submissionId"]):
+            return createResultMessage(body["submissionId"], body["receptorId"], 0, "", 0, False)
+        accounting = Accounting(self.logger, body["submissionId"])
+        docker = Docker(self.config, self.engine, self.cancellations, body["submissionId"], accounting)
         start_time = time()
 
+        configPaths = self.configPaths(body)
         try:
-            affinity, outputdir = docker.runDocking(body["ligandPath"], body["receptorPath"], body["configPath"], body["exhaustiveness"])
+            with METRICS.inFlight("docking"):
+                affinity, outputdir, pocket = docker.runPockets(body["ligandPath"], body["receptorPath"], configPaths,
+                                                                body["exhaustiveness"], cpus, self.outputPath(body))
         except Exception:
-            message.reject(requeue=False)
             elapsed_time = math.ceil(time() - start_time)
-            result = createResultMessage(body["submissionId"], body["receptorId"], 0, "", elapsed_time, False)
-            self.producer.publish(
-                json.dumps(result), exchange="AsyncAPI.Models:DockingResult", retry=True
-            )
-            return
+            return createResultMessage(body["submissionId"], body["receptorId"], 0, "", elapsed_time, False,
+                                       resources=accounting.summary())
 
+        self.learn(body, time() - start_time)
         elapsed_time = math.ceil(time() - start_time)
         self.logger.info(f"Docking took {elapsed_time} seconds")
-        result = createResultMessage(body["submissionId"], body["receptorId"], affinity, outputdir, elapsed_time, True)
-        self.logger.info(f"Publishing result {json.dumps(result)}")
-        self.producer.publish(
-            json.dumps(result), exchange="AsyncAPI.Models:DockingResult", retry=True
-        )
-        message.ack()
+        if configPaths == [body["configPath"]]:
+            pocket = None
+        if key is not None:
+            self.cache.put(key, affinity, outputdir, pocket)
+        return self.archivePose(body, createResultMessage(body["submissionId"], body["receptorId"], affinity, outputdir,
+                                                          elapsed_time, True, pocket=pocket, resources=accounting.summary()))
 
-def setup_mq(host):
-    connection = Connection(host, heartbeat=0)
-    channel = connection.channel()
-    exchange = Exchange("AsyncAPI.Models:DockingResult", "fanout", channel=channel)
-    exchange.declare()
+    def archivePose(self, body, result):
+        """ With `archive.enabled`, moves the pose file of a successful result
+            into the submission's PoseArchive. The result then points at the
+            archive and is marked archived, its pose is found by receptorId.
+        """
+        if not self.archive or not result["message"]["success"]:
+            return result
+        posePath = result["message"]["outputPath"]
+        archive = PoseArchive(PoseArchive.pathFor(body["ligandPath"]))
+        try:
+            with METRICS.stage("archive"):
+                archive.add(body["receptorId"], posePath)
+        except OSError as e:
+            self.logger.error(f"Could not archive {posePath}, keeping the file: {e}")
+            return result
+        os.remove(posePath)
+        result["message"]["outputPath"] = archive.path
+        result["message"]["archived"] = True
+        return result
+
+    def learn(self, body, seconds: float):
+        if self.costModel is None:
+            return
+        try:
+            self.costModel.update(self.costModel.features(body), seconds)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Could not learn from task: {e}")
+
+    def submit(self, body, callback, key=None):
+        with self.busy():
+            result = self.dock(body, key=key)
+        callback(result)
+
+    def start(self, body, callback):
+        def counted(result):
+            callback(withReceptorCount(result, body))
+
+        key, result = self.lookup(body)
+        if result is not None:
+            counted(result)
+            return
+        self.submit(body, counted, key)
+
+    def publishResult(self, result):
+        if self.cancelled(result["message"]["submission"]):
+            self.logger.debug(f"Dropping result for cancelled submission {result['message']['submission']}")
+            return
+        if result["message"]["success"]:
+            self.logger.info(f"Publishing result {json.dumps(result)}")
+        self.publish(json.dumps(result), "AsyncAPI.Models:DockingResult")
+
+    def finish(self, message, result):
+        self.publishResult(result)
+        if result["message"]["success"] or self.cancelled(result["message"]["submission"]):
+            METRICS.inc("worker_messages_total", outcome="ok" if result["message"]["success"] else "cancelled")
+            self.ack(message)
+        else:
+            METRICS.inc("worker_messages_total", outcome="failed")
+            self.reject(message)
+
+    def on_message(self, body, message):
+        self.logger.info(f"Received message {body}")
+        self.received(message)
+        self.start(body, lambda result: self.finish(message, result))
+
+    def on_batch_message(self, body, message):
+        """ Docks one ligand against many receptors. A DockingResult is
+            published per receptor as it finishes; the batch is acked once
+            every receptor has been reported.
+        """
+        self.received(message)
+        if self.cancelled(body["submissionId"]):
+            self.logger.info(f"Dropping batch of cancelled submission {body['submissionId']}")
+            self.ack(message)
+            return
+        screening = body.get("screening")
+        if screening is None and self.config.get("screening", {}).get("enabled"):
+            screening = self.config["screening"]
+        if screening is not None:
+            self.screenBatch(body, message, screening)
+            return
+        tasks = [createBatchTask(body, receptor) for receptor in body["receptors"]]
+        self.logger.info(f"Received batch of {len(tasks)} receptors for submission {body['submissionId']}")
+        remaining = len(tasks)
+
+        def done(result):
+            nonlocal remaining
+            self.publishResult(result)
+            remaining -= 1
+            if remaining == 0:
+                self.logger.info(f"Finished batch for submission {body['submissionId']}")
+                self.ack(message)
+
+        if not tasks:
+            self.ack(message)
+        for task in tasks:
+            self.start(task, done)
+
+    def screenBatch(self, body, message, settings):
+        """ Two-stage screen of a batch: every receptor is first docked at
+            the cheap `settings["exhaustiveness"]`, then only the best ones
+            (see Screening) are re-docked at the batch's exhaustiveness.
+            Each receptor gets exactly one DockingResult, whose stage is
+            "screen" or "refine" depending on which run produced it.
+        """
+        submission = body["submissionId"]
+        screening = Screening(submission, settings.get("topK", 0), settings.get("margin"))
+        tasks = {receptor["receptorId"]: receptor for receptor in body["receptors"]}
+        self.logger.info(f"Received batch of {len(tasks)} receptors for submission {submission}, screening at exhaustiveness {settings['exhaustiveness']}")
+        remaining = len(tasks)
+
+        def refined(result):
+            nonlocal remaining
+            screenResult = screening.results[result["message"]["receptor"]]
+            if result["message"]["success"]:
+                self.discardPose(screenResult)
+                self.publishResult(withStage(result, "refine"))
+            else:
+                # keep the first stage result rather than reporting a failure
+                self.publishResult(self.promote(screenResult, finalPaths[result["message"]["receptor"]]))
+            remaining -= 1
+            if remaining == 0:
+                self.logger.info(f"Finished screen for submission {submission}")
+                self.ack(message)
+
+        def screened(result):
+            nonlocal remaining
+            screening.add(withStage(result, "screen"))
+            remaining -= 1
+            if remaining > 0:
+                return
+            selected = screening.selected()
+            self.logger.info(f"Refining {len(selected)} of {len(tasks)} receptors for submission {submission} "
+                             f"(best {screening.bestAffinity}, cutoff {screening.cutoff()})")
+            for receptor, screenResult in screening.results.items():
+                if receptor not in selected:
+                    self.publishResult(self.promote(screenResult, finalPaths[receptor]))
+            remaining = len(selected)
+            if remaining == 0:
+                self.ack(message)
+            for receptor in selected:
+                self.start(createBatchTask(body, tasks[receptor]), refined)
+
+        # first stage poses go next to the final ones, refining must not overwrite them
+        finalPaths = {receptorId: self.outputPath(createBatchTask(body, receptor)) for receptorId, receptor in tasks.items()}
+        if not tasks:
+            self.ack(message)
+        for receptor in list(tasks.values()):
+            task = createBatchTask(body, receptor, settings["exhaustiveness"])
+            task["outputPath"] = finalPaths[receptor["receptorId"]] + ".screen"
+            self.start(task, screened)
+
+    def promote(self, result, outputPath: str):
+        """ Moves the pose of a first stage result that is final to
+            `outputPath`, where a single stage run would have put it.
+        """
+        message = result["message"]
+        if message["success"] and not message.get("archived"):
+            os.replace(message["outputPath"], outputPath)
+            message["outputPath"] = outputPath
+        return result
+
+    def discardPose(self, result):
+        """ Removes the pose of a first stage result that was refined. """
+        message = result["message"]
+        if message["success"] and not message.get("archived") and os.path.exists(message["outputPath"]):
+            os.remove(message["outputPath"])
+
+    def on_consume_end(self, connection, channel):
+        if self.costModel is not None:
+            self.costModel.close()
+        super().on_consume_end(connection, channel)
+
+class PooledWorker(Worker):
+    """ Runs up to `worker.slots` Vina jobs at the same time and splits the
+        core budget between them. Jobs run on a thread pool (Vina itself is a
+        subprocess); results are published and messages acked back on the
+        consumer thread, since kombu channels must not be shared across threads.
+    """
+    blocking = False
+
+    def __init__(self, connection, queues, config, batchQueues=()):
+        super().__init__(connection, queues, config, batchQueues)
+        self.slots = config["worker"]["slots"]
+        self.budget = CpuBudget(config["worker"].get("cpus") or availableCpus())
+        self.pool = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="vina")
+        self.completed = SimpleQueue()
+        self.running = 0
+        self.scheduler = None
+        if self.costModel is not None:
+            self.scheduler = Scheduler(config["scheduling"].get("max_wait", 600))
+        self.logger.info(f"Running {self.slots} docking slots on {self.budget.cpus} cores")
+
+    def get_consumers(self, Consumer, channel):
+        # with a scheduler, prefetch a window of tasks to pick the shortest from
+        prefetch = max(self.slots, self.config["scheduling"].get("window", 0)) if self.scheduler else self.slots
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=prefetch),
+                self.isolatedConsumer(channel, queues=self.batchQueues, callbacks=[self.on_batch_message], prefetch_count=1),
+                Consumer(queues=[self.cancellationQueue], callbacks=[self.on_cancel], no_ack=True)]
+
+    def dockWithBudget(self, body, key):
+        token, cpus = self.budget.acquire(body["exhaustiveness"])
+        try:
+            return self.dock(body, cpus, key)
+        finally:
+            self.budget.release(token)
 
-    Queue("DockingResult", exchange=exchange, channel=channel).declare()
+    def submit(self, body, callback, key=None):
+        if self.scheduler is None:
+            self.runTask(body, callback, key)
+            return
+        try:
+            cost = self.costModel.predict(self.costModel.features(body))
+        except (OSError, ValueError, KeyError) as e:
+            # most likely a missing input, which fails fast
+            self.logger.warning(f"Could not estimate task cost: {e}")
+            cost = 0.0
+        self.logger.debug(f"Expecting task for receptor {body['receptorId']} to take {cost:.0f} seconds")
+        self.scheduler.push(cost, (body, callback, key))
+        self.dispatch()
+
+    def dispatch(self):
+        while self.running < self.slots and len(self.scheduler):
+            self.runTask(*self.scheduler.pop())
+
+    def runTask(self, body, callback, key):
+        self.running += 1
+        future = self.pool.submit(self.dockWithBudget, body, key)
+        future.add_done_callback(lambda f: self.completed.put((callback, body, f)))
+
+    def on_iteration(self):
+        while True:
+            try:
+                callback, body, future = self.completed.get_nowait()
+            except Empty:
+                break
+            self.running -= 1
+            try:
+                result = future.result()
+            except Exception as e:
+                self.logger.error(f"Docking job crashed: {e}")
+                result = createResultMessage(body["submissionId"], body["receptorId"], 0, "", 0, False)
+            callback(result)
+        if self.scheduler is not None:
+            self.dispatch()
+        super().on_iteration()
+
+    def on_consume_end(self, connection, channel):
+        self.pool.shutdown(wait=True)
+        super().on_consume_end(connection, channel)
+
+class Router(ServiceWorker):
+    """ Moves DockingTasks from the shared fanout queue onto a consistent
+        hash exchange keyed by receptorId, so all tasks for a receptor land
+        on the same worker, which then has the receptor loaded already.
+    """
+    def __init__(self, connection, queues, config, exchange):
+        super().__init__(connection, queues, config, "DockingService.Router")
+        self.exchange = exchange
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=100)]
+
+    def on_message(self, body, message):
+        self.received(message)
+        self.logger.debug(f"Routing task for receptor {body['receptorId']}")
+        # the worker's queue wait counts from when the task was first queued
+        self.publish(body, self.exchange, routing_key=str(body["receptorId"]), declare=[self.exchange],
+                     headers={**(message.headers or {}), "x-enqueued-at": enqueuedAt(message)})
+        self.ack(message)
 
-    return connection, channel, exchange
+def setup_routing(config, name=None):
+    """ The exchange tasks are routed on and the queue `name` on it, by
+        default this worker's queue. Worker queues have stable names from
+        `routing.queue` (or ROUTING_QUEUE), so a replaced container takes
+        over its backlog instead of leaving an orphaned queue that keeps its
+        share of the receptors. Retired workers' queues are emptied with
+        --drain.
+    """
+    exchange = Exchange(config["routing"]["exchange"], "x-consistent-hash", durable=True)
+    name = name or os.environ.get("ROUTING_QUEUE") or config["routing"].get("queue")
+    queue = None
+    if name:
+        queue = Queue(name, exchange=exchange, routing_key=str(config["routing"].get("weight", 1)), durable=True)
+    return exchange, queue
 
+def drainQueue(connection, queue: Queue, exchange: Exchange, logger):
+    """ Retires a worker queue: unbinds it, so it gets no new receptors,
+        routes the tasks left in it to the other workers and deletes it.
+    """
+    channel = connection.channel()
+    queue = queue(channel)
+    queue.unbind_from(exchange, routing_key=queue.routing_key)
+    producer = Producer(channel)
+    moved = 0
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        body = message.decode()
+        producer.publish(body, exchange=exchange, routing_key=str(body["receptorId"]), declare=[exchange],
+                         delivery_mode=2, headers={**(message.headers or {}), "x-enqueued-at": enqueuedAt(message)})
+        message.ack()
+        moved += 1
+    queue.delete(if_empty=True)
+    logger.info(f"Moved {moved} tasks from {queue.name} to the other workers and deleted it")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -88,6 +478,8 @@ if __name__ == "__main__":
         description="Performs docking using AutoDock Vina"
     )
     parser.add_argument("--dev", action="store_true", help="Use config_dev.yml")
+    parser.add_argument("--route", action="store_true", help="Route tasks to workers by receptor instead of docking")
+    parser.add_argument("--drain", metavar="QUEUE", help="Move the tasks of a retired worker's queue to the other workers and delete it")
     args =  parser.parse_args()
 
     config = None
@@ -99,10 +491,31 @@ if __name__ == "__main__":
             config = yaml.safe_load(f)
 
 
-    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"])
+    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"], "DockingResult",
+                                             config.get("messaging", {}).get("heartbeat", HEARTBEAT))
+
+    if config.get("metrics", {}).get("port"):
+        METRICS.serve(config["metrics"]["port"])
 
-    worker = Worker(connection,
-                    [Queue("DockingTask",
-                     exchange=Exchange("AsyncAPI.Models:DockingTask", "fanout"))],
-                    config)
-    worker.run()
+    routing = config.get("routing", {}).get("enabled", False)
+    if (args.route or args.drain) and not routing:
+        parser.error("--route and --drain need routing.enabled, otherwise no worker consumes the routed tasks")
+
+    tasks = Queue("DockingTask", exchange=Exchange("AsyncAPI.Models:DockingTask", "fanout"))
+    if args.drain:
+        exchange, queue = setup_routing(config, args.drain)
+        drainQueue(connection, queue, exchange, initialize_logging("DockingService.Drain"))
+    elif args.route:
+        Router(connection, [tasks], config, setup_routing(config)[0]).run()
+    else:
+        if routing:
+            tasks = setup_routing(config)[1]
+            if tasks is None:
+                parser.error("routing.enabled needs routing.queue or ROUTING_QUEUE, the stable name of this worker's queue")
+        pooled = config.get("worker", {}).get("slots", 1) > 1 or config.get("scheduling", {}).get("enabled", False)
+        worker = (PooledWorker if pooled else Worker)(connection,
+                        [tasks],
+                        config,
+                        [Queue("DockingBatchTask",
+                         exchange=Exchange("AsyncAPI.Models:DockingBatchTask", "fanout"))])
+        worker.run(safety_interval=0.1 if pooled else 1)
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+import argparse
+import fcntl
+import gzip
+import json
+import os
+import re
+import sys
+
+MODE = re.compile(r"REMARK VINA RESULT:\s+([-.0-9eE+]+)\s+([-.0-9eE+]+)\s+([-.0-9eE+]+)")
+
+def readModes(pdbqt: str) -> list:
+    """ [affinity, rmsd lower bound, rmsd upper bound] of every mode in a Vina output. """
+    return [[float(value) for value in match.groups()] for match in MODE.finditer(pdbqt)]
+
+class PoseArchive():
+    """ The docked poses of one submission in a single file instead of one
+        PDBQT file per receptor.
+
+        `path` holds every pose as its own gzip member, so the whole file is
+        a valid .pdbqt.gz and each pose can be read on its own. `path`.index
+        has one JSON line per pose: the receptor, where its member starts and
+        how long it is, and the affinity and RMSDs of every mode. Workers on
+        other hosts may append to the same archive, writers hold an exclusive
+        flock on the data file and readers a shared one. A receptor docked
+        again (e.g. refined after a screen) appends a new pose, the last one
+        counts.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.indexPath = path + ".index"
+        self.index = None
+        self.indexSize = -1
+
+    @staticmethod
+    def pathFor(fullLigandPath: str) -> str:
+        """ The archive of the submission docking this ligand, next to it. """
+        return os.path.splitext(fullLigandPath)[0] + "_poses.pdbqt.gz"
+
+    @contextmanager
+    def locked(self, mode: str, operation: int):
+        with open(self.path, mode) as file:
+            fcntl.flock(file, operation)
+            try:
+                yield file
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def add(self, receptor, posePath: str) -> dict:
+        """ Appends the Vina output at `posePath` as the pose of `receptor`. """
+        with open(posePath, "r") as file:
+            pdbqt = file.read()
+        member = gzip.compress(pdbqt.encode(), mtime=0)
+        with self.locked("ab", fcntl.LOCK_EX) as data:
+            entry = {"receptor": str(receptor), "offset": data.seek(0, os.SEEK_END), "length": len(member),
+                     "modes": readModes(pdbqt)}
+            data.write(member)
+            data.flush()
+            os.fsync(data.fileno())
+            # the pose is only found once its index line is complete
+            with open(self.indexPath, "a+") as index:
+                if index.tell() > 0:
+                    index.seek(index.tell() - 1)
+                    if index.read(1) != "\n":
+                        # a writer died halfway through its line
+                        index.write("\n")
+                index.write(json.dumps(entry) + "\n")
+        return entry
+
+    def entries(self) -> dict:
+        """ The index by receptor id, reread only when it grew. """
+        try:
+            size = os.path.getsize(self.indexPath)
+        except FileNotFoundError:
+            return {}
+        if size != self.indexSize:
+            index = {}
+            with open(self.indexPath, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    index[entry["receptor"]] = entry
+            self.index, self.indexSize = index, size
+        return self.index
+
+    def modes(self, receptor) -> list:
+        return self.entries()[str(receptor)]["modes"]
+
+    def get(self, receptor) -> str:
+        """ The PDBQT Vina wrote for `receptor`, KeyError if it was not archived. """
+        with self.locked("rb", fcntl.LOCK_SH) as data:
+            entry = self.entries()[str(receptor)]
+            data.seek(entry["offset"])
+            return gzip.decompress(data.read(entry["length"])).decode()
+
+    def extract(self, receptor, outputPath: str) -> str:
+        """ Recreates the PDBQT file of `receptor` at `outputPath`. """
+        with open(outputPath, "w") as file:
+            file.write(self.get(receptor))
+        return outputPath
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="PoseArchive",
+        description="Lists the poses in a submission's pose archive or recreates their PDBQT files"
+    )
+    parser.add_argument("archive", help="The _poses.pdbqt.gz file")
+    parser.add_argument("receptor", nargs="?", help="Receptor id to extract, lists the archive when omitted")
+    parser.add_argument("--out", help="PDBQT file to write, stdout when omitted")
+    args = parser.parse_args()
+
+    archive = PoseArchive(args.archive)
+    if args.receptor is None:
+        for receptor, entry in archive.entries().items():
+            best = entry["modes"][0][0] if entry["modes"] else None
+            print(f"{receptor}\t{len(entry['modes'])}\t{best}")
+    elif args.out:
+        archive.extract(args.receptor, args.out)
+    else:
+        sys.stdout.write(archive.get(args.receptor))
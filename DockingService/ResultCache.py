@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+from WorkerRuntime import FileCache, placeFile
+
+class ResultCache(FileCache):
+    """ Content-addressed on-disk cache of docking results.
+
+        Entries are keyed by a hash of the ligand, receptor and config file(s)
+        contents plus the exhaustiveness, and hold the affinity, the winning
+        pocket and the pose file. The least recently used entries are evicted
+        once `max_bytes` is exceeded.
+    """
+    def __init__(self, path: str, maxBytes: int):
+        super().__init__(path, "docking_result", "DockingService.ResultCache", maxBytes=maxBytes)
+
+    def key(self, fullLigandPath, fullReceptorPath, fullConfigPaths, exhaustiveness) -> str:
+        digest = hashlib.sha256()
+        for path in (fullLigandPath, fullReceptorPath, *fullConfigPaths):
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+        digest.update(str(exhaustiveness).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str, outputPath: str):
+        """ Returns the cached result ({"affinity": ..., "pocket": ...}) and
+            places the cached pose at `outputPath`, or None on a miss.
+        """
+        entry = self.entry(key)
+        try:
+            with open(os.path.join(entry, "result.json"), "r") as file:
+                result = json.load(file)
+            if not isinstance(result, dict) or not isinstance(result.get("affinity"), (int, float)):
+                raise ValueError(f"{key} holds no affinity")
+            placeFile(os.path.join(entry, "pose.pdbqt"), outputPath)
+            self.hit(key)
+        except (OSError, ValueError):
+            self.miss()
+            return None
+        return result
+
+    def put(self, key: str, affinity: float, posePath: str, pocket: int = None):
+        self.store(key, {"pose.pdbqt": posePath}, {"result.json": {"affinity": affinity, "pocket": pocket}})
@@ -0,0 +1,39 @@
+from time import time
+import heapq
+import itertools
+
+class Scheduler():
+    """ Orders the tasks a worker has prefetched shortest expected job first.
+
+        A task that has waited longer than `maxWait` seconds is taken next
+        regardless of its cost, oldest first, so large tasks cannot starve
+        behind a steady stream of small ones.
+    """
+    def __init__(self, maxWait: float):
+        self.maxWait = maxWait
+        self.byCost = []
+        self.byAge = []
+        self.pending = {}
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, cost: float, task):
+        entry = next(self.sequence)
+        self.pending[entry] = task
+        heapq.heappush(self.byCost, (cost, entry))
+        heapq.heappush(self.byAge, (time(), entry))
+
+    def pop(self):
+        """ The next task to run, or None when there is none. """
+        # an entry taken through one heap stays in the other until it surfaces
+        for heap in (self.byCost, self.byAge):
+            while heap and heap[0][1] not in self.pending:
+                heapq.heappop(heap)
+        if not self.pending:
+            return None
+        queuedAt, entry = self.byAge[0]
+        if time() - queuedAt <= self.maxWait:
+            _, entry = self.byCost[0]
+        return self.pending.pop(entry)
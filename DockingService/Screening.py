@@ -0,0 +1,47 @@
+import heapq
+import math
+
+class Screening():
+    """ Online ranking of the first, low-exhaustiveness stage of a two-stage
+        screen of one submission. Keeps the K best affinities in a heap as
+        results come in and decides which receptors are re-docked at full
+        exhaustiveness: the K best plus every receptor within `margin`
+        kcal/mol of the best one.
+    """
+    def __init__(self, submission: str, topK: int, margin=None):
+        self.submission = submission
+        self.topK = topK
+        self.margin = margin
+        self.best = []
+        self.results = {}
+        self.bestAffinity = math.inf
+
+    def add(self, result):
+        receptor = result["message"]["receptor"]
+        self.results[receptor] = result
+        if not result["message"]["success"]:
+            return
+        affinity = result["message"]["affinity"]
+        self.bestAffinity = min(self.bestAffinity, affinity)
+        if self.topK <= 0:
+            return
+        # max-heap of the K lowest affinities, the worst of them on top
+        entry = (-affinity, receptor)
+        if len(self.best) < self.topK:
+            heapq.heappush(self.best, entry)
+        elif entry > self.best[0]:
+            heapq.heapreplace(self.best, entry)
+
+    def cutoff(self) -> float:
+        """ Affinity a receptor currently has to beat to be among the K best. """
+        if len(self.best) < self.topK:
+            return math.inf
+        return -self.best[0][0]
+
+    def selected(self) -> set:
+        receptors = {receptor for _, receptor in self.best}
+        if self.margin is not None:
+            receptors |= {receptor for receptor, result in self.results.items()
+                          if result["message"]["success"]
+                          and result["message"]["affinity"] <= self.bestAffinity + self.margin}
+        return receptors
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import threading
+import os
+import logging
+from vina import Vina
+from Docker import readBox
+
+class VinaEngine():
+    """ Docks with the Vina Python bindings instead of starting the binary
+        for every task, and keeps the last `maxReceptors` receptors loaded
+        with their grid maps computed.
+
+        A Vina object holds one ligand at a time, so every loaded receptor is
+        checked out by a single task while it docks; concurrent tasks against
+        the same receptor get their own copy.
+    """
+    def __init__(self, config, maxReceptors: int):
+        self.logger = logging.getLogger("DockingService.VinaEngine")
+        self.config = config
+        self.maxReceptors = maxReceptors
+        self.lock = threading.Lock()
+        self.idle = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fullReceptorPath, fullConfigPath, maps):
+        # a re-prepared receptor or box gets a new modification time
+        return (fullReceptorPath, os.path.getmtime(fullReceptorPath),
+                fullConfigPath, os.path.getmtime(fullConfigPath), maps)
+
+    def acquire(self, key, cpus: int) -> Vina:
+        with self.lock:
+            loaded = self.idle.get(key)
+            if loaded:
+                self.hits += 1
+                return loaded.pop()
+            self.misses += 1
+        fullReceptorPath, _, fullConfigPath, _, maps = key
+        self.logger.info(f"Loading receptor {fullReceptorPath} ({self.hits} hits, {self.misses} misses)")
+        vina = Vina(sf_name="vina", cpu=cpus, verbosity=0)
+        if maps is not None:
+            vina.load_maps(maps)
+        else:
+            center, size = readBox(fullConfigPath)
+            vina.set_receptor(fullReceptorPath)
+            vina.compute_vina_maps(center=center, box_size=size)
+        return vina
+
+    def release(self, key, vina: Vina):
+        with self.lock:
+            self.idle.setdefault(key, []).append(vina)
+            self.idle.move_to_end(key)
+            while len(self.idle) > self.maxReceptors:
+                evicted, _ = self.idle.popitem(last=False)
+                self.logger.debug(f"Unloaded receptor {evicted[0]}")
+
+    def dock(self, fullLigandPath, fullReceptorPath, fullConfigPath, exhaustiveness, cpus, outputPath, maps=None) -> float:
+        """ Docks the ligand and writes the poses to `outputPath`. Returns
+            the affinity of the best pose.
+        """
+        key = self.key(fullReceptorPath, fullConfigPath, maps)
+        vina = self.acquire(key, cpus)
+        # on failure the object may be half way through a ligand and is dropped
+        vina.set_ligand_from_file(fullLigandPath)
+        vina.dock(exhaustiveness=exhaustiveness)
+        vina.write_poses(outputPath, energy_range=5, overwrite=True)
+        affinity = float(vina.energies(n_poses=1)[0][0])
+        self.release(key, vina)
+        return affinity
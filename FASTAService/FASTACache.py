@@ -0,0 +1,45 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import logging
+from WorkerRuntime import METRICS
+
+class FASTACache():
+    """ In-memory LRU of extracted sequences keyed by a hash of the file
+        content, so the same receptor uploaded again is answered immediately.
+    """
+    def __init__(self, maxEntries: int):
+        self.logger = logging.getLogger("FASTAService.FASTACache")
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                METRICS.cacheLookup("fasta", False)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        METRICS.cacheLookup("fasta", True)
+        self.logger.info(f"Cache hit for {key} ({self.hits} hits, {self.misses} misses)")
+        return value
+
+    def put(self, key: str, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
@@ -1,17 +1,128 @@
 import subprocess
+import asyncio
+import os
 import logging
+from WorkerRuntime import METRICS
+
+# Three-letter residue names to one-letter codes, including the protonation
+# variants written by PDB2PQR/MGLTools and common modified residues.
+THREE_TO_ONE = {
+    "ALA": "A", "ARG": "R", "ASN": "N", "ASP": "D", "CYS": "C",
+    "GLN": "Q", "GLU": "E", "GLY": "G", "HIS": "H", "ILE": "I",
+    "LEU": "L", "LYS": "K", "MET": "M", "PHE": "F", "PRO": "P",
+    "SER": "S", "THR": "T", "TRP": "W", "TYR": "Y", "VAL": "V",
+    "SEC": "U", "PYL": "O", "MSE": "M", "ASX": "B", "GLX": "Z",
+    "HID": "H", "HIE": "H", "HIP": "H", "HSD": "H", "HSE": "H", "HSP": "H",
+    "CYX": "C", "CYM": "C", "ASH": "D", "GLH": "E", "LYN": "K",
+}
+
+# Formats read by the native parser, everything else goes through OpenBabel
+NATIVE_EXTENSIONS = (".pdb", ".pdbqt", ".ent")
+
+def parseChains(path: str) -> dict:
+    """ Sequence per chain from the SEQRES records of a PDB/PDBQT file, or
+        from its CA atoms when there are none. Empty if neither is present.
+    """
+    seqres = {}
+    atoms = {}
+    lastResidue = {}
+    with open(path, "r", errors="replace") as file:
+        for line in file:
+            # truncated lines have no chain column, they count as chain " "
+            line = line.rstrip("\r\n")
+            if line.startswith("SEQRES"):
+                names = line[19:].split()
+                if names:
+                    seqres.setdefault(line[11:12] or " ", []).extend(names)
+            elif line.startswith("ATOM") or line.startswith("HETATM"):
+                residue = line[17:20].strip()
+                if line[12:16].strip() != "CA" or (line.startswith("HETATM") and residue not in THREE_TO_ONE):
+                    continue
+                chain = line[21:22] or " "
+                # alternate locations repeat the CA of the same residue
+                if lastResidue.get(chain) == line[22:27]:
+                    continue
+                lastResidue[chain] = line[22:27]
+                atoms.setdefault(chain, []).append(residue)
+    residues = seqres or atoms
+    return {chain: "".join(THREE_TO_ONE.get(r, "X") for r in names) for chain, names in residues.items()}
+
+def parseOpenBabelOutput(result: str) -> str:
+    return "".join(result.split('\n')[1:])
 
 class FASTAGenerator():
     def __init__(self, config):
         self.logger = logging.getLogger("FASTAService.FASTAGenerator")
         self.config = config
 
+    def getChains(self, path: str) -> dict:
+        return parseChains(path)
+
     def getFASTA(self, path: str) -> str:
-        self.logger.info("Generating FASTA using OpenBabel")
-        result = subprocess.run([self.config["babelpath"], path, "-ofasta"], capture_output=True, text=True).stdout
+        return self.getFASTAChains(path)[0]
+
+    def fromChains(self, path: str, chains: dict):
+        """ The result for the natively parsed `chains`, None when the file
+            has none and OpenBabel has to be used.
+        """
+        if not chains:
+            self.logger.info(f"No SEQRES or CA records in {path}")
+            return None
+        fasta = "".join(chains.values())
+        self.logger.info(f"Extracted FASTA: {fasta}")
+        return fasta, chains
+
+    def readOpenBabelOutput(self, result: str) -> str:
         if result == "":
             return ""
         self.logger.info(f"OpenBabel output:\n{result}")
-        fasta = "".join(result.split('\n')[1:])
+        fasta = parseOpenBabelOutput(result)
         self.logger.info(f"Extracted FASTA: {fasta}")
         return fasta
+
+    def getFASTAChains(self, path: str):
+        """ Returns the sequence of all chains and the sequence per chain. The
+            per chain sequences are empty when OpenBabel had to be used.
+        """
+        if os.path.splitext(path)[1].lower() in NATIVE_EXTENSIONS:
+            try:
+                with METRICS.stage("parse"):
+                    chains = self.getChains(path)
+            except OSError as e:
+                self.logger.error(f"Could not read {path}: {e}")
+                return "", {}
+            result = self.fromChains(path, chains)
+            if result is not None:
+                return result
+        return self.getFASTAOpenBabel(path), {}
+
+    def getFASTAOpenBabel(self, path: str) -> str:
+        self.logger.info("Generating FASTA using OpenBabel")
+        with METRICS.stage("openbabel"):
+            result = subprocess.run([self.config["babelpath"], path, "-ofasta"], capture_output=True, text=True).stdout
+        return self.readOpenBabelOutput(result)
+
+    async def getFASTAChainsAsync(self, path: str, executor=None):
+        """ Like getFASTAChains, but parses in `executor` and runs OpenBabel
+            as an asyncio subprocess, so many files can be handled at once.
+        """
+        if os.path.splitext(path)[1].lower() in NATIVE_EXTENSIONS:
+            try:
+                with METRICS.stage("parse"):
+                    chains = await asyncio.get_running_loop().run_in_executor(executor, parseChains, path)
+            except OSError as e:
+                self.logger.error(f"Could not read {path}: {e}")
+                return "", {}
+            result = self.fromChains(path, chains)
+            if result is not None:
+                return result
+        return await self.getFASTAOpenBabelAsync(path), {}
+
+    async def getFASTAOpenBabelAsync(self, path: str) -> str:
+        self.logger.info("Generating FASTA using OpenBabel")
+        with METRICS.stage("openbabel"):
+            babel = await asyncio.create_subprocess_exec(self.config["babelpath"], path, "-ofasta",
+                                                         stdout=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.DEVNULL)
+            stdout, _ = await babel.communicate()
+        return self.readOpenBabelOutput(stdout.decode())
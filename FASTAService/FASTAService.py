@@ -1,28 +1,22 @@
-from kombu import Connection, Exchange, Queue, Producer
-from kombu.mixins import ConsumerProducerMixin
+from kombu import Exchange, Queue
 import json
-from time import sleep
-from random import uniform
 from FASTAGenerator import FASTAGenerator
-import logging
+from FASTACache import FASTACache
+from WorkerRuntime import METRICS, ServiceWorker, setup_mq, HEARTBEAT
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from queue import SimpleQueue, Empty
+import asyncio
+import threading
 import yaml
 import argparse
 
-def initialize_logging(mod_name):
-    logger = logging.getLogger(mod_name)
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        '%(asctime)s [%(name)-12s] %(levelname)-8s %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
-    return logger
-
-def createResultMessage(id: str, fasta: str):
+def createResultMessage(id: str, fasta: str, chains: dict):
     message = {
         "message": {
             "id": id,
-            "FASTA": fasta
+            "FASTA": fasta,
+            "chains": chains
         },
         "messageType": [
             "urn:message:AsyncAPI.Models:FASTAResult"
@@ -30,35 +24,112 @@ def createResultMessage(id: str, fasta: str):
     }
     return message
 
-class Worker(ConsumerProducerMixin):
+class Worker(ServiceWorker):
     def __init__(self, connection, queues, config):
-        self.connection = connection
-        self.queues = queues
-        self.logger = initialize_logging("FASTAService")
-        self.config = config
+        super().__init__(connection, queues, config, "FASTAService")
+        self.cache = None
+        if config.get("cache", {}).get("max_entries", 0) > 0:
+            self.cache = FASTACache(config["cache"]["max_entries"])
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=self.queues, callbacks=[self.on_message])]
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=self.config.get("worker", {}).get("prefetch", 1))]
+
+    def lookup(self, path):
+        """ Returns the cache key of the file and the cached sequences, if any. """
+        if self.cache is None:
+            return None, None
+        try:
+            key = FASTACache.key(path)
+        except OSError as e:
+            self.logger.warning(f"Could not hash {path}: {e}")
+            return None, None
+        return key, self.cache.get(key)
+
+    def remember(self, key, fasta, chains):
+        if key is not None and fasta != "":
+            self.cache.put(key, (fasta, chains))
+
+    def publishResult(self, body, result):
+        self.logger.info(f"Publishing result for message {body}")
+        self.publish(json.dumps(result), "AsyncAPI.Models:FASTAResult")
 
     def on_message(self, body, message):
         generator = FASTAGenerator(self.config)
         self.logger.info(f"Received message {body}")
-        result = createResultMessage(body["id"], generator.getFASTA(body["path"]))
-        self.logger.info(f"Publishing result for message {body}")
-        self.producer.publish(
-            json.dumps(result), exchange="AsyncAPI.Models:FASTAResult", retry=True
-        )
-        message.ack()
+        self.received(message)
+        key, cached = self.lookup(body["path"])
+        if cached is not None:
+            fasta, chains = cached
+        else:
+            with METRICS.inFlight("fasta"):
+                fasta, chains = generator.getFASTAChains(body["path"])
+            self.remember(key, fasta, chains)
+        self.publishResult(body, createResultMessage(body["id"], fasta, chains))
+        METRICS.inc("worker_messages_total", outcome="ok" if fasta != "" else "empty")
+        self.ack(message)
+
+class AsyncWorker(Worker):
+    """ Handles up to `worker.concurrency` messages at once on an asyncio
+        loop running in a background thread. Native parsing runs in a process
+        pool of `worker.parsers` processes so it scales with cores; OpenBabel
+        fallbacks run as asyncio subprocesses. The parsers are started by a
+        forkserver, never forked from this threaded process. Results are published and messages acked back on the
+        consumer thread, since kombu channels must not be shared across threads.
+    """
+    def __init__(self, connection, queues, config):
+        super().__init__(connection, queues, config)
+        self.concurrency = config["worker"]["concurrency"]
+        self.completed = SimpleQueue()
+        self.parsers = ProcessPoolExecutor(max_workers=config["worker"].get("parsers") or None,
+                                           mp_context=multiprocessing.get_context("forkserver"))
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.thread = threading.Thread(target=self.loop.run_forever, name="fasta-loop", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Running up to {self.concurrency} FASTA extractions at once")
 
-def setup_mq(host):
-    connection = Connection(host, heartbeat=20)
-    channel = connection.channel()
-    exchange = Exchange("AsyncAPI.Models:FASTAResult", "fanout", channel=channel)
-    exchange.declare()
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=max(self.concurrency, self.config["worker"].get("prefetch", 1)))]
 
-    Queue("FASTAResult", exchange=exchange, channel=channel).declare()
+    async def extract(self, body):
+        generator = FASTAGenerator(self.config)
+        async with self.semaphore:
+            key, cached = await self.loop.run_in_executor(None, self.lookup, body["path"])
+            if cached is not None:
+                fasta, chains = cached
+            else:
+                with METRICS.inFlight("fasta"):
+                    fasta, chains = await generator.getFASTAChainsAsync(body["path"], self.parsers)
+                self.remember(key, fasta, chains)
+        return createResultMessage(body["id"], fasta, chains)
 
-    return connection, channel, exchange
+    def on_message(self, body, message):
+        self.logger.info(f"Received message {body}")
+        self.received(message)
+        future = asyncio.run_coroutine_threadsafe(self.extract(body), self.loop)
+        future.add_done_callback(lambda f: self.completed.put((message, body, f)))
+
+    def on_iteration(self):
+        while True:
+            try:
+                message, body, future = self.completed.get_nowait()
+            except Empty:
+                break
+            try:
+                result = future.result()
+            except Exception as e:
+                self.logger.error(f"FASTA extraction crashed: {e}")
+                result = createResultMessage(body["id"], "", {})
+            self.publishResult(body, result)
+            METRICS.inc("worker_messages_total", outcome="ok" if result["message"]["FASTA"] != "" else "empty")
+            self.ack(message)
+        super().on_iteration()
+
+    def on_consume_end(self, connection, channel):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.parsers.shutdown()
+        super().on_consume_end(connection, channel)
 
 
 if __name__ == "__main__":
@@ -77,10 +148,15 @@ if __name__ == "__main__":
         with open("config.yml", 'r') as f:
             config = yaml.safe_load(f)
 
-    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"])
+    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"], "FASTAResult",
+                                             config.get("messaging", {}).get("heartbeat", HEARTBEAT))
+
+    if config.get("metrics", {}).get("port"):
+        METRICS.serve(config["metrics"]["port"])
 
-    worker = Worker(connection,
+    concurrent = config.get("worker", {}).get("concurrency", 0) > 0
+    worker = (AsyncWorker if concurrent else Worker)(connection,
                     [Queue("FASTATask",
                      exchange=Exchange("AsyncAPI.Models:FASTATask", "fanout"))],
                     config)
-    worker.run()
+    worker.run(safety_interval=0.05 if concurrent else 1)
@@ -0,0 +1,125 @@
+from time import time
+import bisect
+import heapq
+import math
+
+def histogramEdges(low: float, high: float, width: float) -> list:
+    return [low + i * width for i in range(int(round((high - low) / width)) + 1)]
+
+class Leaderboard():
+    """ Running results of one submission, built from its DockingResults
+        as they come in: the K best hits in a heap, the count, mean and
+        spread of the affinities and an affinity histogram. Only the receptor
+        ids are kept of every result, to tell redeliveries apart.
+
+        counts[0] of the histogram holds affinities below edges[0],
+        counts[i] those in [edges[i-1], edges[i]) and counts[-1] those from
+        edges[-1] up. The submission is complete once results for
+        `expected` receptors are in; DockingResults carry their
+        submission's receptorCount when its DockingTasks set it.
+    """
+    def __init__(self, submission: str, topK: int, edges: list, expected: int = None):
+        self.submission = submission
+        self.topK = topK
+        self.edges = list(edges)
+        self.expected = expected
+        # max-heap of the K lowest affinities, the worst of them on top
+        self.best = []
+        self.outcomes = {}
+        self.failed = 0
+        self.succeeded = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.lowest = math.inf
+        self.highest = -math.inf
+        self.counts = [0] * (len(self.edges) + 1)
+        self.updated = time()
+        self.changed = False
+
+    def add(self, result) -> bool:
+        """ Adds a DockingResult, False when it changed nothing. A receptor
+            counts once, a failure is only replaced by a later success.
+        """
+        message = result["message"]
+        receptor = str(message["receptor"])
+        if message.get("receptorCount"):
+            self.expected = message["receptorCount"]
+        previous = self.outcomes.get(receptor)
+        if previous is True or (previous is False and not message["success"]):
+            return False
+        self.outcomes[receptor] = bool(message["success"])
+        self.updated = time()
+        self.changed = True
+        if not message["success"]:
+            self.failed += 1
+            return True
+        if previous is False:
+            self.failed -= 1
+        affinity = message["affinity"]
+        self.succeeded += 1
+        delta = affinity - self.mean
+        self.mean += delta / self.succeeded
+        self.m2 += delta * (affinity - self.mean)
+        self.lowest = min(self.lowest, affinity)
+        self.highest = max(self.highest, affinity)
+        self.counts[bisect.bisect_right(self.edges, affinity)] += 1
+        if self.topK <= 0:
+            return True
+        hit = {"receptor": message["receptor"], "affinity": affinity, "outputPath": message.get("outputPath"),
+               "pocket": message.get("pocket"), "stage": message.get("stage"), "archived": message.get("archived", False)}
+        entry = (-affinity, receptor, hit)
+        if len(self.best) < self.topK:
+            heapq.heappush(self.best, entry)
+        elif entry[:2] > self.best[0][:2]:
+            heapq.heapreplace(self.best, entry)
+        return True
+
+    @property
+    def received(self) -> int:
+        return len(self.outcomes)
+
+    def complete(self) -> bool:
+        return self.expected is not None and self.received >= self.expected
+
+    def snapshot(self) -> dict:
+        found = self.succeeded > 0
+        return {
+            "submission": self.submission,
+            "received": self.received,
+            "expected": self.expected,
+            "completion": min(1.0, self.received / self.expected) if self.expected else None,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "best": [hit for _, _, hit in sorted(self.best, key=lambda entry: (-entry[0], entry[1]))],
+            "affinity": {
+                "min": self.lowest if found else None,
+                "max": self.highest if found else None,
+                "mean": self.mean if found else None,
+                "stddev": math.sqrt(self.m2 / self.succeeded) if found else None
+            },
+            "histogram": {"edges": self.edges, "counts": self.counts}
+        }
+
+    def state(self) -> dict:
+        """ Everything needed to continue the leaderboard after a restart. """
+        return {"submission": self.submission, "topK": self.topK, "edges": self.edges, "expected": self.expected,
+                "best": [hit for _, _, hit in self.best], "outcomes": self.outcomes, "failed": self.failed,
+                "succeeded": self.succeeded, "mean": self.mean, "m2": self.m2,
+                "lowest": self.lowest if self.succeeded else None, "highest": self.highest if self.succeeded else None,
+                "counts": self.counts, "updated": self.updated}
+
+    @classmethod
+    def fromState(cls, state: dict):
+        board = cls(state["submission"], state["topK"], state["edges"], state["expected"])
+        board.best = [(-hit["affinity"], str(hit["receptor"]), hit) for hit in state["best"]]
+        heapq.heapify(board.best)
+        board.outcomes = state["outcomes"]
+        board.failed = state["failed"]
+        board.succeeded = state["succeeded"]
+        board.mean = state["mean"]
+        board.m2 = state["m2"]
+        if state["succeeded"]:
+            board.lowest, board.highest = state["lowest"], state["highest"]
+        board.counts = state["counts"]
+        board.updated = state["updated"]
+        return board
@@ -0,0 +1,161 @@
+import os
+from kombu import Exchange, Queue
+from collections import OrderedDict
+from time import time, monotonic
+import json
+from Leaderboard import Leaderboard, histogramEdges
+from WorkerRuntime import cancellationQueue, METRICS, ServiceWorker, setup_mq, HEARTBEAT
+import yaml
+import argparse
+
+def createUpdateMessage(snapshot: dict, final: bool, timedOut: bool = False):
+    message = {
+        "message": dict(snapshot, final=final, timedOut=timedOut),
+        "messageType": [
+            "urn:message:AsyncAPI.Models:LeaderboardUpdate"
+        ]
+    }
+    return message
+
+class Worker(ServiceWorker):
+    """ Keeps a Leaderboard per submission from the DockingResults and
+        publishes it as a LeaderboardUpdate at most every `interval` seconds
+        while results come in, and a final one once every receptor is in or
+        none came for `idle_timeout` seconds. A submission is only known to
+        be complete when its DockingResults carry a receptorCount, so the
+        producer of its DockingTasks must set it; without it the final
+        update always comes after `idle_timeout` and has timedOut set.
+
+        Results are acked once the leaderboards holding them were saved to
+        `state_path`, so a restarted service continues where it stopped. Run
+        a single instance, leaderboards are not shared between instances.
+    """
+    def __init__(self, connection, queues, config):
+        super().__init__(connection, queues, config, "LeaderboardService")
+        settings = config["leaderboard"]
+        self.topK = settings["topK"]
+        self.interval = settings["interval"]
+        self.idleTimeout = settings["idle_timeout"]
+        self.prefetch = settings["prefetch"]
+        self.edges = histogramEdges(settings["histogram"]["min"], settings["histogram"]["max"],
+                                    settings["histogram"]["width"])
+        self.statePath = settings.get("state_path") or None
+        if self.statePath is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.statePath)), exist_ok=True)
+        self.finishedTtl = config.get("cancellation", {}).get("ttl", 86400)
+        self.boards = {}
+        # submissions already summarized or cancelled, late results for them are dropped
+        self.finished = OrderedDict()
+        self.pending = []
+        self.lastUpdate = monotonic()
+        self.cancellationQueue = cancellationQueue()
+        self.restore()
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=self.prefetch),
+                Consumer(queues=[self.cancellationQueue], callbacks=[self.on_cancel], no_ack=True)]
+
+    def restore(self):
+        if self.statePath is None or not os.path.exists(self.statePath):
+            return
+        with open(self.statePath, "r") as file:
+            state = json.load(file)
+        self.boards = {board["submission"]: Leaderboard.fromState(board) for board in state["boards"]}
+        self.finished = OrderedDict(state["finished"])
+        for board in self.boards.values():
+            # the service being down does not make a submission idle
+            board.updated = time()
+        self.logger.info(f"Restored {len(self.boards)} leaderboards from {self.statePath}")
+
+    def save(self):
+        if self.statePath is None:
+            return
+        state = {"boards": [board.state() for board in self.boards.values()], "finished": list(self.finished.items())}
+        staging = self.statePath + ".tmp"
+        with open(staging, "w") as file:
+            json.dump(state, file)
+        os.replace(staging, self.statePath)
+
+    def markFinished(self, submission: str):
+        self.finished[submission] = time()
+        self.finished.move_to_end(submission)
+        while self.finished and next(iter(self.finished.values())) < time() - self.finishedTtl:
+            self.finished.popitem(last=False)
+
+    def on_cancel(self, body, message):
+        self.logger.info(f"Submission {body['submissionId']} was cancelled")
+        self.boards.pop(body["submissionId"], None)
+        self.markFinished(body["submissionId"])
+
+    def on_message(self, body, message):
+        self.received(message)
+        self.pending.append(message)
+        result = json.loads(body) if isinstance(body, (str, bytes)) else body
+        submission = result["message"]["submission"]
+        if submission in self.finished:
+            self.logger.debug(f"Dropping late result for submission {submission}")
+            METRICS.inc("worker_messages_total", outcome="dropped")
+            return
+        board = self.boards.get(submission)
+        if board is None:
+            board = self.boards[submission] = Leaderboard(submission, self.topK, self.edges)
+        METRICS.inc("worker_messages_total", outcome="ok" if board.add(result) else "duplicate")
+
+    def publishBoard(self, board: Leaderboard, final: bool, timedOut: bool = False):
+        board.changed = False
+        self.publish(json.dumps(createUpdateMessage(board.snapshot(), final, timedOut)),
+                     "AsyncAPI.Models:LeaderboardUpdate")
+
+    def on_iteration(self):
+        due = monotonic() - self.lastUpdate >= self.interval
+        finished = [board for board in self.boards.values()
+                    if board.complete() or time() - board.updated >= self.idleTimeout]
+        for board in finished:
+            timedOut = not board.complete()
+            self.logger.info(f"Publishing final leaderboard of submission {board.submission} "
+                             f"({board.received} of {board.expected} receptors"
+                             f"{', timed out' if timedOut else ''})")
+            self.publishBoard(board, True, timedOut)
+            del self.boards[board.submission]
+            self.markFinished(board.submission)
+        if due:
+            self.lastUpdate = monotonic()
+            for board in self.boards.values():
+                if board.changed:
+                    self.publishBoard(board, False)
+        if finished or (self.pending and (due or len(self.pending) >= self.prefetch)):
+            with METRICS.stage("checkpoint"):
+                self.save()
+            for message in self.pending:
+                self.ack(message)
+            self.pending = []
+        super().on_iteration()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="LeaderboardService",
+        description="Aggregates the DockingResults of each submission into a live leaderboard"
+    )
+    parser.add_argument("--dev", action="store_true", help="Use config_dev.yml")
+    args =  parser.parse_args()
+
+    config = None
+    if args.dev:
+        with open("config_dev.yml", 'r') as f:
+            config = yaml.safe_load(f)
+    else:
+        with open("config.yml", 'r') as f:
+            config = yaml.safe_load(f)
+
+    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"], "LeaderboardUpdate",
+                                             config.get("messaging", {}).get("heartbeat", HEARTBEAT))
+
+    if config.get("metrics", {}).get("port"):
+        METRICS.serve(config["metrics"]["port"])
+
+    worker = Worker(connection,
+                    [Queue("LeaderboardService.DockingResult",
+                     exchange=Exchange("AsyncAPI.Models:DockingResult", "fanout"))],
+                    config)
+    worker.run(safety_interval=0.5)
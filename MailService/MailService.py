@@ -1,78 +1,102 @@
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
-from kombu import Connection, Exchange, Queue, Producer
-from kombu.mixins import ConsumerProducerMixin
-from time import sleep
-from random import uniform
+from kombu import Exchange, Queue
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue, Empty
 import smtplib
-import logging
 import yaml
 import argparse
+from WorkerRuntime import METRICS, ServiceWorker, setup_mq, HEARTBEAT
+from SMTPPool import SMTPPool
 
-def send_mail(msg, config):
-    try:
-        logging.info("Connecting to SMTP")
-        logging.info(config["smtp_server"])
-        logging.info(config["smtp_port"])
-        if config["ssl"]:
-            server = smtplib.SMTP_SSL(config["smtp_server"], config["smtp_port"])
-        else:
-            server = smtplib.SMTP(config["smtp_server"], config["smtp_port"])
-        logging.info("Sending ehlo")
-        server.ehlo()
-        if (config["smtp_login"] != ""):
-            logging.info("Logging in")
-            server.login(config["smtp_login"], config["smtp_pw"])
-        logging.info("Sending msg")
-        server.send_message(msg)
-        logging.info("Msg send!")
-        server.quit()
-    except Exception as e:
-        logging.error(e)
-        return 1
-
-    return 0
-
-def initialize_logging(mod_name):
-    logger = logging.getLogger(mod_name)
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        '%(asctime)s [%(name)-12s] %(levelname)-8s %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
-    return logger
-
-class Worker(ConsumerProducerMixin):
+def createMail(body) -> MIMEMultipart:
+    email = MIMEMultipart("alternative")
+    email["Subject"] = body["subject"]
+    email["From"] = formataddr(('ReverseDock', "findr@biologie.uni-freiburg.de"))
+    email["To"] = body["recipient"]
+    email.attach(MIMEText(body["bodyRaw"], "plain"))
+    email.attach(MIMEText(body["bodyHTML"], "html"))
+    return email
+
+class Worker(ServiceWorker):
+    """ Sends mails one at a time over a single long-lived SMTP session. """
     def __init__(self, connection, queues, config):
-        self.connection = connection
-        self.queues = queues
-        self.logger = initialize_logging("MailService")
-        self.config = config
+        super().__init__(connection, queues, config, "MailService")
+        self.sessions = config.get("smtp_sessions", 1)
+        self.smtp = SMTPPool(config, self.sessions, config.get("smtp_keepalive", 60))
+        self.logger.info(f"Sending mails over {self.sessions} SMTP sessions "
+                         f"on {config['smtp_server']}:{config['smtp_port']}")
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=self.queues, callbacks=[self.on_message])]
+        # every session busy while a whole batch of sent mails waits to be acked
+        prefetch = self.sessions + self.config.get("messaging", {}).get("ack_batch", 1)
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], prefetch_count=prefetch)]
+
+    def send(self, email) -> bool:
+        with METRICS.inFlight("mail"), METRICS.stage("smtp"):
+            try:
+                self.smtp.send(email)
+            except (smtplib.SMTPException, OSError) as e:
+                self.logger.error(f"Could not send mail to {email['To']}: {e}")
+                return False
+        return True
+
+    def settle(self, message, sent: bool):
+        if sent:
+            METRICS.inc("worker_messages_total", outcome="ok")
+            self.ack(message)
+        else:
+            METRICS.inc("worker_messages_total", outcome="failed")
+            self.reject(message)
 
     def on_message(self, body, message):
         self.logger.info(f"Received message {body}")
-        email = MIMEMultipart("alternative")
-        email["Subject"] = body["subject"]
-        email["From"] = formataddr(('ReverseDock', "findr@biologie.uni-freiburg.de"))
-        email["To"] = body["recipient"]
-        email.attach(MIMEText(body["bodyRaw"], "plain"))
-        email.attach(MIMEText(body["bodyHTML"], "html"))
-        if (send_mail(email, self.config) == 0):
-            message.ack()
-        else:
-            message.reject(requeue=False)
-        
+        self.received(message)
+        self.settle(message, self.send(createMail(body)))
+
+    def on_consume_end(self, connection, channel):
+        self.smtp.close()
+        super().on_consume_end(connection, channel)
 
-def setup_mq(host):
-    connection = Connection(host, heartbeat=120)
-    channel = connection.channel()
+class PooledWorker(Worker):
+    """ Sends up to `smtp_sessions` mails at the same time, one per session.
+        Mails are sent on a thread pool; messages are acked back on the
+        consumer thread, since kombu channels must not be shared across threads.
+    """
+    def __init__(self, connection, queues, config):
+        super().__init__(connection, queues, config)
+        self.senders = ThreadPoolExecutor(max_workers=self.sessions, thread_name_prefix="smtp")
+        self.completed = SimpleQueue()
+
+    def on_message(self, body, message):
+        self.logger.info(f"Received message {body}")
+        self.received(message)
+        future = self.senders.submit(self.send, createMail(body))
+        future.add_done_callback(lambda f: self.completed.put((message, f)))
 
-    return connection, channel
+    def settleCompleted(self):
+        while True:
+            try:
+                message, future = self.completed.get_nowait()
+            except Empty:
+                break
+            try:
+                sent = future.result()
+            except Exception as e:
+                self.logger.error(f"Sending mail crashed: {e}")
+                sent = False
+            self.settle(message, sent)
+
+    def on_iteration(self):
+        self.settleCompleted()
+        super().on_iteration()
+
+    def on_consume_end(self, connection, channel):
+        self.senders.shutdown(wait=True)
+        # ack what was sent meanwhile, redelivering it would send it twice
+        self.settleCompleted()
+        super().on_consume_end(connection, channel)
 
 
 if __name__ == "__main__":
@@ -91,10 +115,15 @@ if __name__ == "__main__":
         with open("config.yml", 'r') as f:
             config = yaml.safe_load(f)
 
-    connection, channel = setup_mq(config["service"]["rabbitmq"])
+    connection, channel, exchange = setup_mq(config["service"]["rabbitmq"],
+                                             heartbeat=config.get("messaging", {}).get("heartbeat", HEARTBEAT))
+
+    if config.get("metrics", {}).get("port"):
+        METRICS.serve(config["metrics"]["port"])
 
-    worker = Worker(connection,
+    pooled = config.get("smtp_sessions", 1) > 1
+    worker = (PooledWorker if pooled else Worker)(connection,
                     [Queue("MailTask",
                      exchange=Exchange("AsyncAPI.Models:MailTask", "fanout"))],
                     config)
-    worker.run()
+    worker.run(safety_interval=0.1 if pooled else 1)
@@ -0,0 +1,113 @@
+from time import monotonic
+import threading
+import smtplib
+import logging
+import queue
+
+# Errors after which the connection is gone and a new one may still succeed
+DISCONNECTED = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+class SMTPSession():
+    """ One SMTP connection that stays open and logged in between mails.
+        It connects on first use and again once the server dropped it.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.server = None
+        self.lastUsed = 0.0
+
+    def connect(self):
+        timeout = self.config.get("smtp_timeout", 60)
+        if self.config["ssl"]:
+            server = smtplib.SMTP_SSL(self.config["smtp_server"], self.config["smtp_port"], timeout=timeout)
+        else:
+            server = smtplib.SMTP(self.config["smtp_server"], self.config["smtp_port"], timeout=timeout)
+        try:
+            server.ehlo()
+            if self.config["smtp_login"] != "":
+                server.login(self.config["smtp_login"], self.config["smtp_pw"])
+        except BaseException:
+            server.close()
+            raise
+        self.server = server
+        self.lastUsed = monotonic()
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+
+    def alive(self) -> bool:
+        """ Sends NOOP, which also keeps the server from timing the session out. """
+        try:
+            alive = self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+        self.lastUsed = monotonic()
+        return alive
+
+    def send(self, msg):
+        """ Sends over the open connection and reconnects once if it was lost. """
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.send_message(msg)
+        except DISCONNECTED:
+            self.server.close()
+            self.server = None
+            self.connect()
+            self.server.send_message(msg)
+        self.lastUsed = monotonic()
+
+class SMTPPool():
+    """ `size` SMTPSessions shared by the threads sending mails, so at most
+        `size` mails are sent at the same time. Sessions idle for `keepalive`
+        seconds are sent a NOOP from a background thread; those the server
+        closed meanwhile reconnect when they are used next.
+    """
+    def __init__(self, config, size: int = 1, keepalive: float = 60):
+        self.logger = logging.getLogger("MailService.SMTPPool")
+        self.keepalive = keepalive
+        self.sessions = [SMTPSession(config) for _ in range(size)]
+        self.idle = queue.Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+        self.stopped = threading.Event()
+        self.thread = None
+        if keepalive:
+            self.thread = threading.Thread(target=self.keepAlive, name="smtp-keepalive", daemon=True)
+            self.thread.start()
+
+    def send(self, msg):
+        session = self.idle.get()
+        try:
+            session.send(msg)
+        finally:
+            self.idle.put(session)
+
+    def keepAlive(self):
+        while not self.stopped.wait(self.keepalive / 2):
+            # sessions sending a mail right now are not idle and are skipped
+            for _ in range(len(self.sessions)):
+                try:
+                    session = self.idle.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if session.server is not None and monotonic() - session.lastUsed >= self.keepalive \
+                            and not session.alive():
+                        self.logger.info("SMTP session was closed by the server, reconnecting on next use")
+                        session.close()
+                finally:
+                    self.idle.put(session)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for session in self.sessions:
+            session.close()
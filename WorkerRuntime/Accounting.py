@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+from time import perf_counter
+import threading
+import json
+import sys
+
+def maxRssBytes(rusage) -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+class Accounting():
+    """ Resources used by the external tools of one job, for sizing nodes.
+
+        Every tool invocation is logged to `logger` as one JSON record and
+        summed up by summary(), which goes into the job's result message.
+        CPU time and peak memory come from os.wait4 and include the helpers
+        a tool waited for; on Linux the peak also covers the worker memory
+        the tool started from, so it is an upper bound for tiny tools. Work
+        done in warm pools or in-process is only known by its wall time.
+    """
+    def __init__(self, logger, job=None):
+        self.logger = logger
+        self.job = job
+        self.lock = threading.Lock()
+        self.tools = []
+
+    def record(self, tool: str, wallSeconds: float, rusage=None, outcome: str = "ok"):
+        record = {"tool": tool, "wallSeconds": round(wallSeconds, 3), "outcome": outcome,
+                  "cpuUserSeconds": None, "cpuSystemSeconds": None, "maxRssBytes": None}
+        if rusage is not None:
+            record.update({"cpuUserSeconds": round(rusage.ru_utime, 3),
+                           "cpuSystemSeconds": round(rusage.ru_stime, 3),
+                           "maxRssBytes": maxRssBytes(rusage)})
+        with self.lock:
+            self.tools.append(record)
+        self.logger.info("Resource usage " + json.dumps(dict(record, job=self.job)))
+
+    @contextmanager
+    def timed(self, tool: str):
+        """ Records the wall time of work that is not a process of its own. """
+        start = perf_counter()
+        outcome = "failed"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.record(tool, perf_counter() - start, outcome=outcome)
+
+    def summary(self) -> dict:
+        with self.lock:
+            tools = list(self.tools)
+        measured = [tool for tool in tools if tool["maxRssBytes"] is not None]
+        return {
+            "wallSeconds": round(sum(tool["wallSeconds"] for tool in tools), 3),
+            "cpuUserSeconds": round(sum(tool["cpuUserSeconds"] for tool in measured), 3),
+            "cpuSystemSeconds": round(sum(tool["cpuSystemSeconds"] for tool in measured), 3),
+            "maxRssBytes": max((tool["maxRssBytes"] for tool in measured), default=None),
+            "tools": tools
+        }
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from time import time
+import threading
+import uuid
+import logging
+from kombu import Exchange, Queue
+from WorkerRuntime.Processes import kill
+
+# Fanout exchange cancelled submission ids are broadcast on, {"submissionId": ...}
+CANCEL_EXCHANGE = "ReversedScreening.Cancellation"
+
+def cancellationQueue() -> Queue:
+    """ A queue of this worker's own on the cancellation exchange, so every
+        worker sees every cancellation. It goes away with the worker.
+    """
+    return Queue(f"Cancellation.{uuid.uuid4().hex}", exchange=Exchange(CANCEL_EXCHANGE, "fanout"),
+                 exclusive=True, auto_delete=True)
+
+class Cancellations():
+    """ Cancelled jobs (submission ids) seen by this worker, remembered for
+        `ttl` seconds, and the tool processes currently running for each job,
+        which are killed when their job is cancelled.
+    """
+    def __init__(self, ttl: float = 86400):
+        self.logger = logging.getLogger("WorkerRuntime.Cancellations")
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cancelled = OrderedDict()
+        self.processes = {}
+
+    def cancel(self, job: str):
+        with self.lock:
+            self.cancelled[job] = time()
+            self.cancelled.move_to_end(job)
+            while self.cancelled and next(iter(self.cancelled.values())) < time() - self.ttl:
+                self.cancelled.popitem(last=False)
+            running = list(self.processes.get(job, ()))
+        for process in running:
+            self.logger.info(f"Killing {process.args[0]} (pid {process.pid}) of cancelled {job}")
+            kill(process)
+
+    def isCancelled(self, job: str) -> bool:
+        with self.lock:
+            return job in self.cancelled
+
+    def register(self, job: str, process):
+        with self.lock:
+            self.processes.setdefault(job, set()).add(process)
+
+    def unregister(self, job: str, process):
+        with self.lock:
+            running = self.processes.get(job)
+            if running is not None:
+                running.discard(process)
+                if not running:
+                    del self.processes[job]
@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+import fcntl
+import logging
+from WorkerRuntime.Metrics import METRICS
+
+# ioctl request that clones a file's extents on btrfs/XFS (linux/fs.h)
+FICLONE = 0x40049409
+
+def cloneFile(source: str, destination: str) -> bool:
+    """ Reflinks `source` to `destination`, False where the filesystem cannot. """
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+def placeFile(source: str, destination: str):
+    """ Puts a copy of `source` at `destination`, as a reflink where the
+        filesystem supports it. Never a hardlink: whatever later writes to
+        `destination` must not change `source`.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    if not cloneFile(source, destination):
+        shutil.copyfile(source, destination)
+
+def linkFile(source: str, destination: str):
+    """ Hardlinks `source` to `destination`, falls back to a reflink and
+        finally to a plain copy where the filesystem allows neither. Only
+        for files nothing writes to afterwards.
+    """
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    if not cloneFile(source, destination):
+        shutil.copyfile(source, destination)
+
+def lastUsed(entry: str) -> float:
+    try:
+        return os.path.getmtime(entry)
+    except OSError:
+        return 0
+
+class FileCache():
+    """ Directory of cache entries, one subdirectory of files per key.
+
+        Entries are written to a hidden staging directory and renamed into
+        place, so readers never see half an entry and workers sharing the
+        directory do not overwrite each other. The modification time of an
+        entry is bumped on every hit, so evicting the oldest entries once
+        `maxBytes` or `maxEntries` is exceeded is LRU. Subclasses decide what
+        goes into an entry and how it is keyed; `kind` labels their lookups
+        in the cache metrics.
+    """
+    def __init__(self, path: str, kind: str, loggerName: str, maxBytes: int = None, maxEntries: int = None):
+        self.logger = logging.getLogger(loggerName)
+        self.path = path
+        self.kind = kind
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+        self.size = sum(self.entrySize(e) for e in self.entries()) if maxBytes is not None else 0
+
+    def entries(self):
+        return [os.path.join(self.path, e) for e in os.listdir(self.path) if not e.startswith(".")]
+
+    def entrySize(self, entry) -> int:
+        try:
+            return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        except OSError:
+            return 0
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def hit(self, key: str):
+        """ Counts a hit on `key` and marks its entry as just used. """
+        os.utime(self.entry(key))
+        with self.lock:
+            self.hits += 1
+        METRICS.cacheLookup(self.kind, True)
+        self.logger.info(f"Cache hit for {key} ({self.hits} hits, {self.misses} misses)")
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+        METRICS.cacheLookup(self.kind, False)
+
+    def store(self, key: str, files: dict, meta: dict) -> bool:
+        """ Adds the entry `key` holding a copy of each file in `files` (by
+            name in the entry) and each value of `meta` as a JSON file, then
+            evicts what no longer fits. False when it was not stored.
+        """
+        entry = self.entry(key)
+        staging = os.path.join(self.path, f".{key}.{uuid.uuid4().hex}")
+        try:
+            os.makedirs(staging, exist_ok=True)
+            for name, source in files.items():
+                shutil.copyfile(source, os.path.join(staging, name))
+            for name, value in meta.items():
+                with open(os.path.join(staging, name), "w") as file:
+                    json.dump(value, file)
+            os.rename(staging, entry)
+        except OSError as e:
+            # another worker stored the same entry first, or the disk is full
+            self.logger.debug(f"Not caching {key}: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        with self.lock:
+            self.size += self.entrySize(entry)
+            if self.full():
+                self.evict()
+        return True
+
+    def full(self) -> bool:
+        """ Whether the cache may be over its limits. The entry count is
+            only checked by evict, the size is tracked by this worker.
+        """
+        return self.maxEntries is not None or (self.maxBytes is not None and self.size > self.maxBytes)
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits again.
+            Must be called with the lock held.
+        """
+        entries = sorted(self.entries(), key=lastUsed)
+        sizes = [self.entrySize(e) for e in entries] if self.maxBytes is not None else [0] * len(entries)
+        self.size = sum(sizes)
+        count = len(entries)
+        for entry, size in zip(entries, sizes):
+            if (self.maxBytes is None or self.size <= self.maxBytes) and \
+                    (self.maxEntries is None or count <= self.maxEntries):
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            self.size -= size
+            count -= 1
+            self.logger.debug(f"Evicted {entry}")
@@ -0,0 +1,26 @@
+from functools import lru_cache
+import hashlib
+import os
+
+def mapsKey(fullReceptorPath: str, fullConfigPath: str) -> str:
+    """ Hash of the receptor and box the grid maps in `<config>.maps` were
+        computed for. DockingPrepper writes it next to the maps and
+        DockingService only loads maps whose key still matches. The hash of
+        files unchanged since the last call is reused.
+    """
+    files = tuple((path, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                  for path, stat in ((path, os.stat(path)) for path in (fullReceptorPath, fullConfigPath)))
+    return hashFiles(files)
+
+@lru_cache(maxsize=4096)
+def hashFiles(files: tuple) -> str:
+    """ `files` holds the path of each file with what identifies its contents,
+        so a rewritten file misses the cache.
+    """
+    digest = hashlib.sha256()
+    for path, *_ in files:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from kombu import Connection, Exchange, Queue
+import threading
+import logging
+
+# Seconds between heartbeats on every service connection. Workers that run
+# tools on the consumer thread keep them up with keepalive() meanwhile.
+HEARTBEAT = 60
+
+def initialize_logging(mod_name):
+    logger = logging.getLogger(mod_name)
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter(
+        '%(asctime)s [%(name)-12s] %(levelname)-8s %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+def setup_mq(host, results=None, heartbeat=HEARTBEAT):
+    """ Connects to RabbitMQ and declares the fanout exchange and queue of
+        the service's `results` message type, e.g. "DockingResult".
+    """
+    connection = Connection(host, heartbeat=heartbeat)
+    channel = connection.channel()
+    exchange = None
+    if results is not None:
+        exchange = Exchange(f"AsyncAPI.Models:{results}", "fanout", channel=channel)
+        exchange.declare()
+
+        Queue(results, exchange=exchange, channel=channel).declare()
+
+    return connection, channel, exchange
+
+@contextmanager
+def keepalive(*connections):
+    """ Sends heartbeats on `connections` from a background thread while the
+        calling thread is busy with a long job, so RabbitMQ does not drop
+        them. The calling thread must not use the connections meanwhile.
+    """
+    connections = [connection for connection in connections
+                   if connection is not None and connection.supports_heartbeats and connection.heartbeat]
+    if not connections:
+        yield
+        return
+    logger = logging.getLogger("WorkerRuntime.Messaging")
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(min(connection.heartbeat for connection in connections) / 2):
+            for connection in connections:
+                try:
+                    connection.connection.send_heartbeat()
+                except (OSError,) + connection.connection_errors as e:
+                    logger.warning(f"Could not send heartbeat: {e}")
+
+    thread = threading.Thread(target=beat, name="keepalive", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
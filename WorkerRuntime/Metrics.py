@@ -0,0 +1,159 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+from datetime import datetime
+from time import time, perf_counter
+import bisect
+import threading
+import logging
+
+# Upper bounds of the histogram buckets in seconds, from fast parsers to long dockings
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400)
+
+# What each metric measures, written as HELP lines
+DESCRIPTIONS = {
+    "worker_stage_seconds": "Time spent in one step of handling a message",
+    "worker_queue_wait_seconds": "Time messages waited in RabbitMQ before being received",
+    "worker_publish_seconds": "Time spent publishing result messages",
+    "worker_in_flight": "Jobs currently being worked on",
+    "worker_messages_total": "Messages handled, by outcome",
+    "worker_cache_requests_total": "Cache lookups, by result",
+}
+
+def enqueuedAt(message) -> float:
+    """ When the message was queued: the time stamped by whoever forwarded it
+        internally, else the broker timestamp set by the publisher, else now.
+    """
+    headers = message.headers or {}
+    if "x-enqueued-at" in headers:
+        return float(headers["x-enqueued-at"])
+    timestamp = message.properties.get("timestamp")
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    return time()
+
+def formatLabels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+class Metrics():
+    """ Counters, gauges and histograms in the Prometheus text format.
+
+        Metrics are created on first use and told apart by their labels, e.g.
+        observe("worker_stage_seconds", 1.5, stage="vina"). serve() exposes
+        them on http://<host>:<port>/metrics from a background thread.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger("WorkerRuntime.Metrics")
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.server = None
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add(self, name: str, amount: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """ Observes how long the block took, also when it raises. """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    @contextmanager
+    def inFlight(self, kind: str):
+        self.add("worker_in_flight", 1, kind=kind)
+        try:
+            yield
+        finally:
+            self.add("worker_in_flight", -1, kind=kind)
+
+    def stage(self, stage: str):
+        return self.time("worker_stage_seconds", stage=stage)
+
+    def received(self, message):
+        """ Records how long a message waited in the queue. """
+        self.observe("worker_queue_wait_seconds", max(0.0, time() - enqueuedAt(message)))
+
+    def cacheLookup(self, cache: str, hit: bool):
+        self.inc("worker_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    def total(self, name: str):
+        """ Observations and their sum for a histogram, across all labels. """
+        with self.lock:
+            histograms = [value for (metric, _), value in self.histograms.items() if metric == name]
+        return sum(sum(counts) for counts, _ in histograms), sum(total for _, total in histograms)
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {name} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, "counter")
+                lines.append(f"{name}{formatLabels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                header(name, "gauge")
+                lines.append(f"{name}{formatLabels(labels)} {value}")
+            for (name, labels), (counts, total) in sorted(self.histograms.items()):
+                header(name, "histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{formatLabels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{formatLabels(labels)} {total}")
+                lines.append(f"{name}_count{formatLabels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        self.logger.info(f"Serving metrics on port {port}")
+
+# The registry of this process, shared by every module of a service
+METRICS = Metrics()
@@ -0,0 +1,178 @@
+from collections import OrderedDict, deque
+from kombu import Producer, pools
+from time import time
+import socket
+import logging
+
+class Outbox():
+    """ Publishes results on a pooled connection and acks the messages they
+        answer.
+
+        With `confirms` the broker confirms publishes asynchronously, and a
+        message is only acked or rejected once everything published before
+        it was confirmed: a worker dying in between means a redelivery, not
+        a lost result. Publishes the broker refused, or left unconfirmed on
+        a lost connection, are sent again. With `wait`, settle() blocks
+        until then, for workers that handle one message at a time.
+
+        With `batch` > 1, runs of finished messages are acked at once with
+        multiple=True in delivery order, when `batch` of them are ready or
+        the first has waited `delay` seconds. An ack then covers every
+        earlier delivery on the channel, so each one must be passed to
+        track() first.
+
+        Only for use on the consumer thread, which must call flush()
+        regularly to read confirms and send due acks.
+    """
+    def __init__(self, connection, confirms=True, batch=1, delay=1.0, wait=False):
+        self.logger = logging.getLogger("WorkerRuntime.Outbox")
+        self.connection = pools.connections[connection].acquire(block=True)
+        self.amqp = self.connection.transport.driver_type == "amqp"
+        # the in-memory transport neither confirms nor acks several messages at once
+        self.confirms = confirms and self.amqp
+        self.batch = max(1, batch) if self.amqp else 1
+        self.delay = delay
+        self.wait = wait
+        self.published = 0
+        self.unconfirmed = {}
+        self.sequences = {}
+        self.sequence = 0
+        self.deliveries = OrderedDict()
+        self.settled = deque()
+        self.producer = Producer(self.connection)
+        if self.confirms:
+            self.enableConfirms(self.producer.channel)
+
+    def enableConfirms(self, channel):
+        channel.confirm_select()
+        channel.events["basic_ack"].add(self.on_ack)
+        channel.events["basic_nack"].add(self.on_nack)
+        self.sequence = 0
+        self.sequences = {}
+
+    def publish(self, body, exchange, **kwargs):
+        self.published += 1
+        self.send(self.published, body, exchange, kwargs)
+
+    def send(self, id, body, exchange, kwargs):
+        self.producer.publish(body, exchange=exchange, retry=True, retry_policy={"on_revive": self.revived}, **kwargs)
+        self.sent(id, body, exchange, kwargs)
+
+    def sent(self, id, body, exchange, kwargs):
+        if self.confirms:
+            # confirms count the publishes on a channel from 1
+            self.sequence += 1
+            self.sequences[self.sequence] = id
+            self.unconfirmed[id] = (body, exchange, kwargs)
+
+    def revived(self, channel):
+        """ Called on the channel replacing a lost one, before the failed
+            publish is retried.
+        """
+        if not self.confirms:
+            return
+        self.enableConfirms(channel)
+        self.logger.warning(f"Publishing {len(self.unconfirmed)} unconfirmed messages again")
+        for id, (body, exchange, kwargs) in sorted(self.unconfirmed.items()):
+            self.producer.publish(body, exchange=exchange, **kwargs)
+            self.sent(id, body, exchange, kwargs)
+
+    def confirmed(self, tag, multiple):
+        if multiple:
+            return [sequence for sequence in self.sequences if sequence <= tag]
+        return [tag] if tag in self.sequences else []
+
+    def on_ack(self, tag, multiple):
+        for sequence in self.confirmed(tag, multiple):
+            self.unconfirmed.pop(self.sequences.pop(sequence), None)
+
+    def on_nack(self, tag, multiple):
+        for sequence in self.confirmed(tag, multiple):
+            id = self.sequences.pop(sequence)
+            body, exchange, kwargs = self.unconfirmed.pop(id)
+            self.logger.warning(f"Broker refused a message to {exchange}, publishing it again")
+            self.send(id, body, exchange, kwargs)
+
+    def confirmedUpTo(self) -> int:
+        """ Everything published up to this number was confirmed. """
+        return min(self.unconfirmed) - 1 if self.unconfirmed else self.published
+
+    def track(self, message):
+        if self.batch > 1:
+            self.deliveries[message.delivery_tag] = [message, None]
+
+    def ack(self, message):
+        self.settle(message, True)
+
+    def reject(self, message):
+        self.settle(message, False)
+
+    def settle(self, message, ack: bool):
+        """ Acks or rejects the message once what was published for it is
+            confirmed.
+        """
+        settlement = (ack, self.published, time())
+        if message.delivery_tag in self.deliveries:
+            self.deliveries[message.delivery_tag][1] = settlement
+        else:
+            self.settled.append((message, settlement))
+        if self.wait:
+            while self.confirmedUpTo() < self.published:
+                self.read(timeout=1)
+        # a worker that waits gets no further deliveries to fill a batch
+        self.flush(force=self.wait)
+
+    def read(self, timeout=0):
+        """ Handles confirms and heartbeats that arrived on the connection. """
+        if not self.amqp:
+            return
+        try:
+            while True:
+                self.connection.drain_events(timeout=timeout)
+                timeout = 0
+        except socket.timeout:
+            pass
+        self.connection.heartbeat_check()
+
+    def flush(self, force=False):
+        """ Sends the acks that are due, or with `force` every ack that can
+            be sent.
+        """
+        self.read()
+        upTo = self.confirmedUpTo()
+        while self.settled and self.settled[0][1][1] <= upTo:
+            message, (ack, _, _) = self.settled.popleft()
+            if ack:
+                message.ack()
+            else:
+                message.reject(requeue=False)
+        run = []
+        for message, settlement in list(self.deliveries.values()):
+            if settlement is None or settlement[1] > upTo:
+                break
+            if settlement[0]:
+                run.append((message, settlement))
+                continue
+            self.ackRun(run)
+            run = []
+            del self.deliveries[message.delivery_tag]
+            message.reject(requeue=False)
+        if run and (force or len(run) >= self.batch or time() - run[0][1][2] >= self.delay):
+            self.ackRun(run)
+
+    def ackRun(self, run):
+        if not run:
+            return
+        for message, _ in run:
+            del self.deliveries[message.delivery_tag]
+        run[-1][0].ack(multiple=True)
+
+    def close(self):
+        try:
+            if self.confirms and self.unconfirmed:
+                self.read(timeout=1)
+            self.flush(force=True)
+        except (OSError,) + self.connection.connection_errors + self.connection.channel_errors as e:
+            # the messages are redelivered
+            self.logger.warning(f"Could not settle all messages: {e}")
+        self.connection.release()
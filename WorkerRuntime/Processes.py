@@ -0,0 +1,182 @@
+from time import perf_counter
+import subprocess
+import threading
+import logging
+import queue
+import json
+import os
+import signal
+
+class ProcessError(Exception):
+    def __init__(self, error):
+        self.error = error
+
+class ProcessTimeout(ProcessError):
+    pass
+
+class ProcessCancelled(ProcessError):
+    pass
+
+class AccountedPopen(subprocess.Popen):
+    """ Popen that reaps the process with os.wait4, keeping its resource
+        usage in `rusage`.
+    """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # already reaped, handled like subprocess does
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, status)
+
+def run(command, timeout=None, job=None, cancellations=None, accounting=None, tool=None, **kwargs) -> subprocess.CompletedProcess:
+    """ subprocess.run for external tools that may have to be stopped early.
+
+        The tool runs in its own process group, so helpers it starts die with
+        it. The group is killed once `timeout` seconds (None or 0 for no limit)
+        have passed, raising ProcessTimeout, or once `job` is cancelled in
+        `cancellations`, raising ProcessCancelled. Output is captured as text
+        unless the keyword arguments say otherwise. The wall time, CPU time
+        and peak memory of the tool are recorded in `accounting` under `tool`
+        (the executable's name by default), also when it was killed.
+    """
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    kwargs.setdefault("text", True)
+    if cancellations is not None and job is not None and cancellations.isCancelled(job):
+        raise ProcessCancelled(f"{job} was cancelled before {command[0]} started")
+    started = perf_counter()
+    outcome = "failed"
+    process = AccountedPopen(command, start_new_session=True, **kwargs)
+    if cancellations is not None and job is not None:
+        cancellations.register(job, process)
+        # the cancellation may have arrived while the process was starting
+        if cancellations.isCancelled(job):
+            kill(process)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout or None)
+        outcome = "ok" if process.returncode == 0 else "failed"
+    except subprocess.TimeoutExpired:
+        kill(process)
+        process.communicate()
+        outcome = "timeout"
+        raise ProcessTimeout(f"{command[0]} did not finish within {timeout} seconds")
+    except BaseException:
+        kill(process)
+        process.wait()
+        raise
+    finally:
+        if cancellations is not None and job is not None:
+            cancellations.unregister(job, process)
+            if cancellations.isCancelled(job):
+                outcome = "cancelled"
+        if accounting is not None:
+            accounting.record(tool or os.path.basename(command[0]), perf_counter() - started, process.rusage, outcome)
+    if cancellations is not None and job is not None and cancellations.isCancelled(job):
+        raise ProcessCancelled(f"{command[0]} was stopped because {job} was cancelled")
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+def kill(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # already gone
+        pass
+
+class WarmProcess():
+    """ A long-lived tool process that keeps its libraries loaded and
+        answers one JSON request per line on stdin with one JSON response per
+        line on stdout. Like the tools started by run() it runs in its own
+        session and is killed once a request takes longer than `timeout`
+        seconds or the job of the request is cancelled in `cancellations`.
+        A killed or crashed process is restarted for the next request.
+    """
+    def __init__(self, command, timeout=None, name=None):
+        self.logger = logging.getLogger("WorkerRuntime.WarmProcess")
+        self.command = command
+        self.timeout = timeout or None
+        self.name = name or os.path.basename(command[0])
+        self.process = None
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, bufsize=1, start_new_session=True)
+        self.logger.info(f"Started {self.name} server with pid {self.process.pid}")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                kill(self.process)
+                self.process.wait()
+
+    def request(self, request: dict, job=None, cancellations=None) -> dict:
+        """ Sends `request` and returns the response, raising ProcessTimeout,
+            ProcessCancelled or ProcessError when the process was killed or
+            died before it answered.
+        """
+        if self.process.poll() is not None:
+            self.logger.warning(f"{self.name} server exited with {self.process.returncode}, restarting")
+            self.start()
+        tracked = cancellations is not None and job is not None
+        if tracked:
+            if cancellations.isCancelled(job):
+                raise ProcessCancelled(f"{job} was cancelled before {self.name} started")
+            cancellations.register(job, self.process)
+        timedOut = threading.Event()
+
+        def expire():
+            timedOut.set()
+            kill(self.process)
+
+        watchdog = threading.Timer(self.timeout, expire) if self.timeout else None
+        if watchdog is not None:
+            watchdog.start()
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            response = self.process.stdout.readline()
+        except OSError:
+            response = ""
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if tracked:
+                cancellations.unregister(job, self.process)
+        if response == "":
+            self.process.wait()
+            returncode = self.process.returncode
+            self.start()
+            if tracked and cancellations.isCancelled(job):
+                raise ProcessCancelled(f"{self.name} was stopped because {job} was cancelled")
+            if timedOut.is_set():
+                raise ProcessTimeout(f"{self.name} did not finish within {self.timeout} seconds")
+            raise ProcessError(f"{self.name} server crashed with {returncode}")
+        return json.loads(response)
+
+class WarmPool():
+    """ A fixed number of WarmProcesses running `command`, each request
+        goes to an idle one.
+    """
+    def __init__(self, command, size: int, timeout=None, name=None):
+        self.idle = queue.Queue()
+        self.processes = [WarmProcess(command, timeout, name) for _ in range(size)]
+        for process in self.processes:
+            self.idle.put(process)
+
+    def request(self, request: dict, job=None, cancellations=None) -> dict:
+        process = self.idle.get()
+        try:
+            return process.request(request, job, cancellations)
+        finally:
+            self.idle.put(process)
+
+    def close(self):
+        for process in self.processes:
+            process.stop()
@@ -0,0 +1,69 @@
+from contextlib import nullcontext
+from kombu import Consumer
+from kombu.mixins import ConsumerMixin
+from WorkerRuntime.Messaging import initialize_logging, keepalive
+from WorkerRuntime.Outbox import Outbox
+from WorkerRuntime.Metrics import METRICS
+
+class ServiceWorker(ConsumerMixin):
+    """ Base of the service workers.
+
+        Results are published with publish() and messages settled with
+        ack() and reject() through an Outbox configured by the `messaging`
+        section, which is flushed on every iteration of the consumer loop.
+        Every delivery must go through received(). Subclasses that override
+        on_iteration or on_consume_end must call these.
+
+        A channel has one prefetch count, the one of the consumer created
+        on it last, so every consumer with a prefetch of its own beyond the
+        first must be created with isolatedConsumer().
+    """
+    # Handles one message at a time on the consumer thread: waits for the
+    # confirms of its results and keeps its connections alive during jobs
+    blocking = False
+
+    def __init__(self, connection, queues, config, name):
+        self.connection = connection
+        self.queues = queues
+        self.config = config
+        self.logger = initialize_logging(name)
+        messaging = config.get("messaging", {})
+        self.outbox = Outbox(connection, messaging.get("confirms", True), messaging.get("ack_batch", 1),
+                             messaging.get("ack_delay", 1.0), self.blocking)
+        self.consumerConnection = None
+
+    def isolatedConsumer(self, channel, **kwargs) -> Consumer:
+        """ A consumer for get_consumers on a new channel of the consumer
+            connection, so its prefetch_count does not replace the one of
+            the consumers on `channel`.
+        """
+        return Consumer(channel.connection.client.channel(), on_decode_error=self.on_decode_error, **kwargs)
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        self.consumerConnection = connection
+
+    def received(self, message):
+        METRICS.received(message)
+        self.outbox.track(message)
+
+    def publish(self, body, exchange, **kwargs):
+        with METRICS.time("worker_publish_seconds"):
+            self.outbox.publish(body, exchange, **kwargs)
+
+    def ack(self, message):
+        self.outbox.ack(message)
+
+    def reject(self, message):
+        self.outbox.reject(message)
+
+    def busy(self):
+        """ Context for a long job run on the consumer thread. """
+        if not self.blocking:
+            return nullcontext()
+        return keepalive(self.consumerConnection, self.outbox.connection)
+
+    def on_iteration(self):
+        self.outbox.flush()
+
+    def on_consume_end(self, connection, channel):
+        self.outbox.close()
@@ -0,0 +1,16 @@
+""" Code shared by the service workers.
+
+    The Dockerfiles copy this package next to each service and put /app on
+    PYTHONPATH. To run a service from a checkout, put the services
+    directory on PYTHONPATH, e.g. `PYTHONPATH=.. python DockingService.py`
+    (the LibraryBuilder also needs `../FASTAService`).
+"""
+from WorkerRuntime.Processes import run, WarmProcess, WarmPool, ProcessError, ProcessTimeout, ProcessCancelled
+from WorkerRuntime.Cancellation import Cancellations, CANCEL_EXCHANGE, cancellationQueue
+from WorkerRuntime.Metrics import METRICS, Metrics, enqueuedAt
+from WorkerRuntime.Accounting import Accounting
+from WorkerRuntime.Messaging import HEARTBEAT, initialize_logging, setup_mq, keepalive
+from WorkerRuntime.Outbox import Outbox
+from WorkerRuntime.Maps import mapsKey
+from WorkerRuntime.FileCache import FileCache, placeFile, linkFile, lastUsed
+from WorkerRuntime.ServiceWorker import ServiceWorker
@@ -0,0 +1,223 @@
+""" Offline throughput benchmarks of the four workers.
+
+    Every worker runs in this process against kombu's in-memory transport,
+    with the external tools replaced by the stand-ins in stubs/ and mail
+    delivered to a local SMTP sink, so neither RabbitMQ nor Vina, OpenBabel,
+    PDBFixer, PDB2PQR, MGLTools or a mail server is needed. For each worker
+    it reports messages per second and the time per message spent outside
+    the timed worker stages, i.e. the overhead of the worker itself. The
+    parsers that run in-process are timed on synthetic structures of
+    several sizes.
+
+        python benchmarks/Benchmark.py --messages 200 --sizes 1000,10000,100000
+"""
+import os
+import sys
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for service in ("DockingService", "DockingPrepperService", "FASTAService", "MailService"):
+    sys.path.append(os.path.join(ROOT, service))
+sys.path.append(ROOT)
+from kombu import Connection, Exchange, Queue
+from time import perf_counter, sleep
+import threading
+import tempfile
+import argparse
+import logging
+import timeit
+import yaml
+from WorkerRuntime import METRICS
+from Synthetic import writeProtein, writeReceptorPDBQT, writeLigandMol2, writeLigandPDBQT, writeBox
+from SMTPSink import SMTPSink
+
+STUBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+
+def stub(tool: str) -> str:
+    return os.path.join(STUBS, tool + ".py")
+
+def queued(connection, queue: Queue) -> int:
+    return queue(connection.default_channel).queue_declare(passive=True).message_count
+
+def measure(name: str, connection, worker, finished, messages: int, timeout: float):
+    """ Runs the worker until `finished()` and returns the report line. """
+    for logger in (worker.logger, logging.getLogger()):
+        logger.setLevel(logging.WARNING)
+    _, seconds = METRICS.total("worker_stage_seconds")
+    done = {}
+
+    def watch():
+        while not finished() and perf_counter() - start < timeout:
+            sleep(0.005)
+        done["at"] = perf_counter()
+        worker.should_stop = True
+
+    start = perf_counter()
+    threading.Thread(target=watch, daemon=True).start()
+    worker.run(safety_interval=0.05)
+    wall = done["at"] - start
+    stageSeconds = METRICS.total("worker_stage_seconds")[1] - seconds
+    completed = finished()
+    slots = getattr(worker, "benchmarkSlots", 1)
+    overhead = (wall - stageSeconds / slots) / messages
+    return (f"{name:<16}{messages:>9}{wall:>10.2f}{messages / wall:>12.1f}{overhead * 1000:>14.2f}"
+            + ("" if completed else "   (timed out)"))
+
+def declare(connection, queue: Queue):
+    queue(connection.default_channel).declare()
+    queue(connection.default_channel).purge()
+
+def publish(connection, exchange: Exchange, bodies):
+    with connection.Producer() as producer:
+        for body in bodies:
+            producer.publish(body, exchange=exchange, declare=[exchange])
+
+def benchmarkDocking(work: str, args) -> str:
+    import DockingService
+    connection = Connection("memory://")
+    tasks = Queue("DockingTask", exchange=Exchange("AsyncAPI.Models:DockingTask", "fanout"))
+    results = Queue("DockingResult", exchange=Exchange("AsyncAPI.Models:DockingResult", "fanout"))
+    declare(connection, tasks)
+    declare(connection, results)
+    ligand = os.path.join(work, "ligand.pdbqt")
+    writeLigandPDBQT(ligand)
+    bodies = []
+    for i in range(args.messages):
+        receptor = os.path.join(work, f"receptor{i}.pdbqt")
+        writeReceptorPDBQT(receptor, 2000, seed=i)
+        writeBox(receptor + "_conf")
+        bodies.append({"submissionId": "benchmark", "receptorId": i, "ligandPath": ligand, "receptorPath": receptor,
+                       "configPath": receptor + "_conf", "exhaustiveness": 8})
+    publish(connection, tasks.exchange, bodies)
+    # enough CPUs for every slot to run at exhaustiveness 8, the budget is not what is measured
+    config = {"vinapath": stub("vina"), "worker": {"slots": args.slots, "cpus": 8 * args.slots}}
+    worker = (DockingService.PooledWorker if args.slots > 1 else DockingService.Worker)(
+        connection, [tasks], config)
+    worker.benchmarkSlots = args.slots
+    return measure("docking", connection, worker, lambda: queued(connection, results) >= args.messages,
+                   args.messages, args.timeout)
+
+def benchmarkPrep(work: str, args) -> str:
+    import DockingPrepperService
+    connection = Connection("memory://")
+    tasks = Queue("DockingPrepTask", exchange=Exchange("AsyncAPI.Models:DockingPrepTask", "fanout"))
+    results = Queue("DockingPrepResult", exchange=Exchange("AsyncAPI.Models:DockingPrepResult", "fanout"))
+    declare(connection, tasks)
+    declare(connection, results)
+    bodies = []
+    for i in range(args.messages):
+        # receptors and ligands alternate, like a submission's prep tasks
+        if i % 2 == 0:
+            path = os.path.join(work, f"receptor{i}.pdb")
+            writeProtein(path, 2000, seed=i)
+        else:
+            path = os.path.join(work, f"ligand{i}.mol2")
+            writeLigandMol2(path, seed=i)
+        bodies.append({"id": str(i), "submissionId": "benchmark", "path": path, "type": i % 2})
+    publish(connection, tasks.exchange, bodies)
+    with open(os.path.join(ROOT, "DockingPrepperService", "config_dev.yml"), "r") as f:
+        config = yaml.safe_load(f)
+    config.update({"pythonshpath": stub("pythonsh"), "babelpath": stub("obabel"), "condapath": sys.executable,
+                   "pdbfixerpath": stub("pdbfixer"), "pdb2pqrpath": stub("pdb2pqr"), "pdb2pqrworkers": 0,
+                   "scratchpath": work, "cache": {}, "worker": {"slots": args.slots}})
+    config["lanes"]["enabled"] = False
+    config["maps"]["enabled"] = False
+    worker = (DockingPrepperService.PooledWorker if args.slots > 1 else DockingPrepperService.Worker)(
+        connection, [tasks], config)
+    worker.benchmarkSlots = args.slots
+    return measure("docking-prep", connection, worker, lambda: queued(connection, results) >= args.messages,
+                   args.messages, args.timeout)
+
+def benchmarkFASTA(work: str, args) -> str:
+    import FASTAService
+    connection = Connection("memory://")
+    tasks = Queue("FASTATask", exchange=Exchange("AsyncAPI.Models:FASTATask", "fanout"))
+    results = Queue("FASTAResult", exchange=Exchange("AsyncAPI.Models:FASTAResult", "fanout"))
+    declare(connection, tasks)
+    declare(connection, results)
+    bodies = []
+    for i in range(args.messages):
+        path = os.path.join(work, f"structure{i}.pdb")
+        writeProtein(path, 2000, seed=i)
+        bodies.append({"id": str(i), "path": path})
+    publish(connection, tasks.exchange, bodies)
+    # no cache, every message is parsed
+    config = {"babelpath": stub("obabel"), "cache": {"max_entries": 0},
+              "worker": {"concurrency": args.slots if args.slots > 1 else 0, "prefetch": 2 * args.slots,
+                         "parsers": args.slots}}
+    worker = (FASTAService.AsyncWorker if args.slots > 1 else FASTAService.Worker)(
+        connection, [tasks], config)
+    worker.benchmarkSlots = args.slots
+    return measure("fasta", connection, worker, lambda: queued(connection, results) >= args.messages,
+                   args.messages, args.timeout)
+
+def benchmarkMail(work: str, args) -> str:
+    import MailService
+    sink = SMTPSink().start()
+    try:
+        connection = Connection("memory://")
+        tasks = Queue("MailTask", exchange=Exchange("AsyncAPI.Models:MailTask", "fanout"))
+        declare(connection, tasks)
+        publish(connection, tasks.exchange, [
+            {"subject": f"Benchmark {i}", "recipient": "benchmark@localhost",
+             "bodyRaw": "Your results are ready.", "bodyHTML": "<p>Your results are ready.</p>"}
+            for i in range(args.messages)])
+        config = {"smtp_login": "", "smtp_pw": "", "smtp_server": sink.server_address[0],
+                  "smtp_port": sink.port, "ssl": False, "smtp_sessions": args.slots,
+                  "messaging": {"ack_batch": 8}}
+        worker = (MailService.PooledWorker if args.slots > 1 else MailService.Worker)(
+            connection, [tasks], config)
+        worker.benchmarkSlots = args.slots
+        return measure("mail", connection, worker, lambda: sink.messages >= args.messages,
+                       args.messages, args.timeout)
+    finally:
+        sink.shutdown()
+        sink.server_close()
+
+def benchmarkParsers(work: str, sizes, repeat: int):
+    """ Best of `repeat` runs of the parsers that run inside the workers. """
+    from DockingPrepper import DockingPrepper
+    from FASTAGenerator import FASTAGenerator
+    prepper = DockingPrepper({})
+    generator = FASTAGenerator({"babelpath": stub("obabel")})
+    for logger in (prepper.logger, generator.logger):
+        logger.setLevel(logging.WARNING)
+    lines = []
+    for size in sizes:
+        path = os.path.join(work, f"parser{size}.pdb")
+        writeProtein(path, size)
+        config = path + "qt"
+        writeReceptorPDBQT(config, size)
+        parsers = [("removeRotamers", lambda: prepper.removeRotamers(path, path + ".out")),
+                   ("prepareConfig", lambda: prepper.prepareConfig(config)),
+                   ("getFASTA", lambda: generator.getFASTA(path))]
+        for name, parser in parsers:
+            best = min(timeit.repeat(parser, number=1, repeat=repeat))
+            lines.append(f"{name:<16}{size:>9}{best * 1000:>12.2f}")
+    return lines
+
+BENCHMARKS = {"docking": benchmarkDocking, "prep": benchmarkPrep, "fasta": benchmarkFASTA, "mail": benchmarkMail}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Benchmark",
+        description="Measures worker throughput and parser speed without a broker or external tools"
+    )
+    parser.add_argument("--messages", type=int, default=100, help="Messages sent to every worker")
+    parser.add_argument("--slots", type=int, default=1, help="Concurrent jobs per worker, 1 uses the serial workers")
+    parser.add_argument("--tool-seconds", type=float, default=0.0, help="How long every stubbed tool runs")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Atoms of the structures the parsers are timed on")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per parser timing, the best is reported")
+    parser.add_argument("--only", default=",".join(BENCHMARKS) + ",parsers", help="Comma separated benchmarks to run")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds before a worker benchmark is given up")
+    args = parser.parse_args()
+
+    os.environ["STUB_SECONDS"] = str(args.tool_seconds)
+    selected = args.only.split(",")
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as work:
+        print(f"{'worker':<16}{'messages':>9}{'seconds':>10}{'msgs/sec':>12}{'overhead ms':>14}")
+        for name, benchmark in BENCHMARKS.items():
+            if name in selected:
+                print(benchmark(work, args), flush=True)
+        if "parsers" in selected:
+            print(f"\n{'parser':<16}{'atoms':>9}{'ms':>12}")
+            for line in benchmarkParsers(work, [int(size) for size in args.sizes.split(",")], args.repeat):
+                print(line, flush=True)
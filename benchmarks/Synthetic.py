@@ -0,0 +1,84 @@
+import math
+import random
+
+# Residues written into synthetic proteins, with the one-letter codes the FASTA
+# service should read back
+RESIDUES = ["ALA", "ARG", "ASN", "ASP", "CYS", "GLN", "GLU", "GLY", "HIS", "ILE",
+            "LEU", "LYS", "MET", "PHE", "PRO", "SER", "THR", "TRP", "TYR", "VAL"]
+
+# Backbone and CB atoms of every residue, as (name, element, offset from CA)
+ATOMS = [("N", "N", (-1.2, 0.6, 0.0)), ("CA", "C", (0.0, 0.0, 0.0)),
+         ("C", "C", (1.2, 0.7, 0.0)), ("O", "O", (1.3, 1.9, 0.0)), ("CB", "C", (0.0, -1.0, 1.2))]
+
+def atomLine(record, serial, name, altloc, residue, chain, number, x, y, z, element):
+    return (f"{record:<6}{serial % 100000:5d} {name:<4}{altloc}{residue:>3} {chain}{number % 10000:4d}    "
+            f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00          {element:>2}\n")
+
+def writeProtein(path: str, atoms: int, altlocFraction: float = 0.05, seed: int = 0):
+    """ A PDB file of about `atoms` atoms: one chain folded into a compact
+        globule, with SEQRES records, alternate locations on a fraction of
+        the residues and a few waters.
+    """
+    rng = random.Random(seed)
+    residues = max(1, atoms // len(ATOMS))
+    names = [rng.choice(RESIDUES) for _ in range(residues)]
+    radius = 1.9 * residues ** (1 / 3)
+    lines = []
+    for start in range(0, residues, 13):
+        chunk = names[start:start + 13]
+        lines.append(f"SEQRES {start // 13 + 1:3d} A {residues:4d}  " + " ".join(chunk) + "\n")
+    serial = 1
+    for number, residue in enumerate(names, start=1):
+        # points on a spiral through a ball, so the chain is compact like a fold
+        t = number / residues
+        r = radius * t ** (1 / 3)
+        phi = number * 2.39996
+        z = r * (2 * t - 1) if r else 0.0
+        planar = math.sqrt(max(r * r - z * z, 0.0))
+        ca = (planar * math.cos(phi), planar * math.sin(phi), z)
+        altlocs = ["A", "B"] if rng.random() < altlocFraction else [" "]
+        for altloc in altlocs:
+            for name, element, offset in ATOMS:
+                if residue == "GLY" and name == "CB":
+                    continue
+                shift = 0.3 if altloc == "B" else 0.0
+                lines.append(atomLine("ATOM", serial, name, altloc, residue, "A", number,
+                                      ca[0] + offset[0] + shift, ca[1] + offset[1], ca[2] + offset[2], element))
+                serial += 1
+    for water in range(max(1, residues // 50)):
+        lines.append(atomLine("HETATM", serial, "O", " ", "HOH", "A", residues + water + 1,
+                              rng.uniform(-radius, radius), rng.uniform(-radius, radius), radius + 3, "O"))
+        serial += 1
+    lines.append("END\n")
+    with open(path, "w") as file:
+        file.writelines(lines)
+
+def writeReceptorPDBQT(path: str, atoms: int, seed: int = 0):
+    """ A prepared receptor as DockingService gets it. """
+    writeProtein(path, atoms, altlocFraction=0.0, seed=seed)
+
+def writeLigandMol2(path: str, atoms: int = 20, seed: int = 0):
+    rng = random.Random(seed)
+    lines = ["@<TRIPOS>MOLECULE\n", "ligand\n", f"{atoms} {atoms - 1} 0 0 0\n", "SMALL\n", "GASTEIGER\n\n", "@<TRIPOS>ATOM\n"]
+    for i in range(1, atoms + 1):
+        lines.append(f"{i:7d} C{i:<4} {rng.uniform(-3, 3):9.4f} {rng.uniform(-3, 3):9.4f} {rng.uniform(-3, 3):9.4f} C.3     1  LIG1        0.0000\n")
+    lines.append("@<TRIPOS>BOND\n")
+    for i in range(1, atoms):
+        lines.append(f"{i:6d} {i:5d} {i + 1:5d} 1\n")
+    with open(path, "w") as file:
+        file.writelines(lines)
+
+def writeLigandPDBQT(path: str, atoms: int = 20, torsions: int = 5, seed: int = 0):
+    rng = random.Random(seed)
+    lines = ["ROOT\n"]
+    for i in range(1, atoms + 1):
+        lines.append(f"HETATM{i:5d}  C   LIG A   1    {rng.uniform(-3, 3):8.3f}{rng.uniform(-3, 3):8.3f}{rng.uniform(-3, 3):8.3f}"
+                     f"  1.00  0.00     0.000 C \n")
+    lines += ["ENDROOT\n", f"TORSDOF {torsions}\n"]
+    with open(path, "w") as file:
+        file.writelines(lines)
+
+def writeBox(path: str, size: float = 30.0):
+    with open(path, "w") as file:
+        file.write("center_x = 0.000000\ncenter_y = 0.000000\ncenter_z = 0.000000\n\n")
+        file.write(f"size_x = {size:f}\nsize_y = {size:f}\nsize_z = {size:f}\n")
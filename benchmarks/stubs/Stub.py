@@ -0,0 +1,17 @@
+""" Shared by the stand-ins for the external tools. They take the same
+    arguments as the real tools, sleep for STUB_SECONDS (default 0) and write
+    plausible output, so the workers can be benchmarked without the tools.
+"""
+import os
+import shutil
+import sys
+import time
+
+def pause():
+    time.sleep(float(os.environ.get("STUB_SECONDS", "0")))
+
+def argument(flag: str) -> str:
+    return sys.argv[sys.argv.index(flag) + 1]
+
+def copy(source: str, destination: str):
+    shutil.copyfile(source, destination)
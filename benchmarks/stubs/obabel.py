@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+import sys
+from Stub import pause, argument
+
+pause()
+if "-ofasta" in sys.argv:
+    print(">stub\nMKVLAAGIVGLLLAAPAGA")
+else:
+    with open(argument("-O"), "w") as file:
+        file.write("ROOT\nHETATM    1  C   LIG A   1       0.000   0.000   0.000  1.00  0.00     0.000 C \nENDROOT\nTORSDOF 0\n")
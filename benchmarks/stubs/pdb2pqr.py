@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+import sys
+from Stub import pause, copy
+
+pause()
+copy(sys.argv[-2], sys.argv[-1])
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+""" Stands in for PDBFix.py, including its --serve protocol. """
+import json
+import sys
+from Stub import pause, copy
+
+if sys.argv[1] == "--serve":
+    for line in sys.stdin:
+        request = json.loads(line)
+        pause()
+        if "pdb" in request:
+            response = {"ok": True, "pdb": request["pdb"]}
+        else:
+            copy(request["input"], request["output"])
+            response = {"ok": True}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+else:
+    pause()
+    copy(sys.argv[1], sys.argv[2])
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+""" Stands in for MGLTools' pythonsh running prepare_receptor4.py. """
+from Stub import pause, argument, copy
+
+pause()
+copy(argument("-r"), argument("-o"))
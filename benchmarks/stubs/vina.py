@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+import sys
+import zlib
+from Stub import pause, argument
+
+pause()
+receptor = argument("--maps") if "--maps" in sys.argv else argument("--receptor")
+affinity = -(zlib.crc32((argument("--ligand") + receptor).encode()) % 120) / 10
+with open(argument("--out"), "w") as file:
+    for mode in range(1, 10):
+        file.write(f"MODEL {mode}\nREMARK VINA RESULT: {affinity + mode / 10:8.3f}      0.000      0.000\nENDMDL\n")
+print("mode |   affinity | dist from best mode\n     | (kcal/mol) | rmsd l.b.| rmsd u.b.\n-----+------------+----------+----------")
+for mode in range(1, 10):
+    print(f"   {mode}       {affinity + mode / 10:8.3f}      0.000      0.000")
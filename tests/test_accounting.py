@@ -0,0 +1,45 @@
+import logging
+import sys
+from types import SimpleNamespace
+import pytest
+from WorkerRuntime import Accounting, run
+
+def rusage(user, system, maxrss):
+    return SimpleNamespace(ru_utime=user, ru_stime=system, ru_maxrss=maxrss)
+
+@pytest.fixture
+def accounting():
+    return Accounting(logging.getLogger("test"), "job")
+
+def test_summary_adds_up_the_tools(accounting):
+    accounting.record("pdbfixer", 2.0)
+    accounting.record("pdb2pqr", 1.5, rusage(1.25, 0.25, 1000))
+    accounting.record("obabel", 0.5, rusage(0.5, 0.125, 3000), outcome="failed")
+    summary = accounting.summary()
+    assert summary["wallSeconds"] == 4.0
+    assert summary["cpuUserSeconds"] == 1.75
+    assert summary["cpuSystemSeconds"] == 0.375
+    expected = 3000 if sys.platform == "darwin" else 3000 * 1024
+    assert summary["maxRssBytes"] == expected
+    assert [tool["tool"] for tool in summary["tools"]] == ["pdbfixer", "pdb2pqr", "obabel"]
+    assert summary["tools"][0]["cpuUserSeconds"] is None
+    assert summary["tools"][2]["outcome"] == "failed"
+
+def test_empty_summary(accounting):
+    summary = accounting.summary()
+    assert summary == {"wallSeconds": 0, "cpuUserSeconds": 0, "cpuSystemSeconds": 0, "maxRssBytes": None, "tools": []}
+
+def test_timed_records_the_outcome(accounting):
+    with accounting.timed("warm"):
+        pass
+    with pytest.raises(ValueError):
+        with accounting.timed("warm"):
+            raise ValueError()
+    assert [tool["outcome"] for tool in accounting.summary()["tools"]] == ["ok", "failed"]
+
+def test_run_records_the_process(accounting):
+    process = run([sys.executable, "-c", "sum(range(10 ** 6))"], accounting=accounting, tool="python")
+    assert process.returncode == 0
+    tool, = accounting.summary()["tools"]
+    assert tool["tool"] == "python" and tool["outcome"] == "ok"
+    assert tool["cpuUserSeconds"] is not None and tool["maxRssBytes"] > 0
@@ -0,0 +1,75 @@
+import json
+import math
+import random
+from CostModel import CostModel, FEATURES, PRIOR, countAtoms, countTorsions
+
+TRUE_WEIGHTS = [-4.0, 0.9, 0.7, 0.3, 0.2]
+
+def randomFeatures(rng) -> list:
+    return [1.0, math.log(rng.choice([1, 2, 4, 8, 16, 32])), math.log(rng.uniform(500, 50000)),
+            math.log(rng.uniform(1000, 30000)), float(rng.randint(0, 12))]
+
+def train(model, observations: int, seed: int = 1):
+    rng = random.Random(seed)
+    for _ in range(observations):
+        features = randomFeatures(rng)
+        model.update(features, math.exp(sum(w * x for w, x in zip(TRUE_WEIGHTS, features))))
+
+def test_starts_from_the_prior():
+    model = CostModel()
+    features = [1.0, 0.0, 0.0, 0.0, 0.0]
+    assert math.isclose(model.predict(features), math.exp(PRIOR[0]))
+
+def test_recursive_least_squares_finds_the_weights():
+    # forgetting lets the identity prior fade, with 1.0 it would bias the intercept
+    model = CostModel(forgetting=0.98)
+    train(model, 300)
+    assert model.observations == 300
+    for learned, true in zip(model.weights, TRUE_WEIGHTS):
+        assert abs(learned - true) < 0.05
+    features = [1.0, math.log(8), math.log(4000), math.log(8000), 5.0]
+    expected = math.exp(sum(w * x for w, x in zip(TRUE_WEIGHTS, features)))
+    assert abs(model.predict(features) / expected - 1) < 0.05
+
+def test_forgetting_follows_a_change():
+    model = CostModel(forgetting=0.95)
+    train(model, 200)
+    features = [1.0, math.log(8), math.log(4000), math.log(8000), 5.0]
+    before = model.predict(features)
+    # the hardware got twice as slow
+    rng = random.Random(2)
+    for _ in range(200):
+        x = randomFeatures(rng)
+        model.update(x, 2 * math.exp(sum(w * v for w, v in zip(TRUE_WEIGHTS, x))))
+    assert abs(model.predict(features) / before - 2) < 0.1
+
+def test_saves_every_n_observations_and_on_close(tmp_path):
+    path = tmp_path / "model.json"
+    model = CostModel(str(path), saveEvery=3)
+    train(model, 2)
+    assert not path.exists()
+    train(model, 1)
+    assert json.loads(path.read_text())["observations"] == 3
+    train(model, 1)
+    assert json.loads(path.read_text())["observations"] == 3
+    model.close()
+    state = json.loads(path.read_text())
+    assert state["observations"] == 4 and state["features"] == FEATURES
+    restored = CostModel(str(path))
+    assert restored.weights == model.weights
+    assert restored.observations == 4
+
+def test_ignores_a_model_of_other_features(tmp_path):
+    path = tmp_path / "model.json"
+    path.write_text(json.dumps({"features": ["intercept"], "weights": [1.0], "covariance": [[1.0]],
+                                "observations": 7}))
+    model = CostModel(str(path))
+    assert model.weights == PRIOR and model.observations == 0
+
+def test_counts_atoms_and_torsions(tmp_path):
+    receptor = tmp_path / "receptor.pdbqt"
+    receptor.write_text("ATOM      1  N   MET A   1\nHETATM    2  O   HOH A   2\nREMARK ATOM\nATOM      3  C   MET A   1\n")
+    ligand = tmp_path / "ligand.pdbqt"
+    ligand.write_text("ROOT\nENDROOT\nTORSDOF 7\n")
+    assert countAtoms(str(receptor)) == 3
+    assert countTorsions(str(ligand)) == 7
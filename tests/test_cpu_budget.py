@@ -0,0 +1,54 @@
+import threading
+import time
+from CpuBudget import CpuBudget
+
+def waitFor(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def acquireLater(budget, weight, name, started):
+    def acquire():
+        token, cpus = budget.acquire(weight)
+        started.append((name, cpus, token))
+    thread = threading.Thread(target=acquire, daemon=True)
+    thread.start()
+    return thread
+
+def test_single_job_gets_its_exhaustiveness():
+    budget = CpuBudget(8)
+    assert budget.acquire(4)[1] == 4
+
+def test_job_is_capped_by_the_budget():
+    budget = CpuBudget(8)
+    assert budget.acquire(32)[1] == 8
+
+def test_jobs_get_their_cores_in_arrival_order():
+    budget = CpuBudget(8)
+    first, cpus = budget.acquire(6)
+    assert cpus == 6
+    started = []
+    large = acquireLater(budget, 8, "large", started)
+    waitFor(lambda: len(budget.waiting) == 1)
+    small = acquireLater(budget, 1, "small", started)
+    waitFor(lambda: len(budget.waiting) == 2)
+    # two cores are free, but the small job must not overtake the large one
+    time.sleep(0.1)
+    assert started == []
+    budget.release(first)
+    large.join(5)
+    small.join(5)
+    assert [(name, cpus) for name, cpus, _ in started] == [("large", 7), ("small", 1)]
+
+def test_released_cores_go_to_the_waiting_job():
+    budget = CpuBudget(4)
+    first, _ = budget.acquire(4)
+    started = []
+    waiting = acquireLater(budget, 4, "waiting", started)
+    waitFor(lambda: len(budget.waiting) == 1)
+    assert started == []
+    budget.release(first)
+    waiting.join(5)
+    assert [(name, cpus) for name, cpus, _ in started] == [("waiting", 4)]
+    assert not budget.waiting
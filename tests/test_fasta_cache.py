@@ -0,0 +1,28 @@
+from FASTACache import FASTACache
+
+def test_key_is_the_content_hash(tmp_path):
+    first, second, other = tmp_path / "a.pdb", tmp_path / "b.pdb", tmp_path / "c.pdb"
+    first.write_text("ATOM")
+    second.write_text("ATOM")
+    other.write_text("HETATM")
+    assert FASTACache.key(str(first)) == FASTACache.key(str(second))
+    assert FASTACache.key(str(first)) != FASTACache.key(str(other))
+
+def test_least_recently_used_entry_is_dropped():
+    cache = FASTACache(2)
+    cache.put("a", ">A\nMK")
+    cache.put("b", ">B\nGG")
+    assert cache.get("a") == ">A\nMK"
+    cache.put("c", ">C\nWW")
+    assert cache.get("b") is None
+    assert cache.get("a") == ">A\nMK" and cache.get("c") == ">C\nWW"
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_put_again_refreshes_the_entry():
+    cache = FASTACache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 3)
+    cache.put("c", 4)
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.get("a") == 3
@@ -0,0 +1,92 @@
+import os
+import pytest
+from WorkerRuntime import FileCache, placeFile
+from ReceptorCache import ReceptorCache
+
+def write(path, text: str) -> str:
+    with open(path, "w") as file:
+        file.write(text)
+    return str(path)
+
+def age(cache, key, seconds: float):
+    os.utime(cache.entry(key), (seconds, seconds))
+
+@pytest.fixture
+def source(tmp_path):
+    return write(tmp_path / "source.txt", "x" * 100)
+
+def test_store_and_lookup(tmp_path, source):
+    cache = FileCache(str(tmp_path / "cache"), "test", "test")
+    assert cache.store("a", {"data": source}, {"meta.json": {"version": 1}})
+    assert os.path.exists(os.path.join(cache.entry("a"), "data"))
+    assert [os.path.basename(e) for e in cache.entries()] == ["a"]
+    # a second worker storing the same entry loses the rename
+    assert not cache.store("a", {"data": source}, {})
+    assert [e for e in os.listdir(cache.path) if e.startswith(".")] == []
+
+def test_evicts_least_recently_used_entries(tmp_path, source):
+    cache = FileCache(str(tmp_path / "cache"), "test", "test", maxEntries=2)
+    cache.store("a", {"data": source}, {})
+    cache.store("b", {"data": source}, {})
+    age(cache, "a", 1000)
+    age(cache, "b", 2000)
+    cache.hit("a")
+    cache.store("c", {"data": source}, {})
+    assert sorted(os.path.basename(e) for e in cache.entries()) == ["a", "c"]
+    assert (cache.hits, cache.misses) == (1, 0)
+
+def test_evicts_by_size(tmp_path, source):
+    cache = FileCache(str(tmp_path / "cache"), "test", "test", maxBytes=250)
+    for number, key in enumerate("abc"):
+        cache.store(key, {"data": source}, {})
+        age(cache, key, 1000 + number)
+    assert sorted(os.path.basename(e) for e in cache.entries()) == ["b", "c"]
+    assert cache.size == 200
+
+def test_size_is_counted_on_startup(tmp_path, source):
+    path = str(tmp_path / "cache")
+    FileCache(path, "test", "test").store("a", {"data": source}, {})
+    assert FileCache(path, "test", "test", maxBytes=1000).size == 100
+
+def test_placed_file_is_not_linked(tmp_path, source):
+    destination = write(tmp_path / "destination.txt", "old")
+    placeFile(source, destination)
+    assert open(destination).read() == "x" * 100
+    with open(destination, "w") as file:
+        file.write("changed")
+    assert open(source).read() == "x" * 100
+    assert os.stat(source).st_ino != os.stat(destination).st_ino
+
+@pytest.fixture
+def receptor(tmp_path):
+    prepared = tmp_path / "prepared"
+    prepared.mkdir()
+    paths = [write(prepared / name, name) for name in
+             ["r.pdbqt", "r.pdbqt_conf", "r.pdbqt_conf_pocket1", "r.pdbqt_conf_pocket2"]]
+    return paths
+
+def test_receptor_round_trip(tmp_path, receptor):
+    cache = ReceptorCache(str(tmp_path / "cache"), 10, "3.0")
+    cache.put("k", receptor[0], receptor[1], receptor[2:])
+    out = tmp_path / "out"
+    out.mkdir()
+    pockets = cache.get("k", str(out / "job.pdbqt"))
+    assert pockets == [str(out / "job.pdbqt_conf_pocket1"), str(out / "job.pdbqt_conf_pocket2")]
+    assert open(out / "job.pdbqt_conf").read() == "r.pdbqt_conf"
+    assert open(pockets[1]).read() == "r.pdbqt_conf_pocket2"
+    assert cache.get("missing", str(out / "other.pdbqt")) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_other_pipeline_versions_are_invalidated(tmp_path, receptor):
+    path = str(tmp_path / "cache")
+    ReceptorCache(path, 10, "3.0").put("k", receptor[0], receptor[1])
+    assert len(ReceptorCache(path, 10, "3.0").entries()) == 1
+    assert ReceptorCache(path, 10, "4.0").entries() == []
+
+def test_key_depends_on_content_and_version(tmp_path, receptor):
+    cache = ReceptorCache(str(tmp_path / "cache"), 10, "3.0")
+    other = ReceptorCache(str(tmp_path / "other"), 10, "4.0")
+    copy = write(tmp_path / "copy.pdbqt", "r.pdbqt")
+    assert cache.key(receptor[0]) == cache.key(copy)
+    assert cache.key(receptor[0]) != cache.key(receptor[1])
+    assert cache.key(receptor[0]) != other.key(receptor[0])
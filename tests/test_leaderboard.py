@@ -0,0 +1,99 @@
+import json
+import random
+import statistics
+import pytest
+from kombu import Connection
+from Leaderboard import Leaderboard, histogramEdges
+from LeaderboardService import Worker
+
+EDGES = histogramEdges(-14, 0, 1)
+
+def result(receptor, affinity, success=True, receptorCount=None):
+    return {"message": {"submission": "s", "receptor": receptor, "affinity": affinity, "success": success,
+                        "receptorCount": receptorCount}}
+
+def test_histogram_edges():
+    assert histogramEdges(-3, 0, 1) == [-3, -2, -1, 0]
+
+def test_statistics_match_the_batch_formulas():
+    rng = random.Random(6)
+    affinities = [rng.uniform(-13, -1) for _ in range(500)]
+    board = Leaderboard("s", 5, EDGES)
+    for receptor, affinity in enumerate(affinities):
+        board.add(result(receptor, affinity))
+    snapshot = board.snapshot()
+    assert snapshot["affinity"]["mean"] == pytest.approx(statistics.fmean(affinities))
+    assert snapshot["affinity"]["stddev"] == pytest.approx(statistics.pstdev(affinities))
+    assert snapshot["affinity"]["min"] == min(affinities)
+    assert snapshot["affinity"]["max"] == max(affinities)
+    assert [hit["affinity"] for hit in snapshot["best"]] == sorted(affinities)[:5]
+    assert sum(snapshot["histogram"]["counts"]) == 500
+
+def test_histogram_bins():
+    board = Leaderboard("s", 0, [-2, -1, 0])
+    for receptor, affinity in enumerate([-3.0, -2.0, -1.5, -1.0, 0.0, 2.0]):
+        board.add(result(receptor, affinity))
+    assert board.snapshot()["histogram"]["counts"] == [1, 2, 1, 2]
+    assert board.snapshot()["best"] == []
+
+def test_receptors_count_once():
+    board = Leaderboard("s", 3, EDGES)
+    assert board.add(result(1, -5.0))
+    assert not board.add(result(1, -5.0))
+    assert not board.add(result(1, 0, success=False))
+    assert board.add(result(2, 0, success=False))
+    assert not board.add(result(2, 0, success=False))
+    # a redelivered failure that later succeeded
+    assert board.add(result(2, -7.0))
+    snapshot = board.snapshot()
+    assert (snapshot["received"], snapshot["succeeded"], snapshot["failed"]) == (2, 2, 0)
+    assert [hit["receptor"] for hit in snapshot["best"]] == [2, 1]
+
+def test_complete_once_every_receptor_is_in():
+    board = Leaderboard("s", 3, EDGES)
+    board.add(result(1, -5.0))
+    assert not board.complete() and board.snapshot()["completion"] is None
+    board.add(result(2, -6.0, receptorCount=3))
+    assert not board.complete() and board.snapshot()["completion"] == pytest.approx(2 / 3)
+    board.add(result(3, 0, success=False))
+    assert board.complete()
+
+def test_state_round_trip():
+    board = Leaderboard("s", 2, EDGES, expected=4)
+    for receptor, affinity in enumerate([-5.0, -8.0, -6.5]):
+        board.add(result(receptor, affinity))
+    board.add(result(9, 0, success=False))
+    restored = Leaderboard.fromState(json.loads(json.dumps(board.state())))
+    assert restored.snapshot() == board.snapshot()
+    restored.add(result(10, -9.0))
+    assert [hit["affinity"] for hit in restored.snapshot()["best"]] == [-9.0, -8.0]
+
+CONFIG = {"leaderboard": {"topK": 3, "interval": 3600, "idle_timeout": 600, "prefetch": 8,
+                          "histogram": {"min": -14, "max": 0, "width": 1}}}
+
+@pytest.fixture
+def worker():
+    worker = Worker(Connection("memory://"), [], CONFIG)
+    worker.published = []
+    worker.publish = lambda body, exchange: worker.published.append(json.loads(body)["message"])
+    yield worker
+    worker.outbox.close()
+
+def test_final_update_of_a_complete_submission(worker):
+    board = worker.boards["s"] = Leaderboard("s", 3, EDGES)
+    board.add(result(1, -5.0, receptorCount=1))
+    worker.on_iteration()
+    update, = worker.published
+    assert update["final"] and not update["timedOut"]
+    assert "s" in worker.finished and not worker.boards
+
+def test_idle_submission_times_out(worker):
+    board = worker.boards["s"] = Leaderboard("s", 3, EDGES)
+    board.add(result(1, -5.0))
+    worker.on_iteration()
+    assert worker.published == []
+    board.updated -= 601
+    worker.on_iteration()
+    update, = worker.published
+    assert update["final"] and update["timedOut"]
+    assert update["expected"] is None and update["received"] == 1
@@ -0,0 +1,65 @@
+import os
+from types import SimpleNamespace
+from WorkerRuntime import mapsKey
+from WorkerRuntime.Maps import hashFiles
+from DockingPrepper import DockingPrepper
+from ReceptorCache import ReceptorCache
+
+def write(path, text: str) -> str:
+    with open(path, "w") as file:
+        file.write(text)
+    return str(path)
+
+def test_maps_key_follows_the_content(tmp_path):
+    receptor = write(tmp_path / "r.pdbqt", "ATOM")
+    config = write(tmp_path / "r.pdbqt_conf", "center_x = 1")
+    key = mapsKey(receptor, config)
+    assert mapsKey(receptor, config) == key
+    copy = write(tmp_path / "copy.pdbqt", "ATOM")
+    assert mapsKey(copy, config) == key
+    write(tmp_path / "r.pdbqt_conf", "center_x = 2.5")
+    assert mapsKey(receptor, config) != key
+
+def test_unchanged_files_are_hashed_once(tmp_path):
+    receptor = write(tmp_path / "r.pdbqt", "ATOM")
+    config = write(tmp_path / "r.pdbqt_conf", "center_x = 1")
+    hashFiles.cache_clear()
+    mapsKey(receptor, config)
+    mapsKey(receptor, config)
+    assert (hashFiles.cache_info().hits, hashFiles.cache_info().misses) == (1, 1)
+
+class FakeVina():
+    def __init__(self):
+        self.runs = []
+
+    def __call__(self, tool, command):
+        self.runs.append(command)
+        prefix = command[command.index("--write_maps") + 1]
+        write(prefix + ".C.map", "map")
+        return SimpleNamespace(returncode=0, stderr="")
+
+def test_prepare_maps_skips_current_maps(tmp_path):
+    receptor = write(tmp_path / "r.pdbqt", "ATOM")
+    configs = [write(tmp_path / "r.pdbqt_conf", "box 1"), write(tmp_path / "r.pdbqt_conf_pocket1", "box 2")]
+    prepper = DockingPrepper({"maps": {"vinapath": "vina"}})
+    prepper.runTool = FakeVina()
+    keys = prepper.prepareMaps(receptor, configs)
+    assert keys == [mapsKey(receptor, config) for config in configs]
+    assert len(prepper.runTool.runs) == 2
+    assert open(os.path.join(configs[1] + ".maps", "key")).read() == keys[1]
+    assert prepper.prepareMaps(receptor, configs, keys) == keys
+    assert len(prepper.runTool.runs) == 2
+    # a stale key in the maps directory means the maps are written again
+    write(os.path.join(configs[0] + ".maps", "key"), "stale")
+    prepper.prepareMaps(receptor, configs, keys)
+    assert len(prepper.runTool.runs) == 3
+
+def test_receptor_cache_keeps_the_maps_keys(tmp_path):
+    receptor = write(tmp_path / "r.pdbqt", "ATOM")
+    config = write(tmp_path / "r.pdbqt_conf", "box")
+    cache = ReceptorCache(str(tmp_path / "cache"), 10, "3.0")
+    cache.put("with", receptor, config, mapsKeys=["k1"])
+    cache.put("without", receptor, config)
+    assert cache.mapsKeys("with") == ["k1"]
+    assert cache.mapsKeys("without") is None
+    assert cache.mapsKeys("missing") is None
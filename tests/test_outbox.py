@@ -0,0 +1,175 @@
+from collections import defaultdict
+from kombu import Connection
+import socket
+import pytest
+from WorkerRuntime.Outbox import Outbox
+
+class FakeChannel():
+    def __init__(self):
+        self.events = defaultdict(set)
+        self.confirming = False
+
+    def confirm_select(self):
+        self.confirming = True
+
+class FakeConnection():
+    """ An AMQP connection with nothing to read. """
+    connection_errors = ()
+    channel_errors = ()
+
+    def drain_events(self, timeout=None):
+        raise socket.timeout()
+
+    def heartbeat_check(self):
+        pass
+
+    def release(self):
+        pass
+
+class FakeProducer():
+    """ Records publishes; with `lose` set, the next publish loses the
+        channel once and kombu revives it before retrying.
+    """
+    def __init__(self):
+        self.published = []
+        self.lose = False
+        self.channel = FakeChannel()
+
+    def publish(self, body, exchange=None, retry=False, retry_policy=None, **kwargs):
+        if self.lose:
+            self.lose = False
+            self.channel = FakeChannel()
+            retry_policy["on_revive"](self.channel)
+        self.published.append(body)
+
+class FakeMessage():
+    def __init__(self, tag, log):
+        self.delivery_tag = tag
+        self.log = log
+
+    def ack(self, multiple=False):
+        self.log.append(("ack", self.delivery_tag, multiple))
+
+    def reject(self, requeue=True):
+        self.log.append(("reject", self.delivery_tag, requeue))
+
+def amqpOutbox(confirms=True, batch=1, delay=60.0, wait=False):
+    """ An Outbox on the AMQP paths, which the in-memory transport skips. """
+    outbox = Outbox(Connection("memory://"), confirms, batch, delay, wait)
+    outbox.connection.release()
+    outbox.connection = FakeConnection()
+    outbox.amqp = True
+    outbox.confirms = confirms
+    outbox.batch = batch
+    outbox.producer = FakeProducer()
+    if confirms:
+        outbox.enableConfirms(outbox.producer.channel)
+    return outbox
+
+@pytest.fixture
+def log():
+    return []
+
+def test_run_is_acked_once_with_multiple(log):
+    outbox = amqpOutbox(confirms=False, batch=3)
+    messages = [FakeMessage(tag, log) for tag in (1, 2, 3)]
+    for message in messages:
+        outbox.track(message)
+    outbox.ack(messages[1])
+    outbox.ack(messages[0])
+    assert log == []
+    outbox.ack(messages[2])
+    assert log == [("ack", 3, True)]
+    assert not outbox.deliveries
+
+def test_run_waits_for_earlier_deliveries(log):
+    outbox = amqpOutbox(confirms=False, batch=2)
+    messages = [FakeMessage(tag, log) for tag in (1, 2, 3)]
+    for message in messages:
+        outbox.track(message)
+    outbox.ack(messages[1])
+    outbox.ack(messages[2])
+    # acking 3 with multiple would also ack 1, which is still being worked on
+    assert log == []
+    outbox.ack(messages[0])
+    assert log == [("ack", 3, True)]
+
+def test_reject_in_the_middle_of_a_run(log):
+    outbox = amqpOutbox(confirms=False, batch=4)
+    messages = [FakeMessage(tag, log) for tag in (1, 2, 3)]
+    for message in messages:
+        outbox.track(message)
+    outbox.ack(messages[0])
+    outbox.ack(messages[2])
+    assert log == []
+    outbox.reject(messages[1])
+    assert log == [("ack", 1, True), ("reject", 2, False)]
+    assert list(outbox.deliveries) == [3]
+    outbox.flush(force=True)
+    assert log[-1] == ("ack", 3, True)
+    assert not outbox.deliveries
+
+def test_run_is_acked_after_delay(log):
+    outbox = amqpOutbox(confirms=False, batch=4, delay=0.0)
+    message = FakeMessage(1, log)
+    outbox.track(message)
+    outbox.ack(message)
+    assert log == [("ack", 1, True)]
+
+def test_acks_wait_for_confirms(log):
+    outbox = amqpOutbox()
+    first, second = FakeMessage(1, log), FakeMessage(2, log)
+    outbox.publish("a", "results")
+    outbox.ack(first)
+    outbox.publish("b", "results")
+    outbox.reject(second)
+    assert log == []
+    outbox.on_ack(2, False)
+    outbox.flush()
+    # the first publish is still unconfirmed, so neither may be settled
+    assert log == [] and outbox.confirmedUpTo() == 0
+    outbox.on_ack(1, False)
+    outbox.flush()
+    assert log == [("ack", 1, False), ("reject", 2, False)]
+
+def test_confirmed_up_to(log):
+    outbox = amqpOutbox()
+    assert outbox.confirmedUpTo() == 0
+    for body in "abcd":
+        outbox.publish(body, "results")
+    assert outbox.confirmedUpTo() == 0
+    outbox.on_ack(3, False)
+    assert outbox.confirmedUpTo() == 0
+    outbox.on_ack(2, True)
+    assert outbox.confirmedUpTo() == 3
+    outbox.on_ack(4, False)
+    assert outbox.confirmedUpTo() == 4
+
+def test_nack_publishes_again(log):
+    outbox = amqpOutbox()
+    outbox.publish("a", "results")
+    outbox.publish("b", "results")
+    outbox.on_nack(1, False)
+    assert outbox.producer.published == ["a", "b", "a"]
+    # the channel numbers the publish sent again 3
+    assert outbox.sequences == {2: 2, 3: 1}
+    outbox.on_ack(2, False)
+    assert outbox.confirmedUpTo() == 0
+    outbox.on_ack(3, False)
+    assert outbox.confirmedUpTo() == 2
+
+def test_sequence_numbers_restart_on_revived_channel(log):
+    outbox = amqpOutbox()
+    outbox.publish("a", "results")
+    outbox.publish("b", "results")
+    outbox.on_ack(1, False)
+    outbox.producer.lose = True
+    outbox.publish("c", "results")
+    channel = outbox.producer.channel
+    assert channel.confirming and outbox.on_ack in channel.events["basic_ack"]
+    # "b" was unconfirmed on the lost channel and goes out again before "c"
+    assert outbox.producer.published == ["a", "b", "b", "c"]
+    assert outbox.sequences == {1: 2, 2: 3}
+    outbox.on_ack(2, True)
+    assert outbox.confirmedUpTo() == 3
+    assert not outbox.unconfirmed
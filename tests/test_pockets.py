@@ -0,0 +1,69 @@
+from collections import deque
+import numpy as np
+from Pockets import findPockets, label, seenAlong, shifted, NEIGHBOURS
+
+def sphere(radius: float, spacing: float) -> np.ndarray:
+    """ Atoms about `spacing` apart on a sphere around the origin. """
+    count = int(4 * np.pi * radius ** 2 / spacing ** 2)
+    index = np.arange(count) + 0.5
+    polar = np.arccos(1 - 2 * index / count)
+    azimuth = np.pi * (1 + 5 ** 0.5) * index
+    return radius * np.stack([np.cos(azimuth) * np.sin(polar), np.sin(azimuth) * np.sin(polar), np.cos(polar)], axis=1)
+
+def referenceLabels(mask: np.ndarray) -> np.ndarray:
+    """ Connected components by breadth-first search, labelled like label(). """
+    labels = np.full(mask.shape, -1)
+    for start in zip(*np.nonzero(mask)):
+        if labels[start] != -1:
+            continue
+        component = [start]
+        labels[start] = 0
+        queue = deque([start])
+        while queue:
+            voxel = queue.popleft()
+            for offset in NEIGHBOURS:
+                neighbour = tuple(np.add(voxel, offset))
+                if all(0 <= n < s for n, s in zip(neighbour, mask.shape)) and mask[neighbour] and labels[neighbour] == -1:
+                    labels[neighbour] = 0
+                    component.append(neighbour)
+                    queue.append(neighbour)
+        smallest = min(np.ravel_multi_index(voxel, mask.shape) for voxel in component)
+        for voxel in component:
+            labels[voxel] = smallest
+    return labels
+
+def test_shifted_moves_and_fills():
+    grid = np.arange(27).reshape(3, 3, 3)
+    out = shifted(grid, (1, 0, -1), fill=-1)
+    assert out[1, 0, 0] == grid[0, 0, 1]
+    assert np.all(out[0] == -1) and np.all(out[:, :, 2] == -1)
+    assert np.all(shifted(grid, (5, 0, 0)) == 0)
+
+def test_seen_along_marks_everything_behind():
+    occupied = np.zeros((1, 1, 9), dtype=bool)
+    occupied[0, 0, 2] = True
+    assert list(seenAlong(occupied, (0, 0, 1))[0, 0]) == [False, False] + [True] * 7
+    assert list(seenAlong(occupied, (0, 0, -1))[0, 0]) == [True] * 3 + [False] * 6
+
+def test_label_matches_breadth_first_search():
+    rng = np.random.default_rng(3)
+    mask = rng.random((12, 10, 8)) < 0.45
+    assert np.array_equal(label(mask), referenceLabels(mask))
+
+def test_finds_the_cavity_of_a_hollow_sphere():
+    atoms = sphere(10.0, 1.2)
+    boxes = findPockets(atoms, 3, minVolume=100.0, padding=4.0)
+    assert len(boxes) == 1
+    center, size = boxes[0]
+    assert np.allclose(center, 0, atol=1.0)
+    # the cavity reaches to about 8 A from the center, plus the padding on both sides
+    assert np.all((size > 20) & (size < 26))
+
+def test_open_structure_has_no_pockets():
+    line = np.stack([np.arange(0, 30, 1.5), np.zeros(20), np.zeros(20)], axis=1)
+    assert findPockets(line, 3) == []
+
+def test_count_and_volume_limit_the_pockets():
+    atoms = sphere(10.0, 1.2)
+    assert findPockets(atoms, 0) == []
+    assert findPockets(atoms, 3, minVolume=1e6) == []
@@ -0,0 +1,72 @@
+import gzip
+import json
+import pytest
+from PoseArchive import PoseArchive, readModes
+
+def vinaOutput(affinities) -> str:
+    models = []
+    for number, affinity in enumerate(affinities, start=1):
+        models.append(f"MODEL {number}\nREMARK VINA RESULT:    {affinity:.1f}      {number - 1:.3f}      "
+                      f"{2 * (number - 1):.3f}\nATOM      1  C   LIG     1       0.000   0.000   0.000\nENDMDL\n")
+    return "".join(models)
+
+@pytest.fixture
+def archive(tmp_path):
+    return PoseArchive(str(tmp_path / "ligand_poses.pdbqt.gz"))
+
+def pose(tmp_path, name, affinities) -> str:
+    path = tmp_path / name
+    path.write_text(vinaOutput(affinities))
+    return str(path)
+
+def test_read_modes():
+    assert readModes(vinaOutput([-9.5, -8.0])) == [[-9.5, 0.0, 0.0], [-8.0, 1.0, 2.0]]
+    assert readModes("ATOM\n") == []
+
+def test_members_are_indexed_by_offset(tmp_path, archive):
+    first = archive.add("r1", pose(tmp_path, "r1.pdbqt", [-9.5, -8.0]))
+    second = archive.add(2, pose(tmp_path, "r2.pdbqt", [-7.0]))
+    assert first["offset"] == 0
+    assert second["offset"] == first["length"]
+    data = open(archive.path, "rb").read()
+    assert len(data) == first["length"] + second["length"]
+    member = data[second["offset"]:second["offset"] + second["length"]]
+    assert gzip.decompress(member).decode() == vinaOutput([-7.0])
+    # the archive as a whole is one valid gzip file
+    assert gzip.decompress(data).decode() == vinaOutput([-9.5, -8.0]) + vinaOutput([-7.0])
+
+def test_get_and_modes(tmp_path, archive):
+    archive.add("r1", pose(tmp_path, "r1.pdbqt", [-9.5, -8.0]))
+    archive.add("r2", pose(tmp_path, "r2.pdbqt", [-7.0]))
+    assert archive.get("r1") == vinaOutput([-9.5, -8.0])
+    assert archive.modes("r2") == [[-7.0, 0.0, 0.0]]
+    out = tmp_path / "extracted.pdbqt"
+    archive.extract("r2", str(out))
+    assert out.read_text() == vinaOutput([-7.0])
+    with pytest.raises(KeyError):
+        archive.get("r3")
+
+def test_last_pose_of_a_receptor_counts(tmp_path, archive):
+    archive.add("r1", pose(tmp_path, "screen.pdbqt", [-6.0]))
+    archive.add("r1", pose(tmp_path, "refined.pdbqt", [-8.5]))
+    assert archive.get("r1") == vinaOutput([-8.5])
+    assert list(archive.entries()) == ["r1"]
+
+def test_index_is_reread_when_another_writer_appended(tmp_path, archive):
+    archive.add("r1", pose(tmp_path, "r1.pdbqt", [-9.0]))
+    assert list(archive.entries()) == ["r1"]
+    PoseArchive(archive.path).add("r2", pose(tmp_path, "r2.pdbqt", [-7.0]))
+    assert list(archive.entries()) == ["r1", "r2"]
+
+def test_torn_index_line_is_skipped(tmp_path, archive):
+    archive.add("r1", pose(tmp_path, "r1.pdbqt", [-9.0]))
+    with open(archive.indexPath, "a") as index:
+        index.write('{"receptor": "r2", "offs')
+    entry = archive.add("r3", pose(tmp_path, "r3.pdbqt", [-7.0]))
+    lines = open(archive.indexPath).read().splitlines()
+    assert json.loads(lines[-1]) == entry
+    assert list(archive.entries()) == ["r1", "r3"]
+    assert archive.get("r3") == vinaOutput([-7.0])
+
+def test_empty_archive(archive):
+    assert archive.entries() == {}
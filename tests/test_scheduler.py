@@ -0,0 +1,54 @@
+import pytest
+import Scheduler as schedulerModule
+from Scheduler import Scheduler
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(schedulerModule, "time", lambda: now[0])
+    return now
+
+def test_shortest_expected_job_first(clock):
+    scheduler = Scheduler(maxWait=600)
+    for cost, task in [(30.0, "medium"), (300.0, "large"), (3.0, "small")]:
+        scheduler.push(cost, task)
+    assert len(scheduler) == 3
+    assert [scheduler.pop() for _ in range(3)] == ["small", "medium", "large"]
+    assert scheduler.pop() is None
+    assert len(scheduler) == 0
+
+def test_equal_costs_keep_arrival_order(clock):
+    scheduler = Scheduler(maxWait=600)
+    for task in ["a", "b", "c"]:
+        scheduler.push(1.0, task)
+    assert [scheduler.pop() for _ in range(3)] == ["a", "b", "c"]
+
+def test_task_waiting_too_long_runs_next(clock):
+    scheduler = Scheduler(maxWait=60)
+    scheduler.push(1000.0, "large")
+    clock[0] += 30
+    scheduler.push(1.0, "small")
+    assert scheduler.pop() == "small"
+    scheduler.push(1.0, "small")
+    clock[0] += 31
+    # the large task has waited 61 s, the new small one 31 s
+    assert scheduler.pop() == "large"
+    assert scheduler.pop() == "small"
+
+def test_overdue_tasks_run_oldest_first(clock):
+    scheduler = Scheduler(maxWait=60)
+    scheduler.push(500.0, "old")
+    clock[0] += 1
+    scheduler.push(100.0, "newer")
+    clock[0] += 120
+    assert [scheduler.pop(), scheduler.pop()] == ["old", "newer"]
+
+def test_stale_heap_entries_are_skipped(clock):
+    scheduler = Scheduler(maxWait=60)
+    scheduler.push(5.0, "cheap")
+    scheduler.push(50.0, "expensive")
+    # taken by cost, still at the front of the age heap
+    assert scheduler.pop() == "cheap"
+    clock[0] += 120
+    assert scheduler.pop() == "expensive"
+    assert scheduler.pop() is None
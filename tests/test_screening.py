@@ -0,0 +1,52 @@
+import math
+import random
+from Screening import Screening
+
+def result(receptor, affinity, success=True):
+    return {"message": {"receptor": receptor, "affinity": affinity, "success": success}}
+
+def test_keeps_the_k_best_affinities():
+    rng = random.Random(4)
+    values = [-2 - 0.05 * number for number in range(200)]
+    rng.shuffle(values)
+    affinities = dict(enumerate(values))
+    screening = Screening("s", 10)
+    for receptor, affinity in affinities.items():
+        screening.add(result(receptor, affinity))
+    expected = sorted(affinities, key=lambda receptor: affinities[receptor])[:10]
+    assert screening.selected() == set(expected)
+    assert screening.cutoff() == affinities[expected[-1]]
+    assert screening.bestAffinity == affinities[expected[0]]
+
+def test_cutoff_is_open_until_k_results():
+    screening = Screening("s", 3)
+    screening.add(result(1, -5.0))
+    screening.add(result(2, -7.0))
+    assert screening.cutoff() == math.inf
+    screening.add(result(3, -6.0))
+    assert screening.cutoff() == -5.0
+    screening.add(result(4, -4.0))
+    assert screening.cutoff() == -5.0
+    screening.add(result(5, -9.0))
+    assert screening.cutoff() == -6.0
+    assert screening.selected() == {2, 3, 5}
+
+def test_failures_are_never_selected():
+    screening = Screening("s", 2, margin=10.0)
+    screening.add(result(1, 0, success=False))
+    screening.add(result(2, -5.0))
+    assert screening.selected() == {2}
+    assert set(screening.results) == {1, 2}
+
+def test_margin_adds_receptors_close_to_the_best():
+    screening = Screening("s", 1, margin=1.0)
+    for receptor, affinity in [(1, -8.0), (2, -7.5), (3, -7.0), (4, -6.9)]:
+        screening.add(result(receptor, affinity))
+    assert screening.selected() == {1, 2, 3}
+
+def test_no_top_k_selects_by_margin_only():
+    screening = Screening("s", 0, margin=0.5)
+    for receptor, affinity in [(1, -8.0), (2, -7.6), (3, -7.0)]:
+        screening.add(result(receptor, affinity))
+    assert screening.best == []
+    assert screening.selected() == {1, 2}
@@ -0,0 +1,85 @@
+import random
+import numpy as np
+import pytest
+from Structure import Structure
+from DockingPrepper import DockingPrepper
+
+def oldStripRotamers(text: str) -> str:
+    """ The line by line filter removeRotamers used before Structure. """
+    toDelete = ['A', 'G', 'C', 'U', 'I', 'DA', 'DG', 'DC', 'DT', 'DI']
+    kept = []
+    for line in text.splitlines(keepends=True):
+        if line.startswith("ATOM") or line.startswith("HETATM"):
+            if line[17:20].strip() in toDelete:
+                continue
+            if line[16:17] != ' ' and line[16:17] != 'A':
+                continue
+        kept.append(line)
+    return "".join(kept)
+
+def atomLine(record, serial, name, altloc, residue, x, y, z) -> str:
+    return (f"{record:<6}{serial:>5} {name:<4}{altloc}{residue:>3} A{serial % 500:>4}    "
+            f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00 20.00           C\n")
+
+def randomPDB(rng, atoms: int) -> str:
+    lines = ["HEADER    TEST\n", "REMARK   1 ATOM RECORDS BELOW\n"]
+    for serial in range(1, atoms + 1):
+        record = rng.choice(["ATOM", "ATOM", "ATOM", "HETATM"])
+        residue = rng.choice(["ALA", "GLY", "HOH", "DA", "U", "A", "DT", "LYS"])
+        altloc = rng.choice([" ", " ", " ", "A", "B", "C"])
+        lines.append(atomLine(record, serial, "CA", altloc, residue,
+                              rng.uniform(-999, 999), rng.uniform(-99, 99), rng.uniform(-9, 9)))
+        if rng.random() < 0.05:
+            lines.append("TER\n")
+        if rng.random() < 0.02:
+            # a line cut short before the residue name
+            lines.append("ATOM     99  CB\n")
+    lines.append("END")
+    return "".join(lines)
+
+@pytest.fixture
+def pdb(tmp_path):
+    path = tmp_path / "receptor.pdb"
+    path.write_text(randomPDB(random.Random(5), 2000))
+    return path
+
+def test_strip_rotamers_matches_the_line_parser(pdb):
+    expected = oldStripRotamers(pdb.read_text())
+    assert DockingPrepper({}).stripRotamers(str(pdb)).decode() == expected
+
+def test_remove_rotamers_writes_the_same_file(pdb, tmp_path):
+    out = tmp_path / "out.pdb"
+    DockingPrepper({}).removeRotamers(str(pdb), str(out))
+    assert out.read_text() == oldStripRotamers(pdb.read_text())
+
+def test_coordinates_match_the_columns(pdb):
+    lines = pdb.read_text().splitlines()
+    expected = [[float(line[30:38]), float(line[38:46]), float(line[46:54])]
+                for line in lines if line.startswith("ATOM") and len(line) >= 54]
+    with Structure(str(pdb)) as structure:
+        mask = structure.records(b"ATOM") & (structure.ends - structure.starts >= 54)
+        assert np.allclose(structure.coordinates(mask), expected)
+
+def test_fields_of_every_line(pdb):
+    lines = pdb.read_text().splitlines()
+    with Structure(str(pdb)) as structure:
+        assert len(structure.starts) == len(lines)
+        assert [bytes([a]).decode() for a in structure.altlocs()] == [(line + " " * 17)[16] for line in lines]
+        assert [r.decode() for r in structure.residueNames()] == [line[17:20].strip() for line in lines]
+        assert list(structure.atoms()) == [line.startswith(("ATOM", "HETATM")) for line in lines]
+
+def test_short_lines_and_missing_final_newline(tmp_path):
+    path = tmp_path / "short.pdb"
+    path.write_text("ATOM\nHETATM    1  O   HOH\nEND")
+    with Structure(str(path)) as structure:
+        assert structure.columns.shape == (3, 54)
+        assert bytes(structure.columns[0]).decode() == "ATOM".ljust(54)
+        assert bytes(structure.columns[2]).decode() == "END".ljust(54)
+        assert structure.select(np.array([True, False, True])) == b"ATOM\nEND"
+
+def test_empty_file(tmp_path):
+    path = tmp_path / "empty.pdb"
+    path.write_bytes(b"")
+    with Structure(str(path)) as structure:
+        assert structure.columns.shape == (0, 54)
+        assert structure.select(np.zeros(0, dtype=bool)) == b""